@@ -58,7 +58,7 @@ This package adds packet marking capability on IPv6 flow label field using eBPF/
 
 %prep
 %autosetup -n %{pypi_name}-%{version}
-pathfix.py -pni "%{__python3} %{py3_shbang_opts}" . sbin/flowd
+pathfix.py -pni "%{__python3} %{py3_shbang_opts}" . sbin/flowd sbin/flowd-bench
 
 %build
 %py3_build
@@ -78,17 +78,31 @@ rm -rf $RPM_BUILD_ROOT
 %{python3_sitelib}/scitags/service.py
 %{python3_sitelib}/scitags/__init__.py
 %{python3_sitelib}/scitags/config.py
+%{python3_sitelib}/scitags/ring.py
+%{python3_sitelib}/scitags/codec.py
+%{python3_sitelib}/scitags/supervisor.py
+%{python3_sitelib}/scitags/flowmap.py
+%{python3_sitelib}/scitags/startup.py
+%{python3_sitelib}/scitags/latency.py
+%{python3_sitelib}/scitags/metrics.py
+%{python3_sitelib}/scitags/aio.py
+%{python3_sitelib}/scitags/profiling.py
+%{python3_sitelib}/scitags/logs.py
+%{python3_sitelib}/scitags/udp.py
+%{python3_sitelib}/scitags/timers.py
 %{python3_sitelib}/scitags/stun/*
 %{python3_sitelib}/scitags/plugins/firefly.py
 %{python3_sitelib}/scitags/plugins/netstat.py
 %{python3_sitelib}/scitags/plugins/__init__.py
 %{python3_sitelib}/scitags/plugins/iperf.py
 %{python3_sitelib}/scitags/plugins/np_api.py
+%{python3_sitelib}/scitags/plugins/synthetic.py
 %{python3_sitelib}/scitags/backends/udp_firefly.py
 %{python3_sitelib}/scitags/backends/__init__.py
 %{python3_sitelib}/scitags/netlink/__init__.py
 %config(noreplace) /etc/flowd/flowd.cfg
 %attr(755, root, root) /usr/sbin/flowd
+%attr(755, root, root) /usr/sbin/flowd-bench
 /usr/lib/systemd/system/flowd.service
 
 %files prometheus
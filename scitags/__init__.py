@@ -1,11 +1,20 @@
 import collections
+import ctypes
+import datetime
+import logging
 import os
+import time
+import socket
+import zlib
 import multiprocessing as mp
+import multiprocessing.queues
 try:
     import queue
 except ImportError:
     import Queue as queue
 
+from scitags import settings
+
 AUTHOR = "Marian Babik <Marian.Babik@cern.ch>, Tristan Sullivan <tssulliv@uvic.ca>, Luca Bassi"
 AUTHOR_EMAIL = "<net-wg-dev@cern.ch>"
 VERSION = "1.1.7"
@@ -14,6 +23,8 @@ __author__ = AUTHOR
 __version__ = VERSION
 __date__ = DATE
 
+log = logging.getLogger('scitags')
+
 
 class FlowConfigException(Exception):
     pass
@@ -30,38 +41,676 @@ class FlowIdException(Exception):
 #   inputs: (protocol, src, src_port, dst, dst_port, experiment, activity)
 # flow-update (optional)
 #   inputs: (protocol, src, src_port, dst, dst_port, experiment, activity)
+# stamps are (detected, enqueued) time.monotonic() timestamps set on publish (see scitags.latency)
 FlowID = collections.namedtuple('FlowID', ['state', 'prot', 'src', 'src_port', 'dst', 'dst_port', 'exp', 'act',
-                                           'start_time', 'end_time', 'netlink'])
-FlowID.__new__.__defaults__ = (None,) * 3   # start_time/end_time/netlink default to None
+                                           'start_time', 'end_time', 'netlink', 'stamps'])
+FlowID.__new__.__defaults__ = (None,) * 4   # start_time/end_time/netlink/stamps default to None
+
+# Control message sent over the bus to the backends when the flow map registry changes,
+# backends swap in flow_map as a whole; version is increased with each update
+FlowMapUpdate = collections.namedtuple('FlowMapUpdate', ['version', 'flow_map'])
+
+# Control message with the config changes made on reload (SIGHUP), changed is a dict of new/changed keys,
+# removed a list of keys; applied to scitags.config.config by the bus subscribers and plugin publishers
+ConfigUpdate = collections.namedtuple('ConfigUpdate', ['version', 'changed', 'removed'])
+
+# Control message sent to the backends on shutdown once the plugins have stopped, the subscriber hands out
+# the starts held by the coalescer and reports it's drained (BusSubscriber.drain_state) as soon as the backend
+# asks for more events, i.e. once everything published before it has been processed
+DrainRequest = collections.namedtuple('DrainRequest', [])
+
+# BusSubscriber.drain_state
+DRAIN_NONE, DRAIN_REQUESTED, DRAINED = range(3)
+
+
+# requests is imported on first use (flow map refresh, IP discovery) to keep startup fast;
+# name resolution is restricted to IPv4 for all requests made by flowd
+def get_requests():
+    import requests
+    import requests.packages.urllib3.util.connection as urllib3_cn
+    urllib3_cn.allowed_gai_family = lambda: socket.AF_INET
+    return requests
 
 
 # IP config container
 IPConfig = collections.namedtuple('ip_config', ['pub_ip4', 'int_ip4', 'pub_ip6', 'int_ip6'])
 
+# Counters kept by each bus subscriber for its backend (BusSubscriber.counters, see scitags.metrics)
+BACKEND_COUNTERS = ('events_in', 'events_out', 'mapping_errors', 'send_errors', 'events_dropped', 'events_cancelled',
+                    'flows_coalesced', 'flows_suppressed', 'flow_updates')
+(EVENTS_IN, EVENTS_OUT, MAPPING_ERRORS, SEND_ERRORS, EVENTS_DROPPED, EVENTS_CANCELLED,
+ FLOWS_COALESCED, FLOWS_SUPPRESSED, FLOW_UPDATES) = range(len(BACKEND_COUNTERS))
+
+# Counters of the datagrams sent by a backend per destination (BusSubscriber.destinations, see scitags.udp)
+DESTINATION_COUNTERS = ('datagrams_sent', 'datagrams_eagain', 'datagrams_dropped', 'datagrams_ratelimited',
+                        'destination_errors', 'dns_lookups', 'dns_failures')
+(DATAGRAMS_SENT, DATAGRAMS_EAGAIN, DATAGRAMS_DROPPED, DATAGRAMS_RATELIMITED,
+ DESTINATION_ERRORS, DNS_LOOKUPS, DNS_FAILURES) = range(len(DESTINATION_COUNTERS))
+
+
+# Named counters in shared memory, destinations are added by the backend process (up to size, the rest
+# is counted in the last one) and read by the service; state of each destination is 1 (up) or 0 (down),
+# time spent resolving it (DNS) is summed up in seconds
+class DestinationCounters(object):
+    NAME_SIZE = 64
+
+    def __init__(self, size=16):
+        self.size = size
+        self._names = mp.RawArray(ctypes.c_char, size * self.NAME_SIZE)
+        self._counters = mp.RawArray(ctypes.c_uint64, size * len(DESTINATION_COUNTERS))
+        self._states = mp.RawArray(ctypes.c_ubyte, size)
+        self._times = mp.RawArray(ctypes.c_double, size)
+        self._used = mp.RawValue(ctypes.c_uint32, 0)
+
+    def names(self):
+        return [self._names[i * self.NAME_SIZE:(i + 1) * self.NAME_SIZE].rstrip(b'\0').decode('utf-8', 'replace')
+                for i in range(self._used.value)]
+
+    def slot(self, name):
+        # index of the destination, added if it's not known yet
+        names = self.names()
+        if name in names:
+            return names.index(name)
+        used = self._used.value
+        if used >= self.size:
+            return self.size - 1
+        raw = name.encode('utf-8')[:self.NAME_SIZE - 1]
+        self._names[used * self.NAME_SIZE:(used + 1) * self.NAME_SIZE] = raw.ljust(self.NAME_SIZE, b'\0')
+        self._states[used] = 1
+        self._used.value = used + 1
+        return used
+
+    def count(self, slot, counter, n=1):
+        self._counters[slot * len(DESTINATION_COUNTERS) + counter] += n
+
+    def set_state(self, slot, up):
+        self._states[slot] = int(up)
+
+    def add_time(self, slot, seconds):
+        self._times[slot] += seconds
+
+    def times(self):
+        return [(name, self._times[i]) for i, name in enumerate(self.names())]
+
+    def states(self):
+        return [(name, self._states[i]) for i, name in enumerate(self.names())]
+
+    def items(self):
+        n = len(DESTINATION_COUNTERS)
+        return [(name, self._counters[i * n:(i + 1) * n]) for i, name in enumerate(self.names())]
+
+
+# Overload policies of the event bus (EVENT_BUS_POLICY), see PubSubQueue
+POLICIES = ('block', 'drop-oldest', 'drop-newest', 'cancel')
+
+
+# Shard index of a flow, all events of the same flow (5-tuple) map to the same shard
+def flow_shard(flow_id, shards):
+    key = '{} {} {} {} {}'.format(flow_id.prot, flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+# Batch of FlowIDs sent over the bus as a single frame (see put_many)
+class FlowBatch(list):
+    pass
+
+
+# Drops duplicate reports of the same flow when several plugins are running,
+# the first start (and first end) reported for a flow wins, except for starts tagged with one of the
+# catch_all (experiment, activity) of the plugins that report every connection (e.g. netlink), these
+# are replaced by a later start with a specific tag (e.g. from np_api); the end of the flow is handed
+# out with the tag of the start that won
+class FlowDedup(object):
+    def __init__(self, size=100000, catch_all=()):
+        self._size = size
+        self._catch_all = frozenset(catch_all)
+        self._active = collections.OrderedDict()
+        self._ended = collections.OrderedDict()
+
+    @staticmethod
+    def _remember(index, key, value, size):
+        index[key] = value
+        if len(index) > size:
+            index.popitem(last=False)
+
+    def filter(self, flow_id):
+        # returns the flow to hand out or None for a duplicate
+        if not isinstance(flow_id, FlowID):
+            return flow_id
+        key = (flow_id.prot, flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)
+        tag = (flow_id.exp, flow_id.act)
+        if flow_id.state == 'start':
+            active = self._active.get(key)
+            if active is not None and (active not in self._catch_all or tag in self._catch_all):
+                return None
+            self._ended.pop(key, None)
+            self._remember(self._active, key, tag, self._size)
+        elif flow_id.state == 'end':
+            active = self._active.pop(key, None)
+            if active is not None:
+                self._remember(self._ended, key, True, self._size)
+                if active != tag:
+                    return flow_id._replace(exp=active[0], act=active[1])
+            elif key in self._ended:
+                return None
+        return flow_id
+
+
+def flow_lifetime(flow_id):
+    # seconds between start_time and end_time (as produced by the plugins), None if they can't be parsed
+    try:
+        times = [datetime.datetime.strptime(ts[:-6], '%Y-%m-%dT%H:%M:%S.%f' if '.' in ts else '%Y-%m-%dT%H:%M:%S')
+                 for ts in (flow_id.start_time, flow_id.end_time)]
+    except (TypeError, ValueError):
+        return None
+    delta = times[1] - times[0]
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+# Holds flow starts for window seconds before handing them out; if the end of the flow arrives
+# in the meantime only the end is handed out (it carries both start and end time), or nothing
+# at all if the flow lasted less than min_lifetime
+class FlowCoalescer(object):
+    def __init__(self, window, min_lifetime=0, counters=None):
+        self._window = max(window, min_lifetime)
+        self._min_lifetime = min_lifetime
+        self._counters = counters
+        self._held = collections.OrderedDict()   # flow key -> (release time, start), in order of release
+
+    def next_release(self):
+        for release, _ in self._held.values():
+            return release
+        return None
+
+    def _count(self, counter):
+        if self._counters is not None:
+            self._counters[counter] += 1
+
+    def flush(self):
+        # returns all held starts (shutdown)
+        out = [start for _, start in self._held.values()]
+        self._held.clear()
+        return out
+
+    def process(self, events, now):
+        # returns starts held for long enough followed by events, starts and ends of short flows
+        # are taken out of events
+        out = list()
+        while self._held:
+            key, (release, start) = next(iter(self._held.items()))
+            if release > now:
+                break
+            del self._held[key]
+            out.append(start)
+        for val in events:
+            if not isinstance(val, FlowID):
+                out.append(val)
+                continue
+            key = (val.prot, val.src, val.src_port, val.dst, val.dst_port)
+            if val.state == 'start':
+                self._held[key] = (now + self._window, val)
+                continue
+            if val.state == 'end' and key in self._held:
+                del self._held[key]
+                lifetime = flow_lifetime(val)
+                if lifetime is not None and lifetime < self._min_lifetime:
+                    self._count(FLOWS_SUPPRESSED)
+                    continue
+                self._count(FLOWS_COALESCED)
+            out.append(val)
+        return out
+
+
+# returned by BusSubscriber._accept for events that are not handed out
+_SKIP = object()
+
+
+# Subscriber side of the event bus, unpacks batches so that backends can consume
+# events one by one (get) or in batches (get_batch); with a codec (see scitags.codec)
+# events arrive encoded and are decoded only when handed out; shard=(index, count)
+# passes only the flows that belong to the given shard (see flow_shard); config
+# updates (ConfigUpdate) are applied to the backend's config and not handed out; config and flow map updates
+# not newer than the last one seen (config_version/flow_map_version) are skipped, so that they can be re-sent
+# to a subscriber that may have lost some (see FlowService.resync_backends);
+# with latency (scitags.latency.LatencyStats) per-stage latency of the events is recorded,
+# backends report when an event was emitted by calling emitted and count errors with count
+# (and datagrams sent per destination in destinations);
+# coalesce=(window, min_lifetime) passes the events through FlowCoalescer (get_batch only);
+# dedup (True or the plugins' catch-all (experiment, activity) tags) passes them through FlowDedup;
+# on shutdown the subscriber reports in drain_state when the backend is done with the events
+# published before DrainRequest
+class BusSubscriber(object):
+    def __init__(self, codec=None, dedup=False, shard=None, latency=None, coalesce=None):
+        self._pending = collections.deque()
+        self._codec = codec
+        self._dedup = FlowDedup(catch_all=() if dedup is True else dedup) if dedup else None
+        self._shard = shard
+        self.latency = latency
+        self.counters = mp.RawArray(ctypes.c_uint64, len(BACKEND_COUNTERS))
+        self.destinations = DestinationCounters()
+        self._coalescer = FlowCoalescer(coalesce[0], coalesce[1], self.counters) if coalesce else None
+        self.drain_state = mp.RawValue(ctypes.c_ubyte, DRAIN_NONE)
+        self.config_version = mp.RawValue(ctypes.c_uint64, 0)
+        self.flow_map_version = mp.RawValue(ctypes.c_uint64, 0)
+        self._drain = False
+
+    def depth(self):
+        # events (or frames) waiting on the bus, None if not known
+        return None
+
+    def _get_frame(self, block, timeout):
+        raise NotImplementedError
+
+    def reattach(self):
+        # called before the subscription is handed over to a new (restarted) backend process
+        self._pending.clear()
+
+    def _on_fill(self, n):
+        pass
+
+    def _fill(self, block, timeout):
+        frame = self._get_frame(block, timeout)
+        n = len(self._pending)
+        if isinstance(frame, FlowBatch):
+            self._pending.extend(frame)
+        elif self._codec and isinstance(frame, bytes):
+            self._pending.extend(self._codec.split_batch(frame))
+        else:
+            self._pending.append(frame)
+        self._on_fill(len(self._pending) - n)
+
+    def _pop(self):
+        item = self._pending.popleft()
+        if isinstance(item, memoryview):
+            return self._codec.decode(item)
+        return item
+
+    def _accept(self, item):
+        # returns the item to hand out (flows can be re-tagged by the dedup) or _SKIP
+        if isinstance(item, ConfigUpdate):
+            if item.version > self.config_version.value:
+                import scitags.config
+                scitags.config.apply_update(item)
+                self.config_version.value = item.version
+            return _SKIP
+        if isinstance(item, FlowMapUpdate):
+            if item.version <= self.flow_map_version.value:
+                return _SKIP
+            self.flow_map_version.value = item.version
+            return item
+        if isinstance(item, DrainRequest):
+            self._drain = True
+            self.drain_state.value = DRAIN_REQUESTED
+            return _SKIP
+        if self._shard and isinstance(item, FlowID) and flow_shard(item, self._shard[1]) != self._shard[0]:
+            return _SKIP
+        if self._dedup:
+            item = self._dedup.filter(item)
+            if item is None:
+                return _SKIP
+        return item
+
+    def _check_drained(self):
+        # called when the backend asks for more events, i.e. it's done with the ones handed out before
+        if self._drain:
+            self.drain_state.value = DRAINED
+
+    def get(self, block=True, timeout=None):
+        self._check_drained()
+        while True:
+            while not self._pending:
+                self._fill(block, timeout)
+            item = self._accept(self._pop())
+            if item is not _SKIP:
+                self.counters[EVENTS_IN] += 1
+                if self.latency:
+                    self.latency.dequeued((item,))
+                return item
+
+    def get_batch(self, max_items, timeout=None):
+        # blocks until at least one event is available, then takes whatever else is already queued
+        # (the batch can be empty if all events were filtered out or are held by the coalescer)
+        self._check_drained()
+        if not self._coalescer:
+            return self._get_batch(max_items, timeout)
+        release = self._coalescer.next_release()
+        if release is not None:
+            # wake up in time to hand out the held starts
+            wait = max(release - time.monotonic(), 0)
+            if timeout is None or wait < timeout:
+                try:
+                    batch = self._get_batch(max_items, wait)
+                except queue.Empty:
+                    batch = list()
+                batch = self._coalescer.process(batch, time.monotonic())
+            else:
+                batch = self._coalescer.process(self._get_batch(max_items, timeout), time.monotonic())
+        else:
+            batch = self._coalescer.process(self._get_batch(max_items, timeout), time.monotonic())
+        if self._drain:
+            batch.extend(self._coalescer.flush())
+        return batch
+
+    def _get_batch(self, max_items, timeout):
+        while not self._pending:
+            self._fill(True, timeout)
+        while len(self._pending) < max_items:
+            try:
+                self._fill(False, None)
+            except queue.Empty:
+                break
+        batch = [self._pop() for _ in range(min(max_items, len(self._pending)))]
+        batch = [item for item in map(self._accept, batch) if item is not _SKIP]
+        self.counters[EVENTS_IN] += len(batch)
+        if self.latency:
+            self.latency.dequeued(batch)
+        return batch
+
+    def emitted(self, flow_id):
+        self.counters[EVENTS_OUT] += 1
+        if self.latency:
+            self.latency.emitted(flow_id)
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+
+# Queue of a PubSubSubscriber, the workarounds that depend on the internals of multiprocessing.queues.Queue
+# (checked against CPython 3.6 - 3.12) are kept here
+class SubscriberQueue(multiprocessing.queues.Queue):
+    def __init__(self):
+        super(SubscriberQueue, self).__init__(ctx=mp.get_context())
+
+    def reset_reader_lock(self):
+        # the reader lock is only taken by get() of the subscriber's (single) backend process, if that process
+        # died holding it the restarted backend would block forever; it's safe to replace it before the new
+        # process is forked as the producers never take it (a frame the dead process was reading can't be recovered)
+        self._rlock = mp.Lock()
+
+    def remove_events(self, n, events):
+        # removes whole frames with at least n events in total from the frames this process has not written to
+        # the pipe yet (buffer of the feeder thread), frames already in the pipe can't be removed; events(frame)
+        # is the number of events in the frame, 0 for control messages (kept); returns number of events removed
+        removed = 0
+        if self._buffer is None:
+            return 0
+        with self._notempty:
+            kept = collections.deque()
+            while self._buffer and removed < n:
+                frame = self._buffer.popleft()
+                count = events(frame)
+                if count:
+                    removed += count
+                    self._sem.release()
+                else:
+                    kept.append(frame)
+            self._buffer.extendleft(reversed(kept))
+        return removed
+
+
+class PubSubSubscriber(BusSubscriber):
+    def __init__(self, q, codec=None, dedup=False, latency=None, coalesce=None):
+        super(PubSubSubscriber, self).__init__(codec, dedup, latency=latency, coalesce=coalesce)
+        self._queue = q
+        # events sent to the queue (by any of the producers), taken from it by the subscriber and
+        # removed from it by the producers (drop-oldest); _removed and counters[EVENTS_DROPPED/CANCELLED]
+        # are updated under the _sent lock
+        self._sent = mp.Value(ctypes.c_uint64, 0)
+        self._received = mp.RawValue(ctypes.c_uint64, 0)
+        self._removed = mp.RawValue(ctypes.c_uint64, 0)
+
+    def _get_frame(self, block, timeout):
+        return self._queue.get(block, timeout)
+
+    def _on_fill(self, n):
+        self._received.value += n
+
+    def depth(self):
+        # events waiting in the queue
+        return self._sent.value - self._received.value - self._removed.value
+
+    def reattach(self):
+        super(PubSubSubscriber, self).reattach()
+        if isinstance(self._queue, SubscriberQueue):
+            self._queue.reset_reader_lock()
+
+
+def latency_stats(enabled):
+    # histograms are allocated in shared memory before the backends are forked
+    if not enabled:
+        return None
+    import scitags.latency
+    return scitags.latency.LatencyStats()
+
+
+# Drops start and end of the flows that ended before their start could be sent,
+# returns (events, number of events cancelled)
+def cancel_pairs(events):
+    starts = dict()
+    cancelled = set()
+    for i, val in enumerate(events):
+        if not isinstance(val, FlowID):
+            continue
+        key = (val.prot, val.src, val.src_port, val.dst, val.dst_port)
+        if val.state == 'start':
+            starts[key] = i
+        elif val.state == 'end' and key in starts:
+            cancelled.add(starts.pop(key))
+            cancelled.add(i)
+    if not cancelled:
+        return events, 0
+    return [val for i, val in enumerate(events) if i not in cancelled], len(cancelled)
+
+
 # Publish/Subscribe Multiprocessing Queue
+#
+# Each subscriber can hold up to capacity events (0 - unbounded), when it's full the policy decides:
+#   block - producer waits until the subscriber makes room (up to block_timeout, then the rest is dropped)
+#   drop-oldest - producer drops the oldest events it hasn't written to the queue yet (control messages are kept)
+#   drop-newest - events that don't fit are dropped
+#   cancel - events that don't fit are held back by the producer (up to capacity) and sent once there is room,
+#            start/end pairs of flows that ended while being held back are dropped together; newest events
+#            are dropped if the producer can't hold any more (or when it stops, see release)
+# Dropped and cancelled events are counted per subscriber (counters[EVENTS_DROPPED/EVENTS_CANCELLED]).
 class PubSubQueue(object):
-    def __init__(self):
+    def __init__(self, codec=None, dedup=False, latency=False, capacity=0, policy='drop-oldest', coalesce=None,
+                 block_timeout=settings.EVENT_BUS_BLOCK_TIMEOUT):
+        if policy not in POLICIES:
+            raise FlowConfigException('Unknown event bus policy {}, expected one of {}'.format(policy,
+                                                                                           ', '.join(POLICIES)))
         self._queues = []
+        self._fanout = []
+        self._shard_groups = []
+        self._codec = codec
+        self._dedup = dedup
+        self._latency = latency
+        self._coalesce = coalesce
+        self._capacity = capacity
+        self._policy = policy
+        self._block_timeout = block_timeout
+        self._held = dict()
+        self._blocked = set()
         self._creator_pid = os.getpid()
 
     def __getstate__(self):
         self_dict = self.__dict__
         self_dict['_queues'] = []
+        self_dict['_fanout'] = []
+        self_dict['_shard_groups'] = []
         return self_dict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
 
-    def register(self):
-        q = mp.Queue()
+    def _subscriber(self):
+        q = SubscriberQueue()
         self._queues.append(q)
-        return q
+        return PubSubSubscriber(q, self._codec, self._dedup, latency_stats(self._latency), self._coalesce)
+
+    def register(self):
+        sub = self._subscriber()
+        self._fanout.append(sub)
+        return sub
+
+    def register_shards(self, shards):
+        # pool of subscribers, each flow is sent to exactly one of them (see flow_shard)
+        group = [self._subscriber() for _ in range(shards)]
+        self._shard_groups.append(group)
+        return group
+
+    def _encode(self, vals):
+        if self._codec:
+            return self._codec.encode_batch(vals)
+        return FlowBatch(vals)
+
+    def _frame_events(self, frame):
+        if isinstance(frame, FlowBatch):
+            return len(frame)
+        if self._codec and isinstance(frame, bytes):
+            return len(self._codec.split_batch(frame))
+        return 1
+
+    def _put_frame(self, sub, frame, n):
+        with sub._sent.get_lock():
+            sub._sent.value += n
+        sub._queue.put(frame)
+
+    def _count(self, sub, counter, n):
+        if n:
+            with sub._sent.get_lock():
+                sub.counters[counter] += n
+
+    def _free(self, sub):
+        return self._capacity - sub.depth()
+
+    def _event_frame(self, frame):
+        # number of events in frame, 0 for control messages
+        if isinstance(frame, (FlowBatch, FlowID, bytes)):
+            return self._frame_events(frame)
+        return 0
+
+    def _drop_oldest(self, sub, n):
+        # removes at least n events (whole frames) not written to the queue yet, see SubscriberQueue.remove_events;
+        # returns number of events removed
+        removed = sub._queue.remove_events(n, self._event_frame)
+        with sub._sent.get_lock():
+            sub._removed.value += removed
+            sub.counters[EVENTS_DROPPED] += removed
+        return removed
+
+    def _send(self, key, sub, vals, frame=None):
+        # sends vals to sub applying the overload policy, frame is vals already encoded
+        if not self._capacity:
+            self._put_frame(sub, frame if frame is not None else self._encode(vals), len(vals))
+            return
+        held = self._held.get(key)
+        if held:
+            vals = held + vals
+            frame = None
+            del self._held[key]
+        if not vals:
+            return
+        free = self._free(sub)
+        if len(vals) <= free:
+            self._put_frame(sub, frame if frame is not None else self._encode(vals), len(vals))
+            return
+        getattr(self, '_overload_' + self._policy.replace('-', '_'))(key, sub, vals, max(free, 0))
+
+    # overload policies (_overload_<policy>), called with the events that don't all fit into sub
+    # (free is the room left)
+    def _overload_block(self, key, sub, vals, free):
+        if key not in self._blocked:
+            log.warning('event bus subscriber full ({} events), waiting (logged only once)'.format(self._capacity))
+            self._blocked.add(key)
+        deadline = time.monotonic() + self._block_timeout
+        while vals:
+            free = self._free(sub)
+            if free > 0:
+                self._put_frame(sub, self._encode(vals[:free]), len(vals[:free]))
+                vals = vals[free:]
+            elif time.monotonic() >= deadline:
+                self._count(sub, EVENTS_DROPPED, len(vals))
+                return
+            else:
+                time.sleep(0.01)
+
+    def _overload_drop_oldest(self, key, sub, vals, free):
+        if len(vals) > self._capacity:
+            self._count(sub, EVENTS_DROPPED, len(vals) - self._capacity)
+            vals = vals[len(vals) - self._capacity:]
+        self._drop_oldest(sub, len(vals) - free)
+        self._put_frame(sub, self._encode(vals), len(vals))
+
+    def _overload_drop_newest(self, key, sub, vals, free):
+        self._count(sub, EVENTS_DROPPED, len(vals) - free)
+        if free:
+            self._put_frame(sub, self._encode(vals[:free]), free)
+
+    def _overload_cancel(self, key, sub, vals, free):
+        vals, cancelled = cancel_pairs(vals)
+        self._count(sub, EVENTS_CANCELLED, cancelled)
+        if free:
+            self._put_frame(sub, self._encode(vals[:free]), len(vals[:free]))
+        held = vals[free:]
+        if len(held) > self._capacity:
+            self._count(sub, EVENTS_DROPPED, len(held) - self._capacity)
+            held = held[:self._capacity]
+        if held:
+            self._held[key] = held
+
+    def _control(self, sub, val):
+        # control messages are never dropped
+        self._put_frame(sub, val, 1)
 
     def put(self, val):
-        for q in self._queues:
-            q.put(val)
+        if not isinstance(val, FlowID):
+            for sub in self._fanout:
+                self._control(sub, val)
+            for group in self._shard_groups:
+                for sub in group:
+                    self._control(sub, val)
+            return
+        self.put_many((val,))
+
+    def put_many(self, vals):
+        # also sends events held back by the cancel policy, so it's called by the plugins even with no events
+        vals = list(vals)
+        if not vals and not self._held:
+            return
+        if self._fanout:
+            frame = self._encode(vals) if vals else None
+            for i, sub in enumerate(self._fanout):
+                self._send((None, i), sub, vals, frame)
+        for g, group in enumerate(self._shard_groups):
+            parts = [list() for _ in group]
+            for val in vals:
+                if isinstance(val, FlowID):
+                    parts[flow_shard(val, len(group))].append(val)
+                else:
+                    for part in parts:
+                        part.append(val)
+            for i, (sub, part) in enumerate(zip(group, parts)):
+                self._send((g, i), sub, part)
+
+    def flush(self):
+        # sends the events held back by the cancel policy if there is room, called by the plugins on every
+        # poll (or tick) so that they don't wait for the next event
+        if self._held:
+            self.put_many(())
+
+    def _drop_held(self):
+        for (g, i), vals in self._held.items():
+            sub = self._fanout[i] if g is None else self._shard_groups[g][i]
+            self._count(sub, EVENTS_DROPPED, len(vals))
+        self._held.clear()
+
+    def release(self):
+        # called by a producer that stops publishing, events it still holds back are counted as dropped
+        self.flush()
+        self._drop_held()
 
     def close(self):
+        self._drop_held()
         while True:
             try:
                 for q in self._queues:
@@ -73,4 +722,3 @@ class PubSubQueue(object):
         for q in self._queues:
             q.close()
             q.join_thread()
-
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import scitags
+import scitags.settings
+import scitags.supervisor
+
+log = logging.getLogger('scitags')
+
+# Single process runtime (RUNTIME = 'asyncio')
+#
+# Plugins and backends run as asyncio tasks of the service process instead of forked processes, which saves
+# the interpreter, config and libraries loaded by each of the children. The plugin and backend modules are
+# the same as in the multi-process runtime, their run() loops block (psutil, netlink or ss polls, waiting
+# on the bus), so each task awaits its run() on a thread of a small pool and the event loop only does the
+# supervision, config reload and reporting. Events are passed by reference over in-process queues.
+# Intended for small hosts and containers, everything shares one interpreter (and the GIL), backend
+# worker pools are not available.
+
+
+# PubSubQueue over in-process queues, events are not encoded; producers (plugin threads) are serialized
+class ThreadQueue(scitags.PubSubQueue):
+    def __init__(self, dedup=False, latency=False, capacity=0, policy='drop-oldest', coalesce=None,
+                 block_timeout=scitags.settings.EVENT_BUS_BLOCK_TIMEOUT):
+        super(ThreadQueue, self).__init__(None, dedup, latency, capacity, policy, coalesce, block_timeout)
+        self._lock = threading.RLock()
+
+    def _subscriber(self):
+        q = queue.Queue()
+        self._queues.append(q)
+        return scitags.PubSubSubscriber(q, None, self._dedup, scitags.latency_stats(self._latency),
+                                        self._coalesce)
+
+    def _drop_oldest(self, sub, n):
+        # unlike with multiprocessing queues, any frame not taken by the subscriber yet can be removed
+        q = sub._queue
+        removed = 0
+        with q.mutex:
+            kept = collections.deque()
+            while q.queue and removed < n:
+                frame = q.queue.popleft()
+                if isinstance(frame, (scitags.FlowBatch, scitags.FlowID)):
+                    removed += self._frame_events(frame)
+                else:
+                    kept.append(frame)
+            q.queue.extendleft(reversed(kept))
+        with sub._sent.get_lock():
+            sub._removed.value += removed
+            sub.counters[scitags.EVENTS_DROPPED] += removed
+        return removed
+
+    def put(self, val):
+        with self._lock:
+            super(ThreadQueue, self).put(val)
+
+    def put_many(self, vals):
+        with self._lock:
+            super(ThreadQueue, self).put_many(vals)
+
+    def release(self):
+        # held events are shared by all the plugin threads, what's left is counted as dropped by close
+        self.flush()
+
+    def close(self):
+        self._drop_held()
+        for q in self._queues:
+            with q.mutex:
+                q.queue.clear()
+
+
+# Plugin or backend task watched by the TaskSupervisor
+class SupervisedTask(object):
+    def __init__(self, name, role, target, args):
+        self.name = name
+        self.role = role
+        self.target = target
+        self.args = args
+        # runs in the service process, there is no process (pid) of its own
+        self.proc = None
+        self.future = None
+        self.restarts = 0
+        self.last_exit = None
+        self.started = None
+        self.backoff = 0
+
+    def is_alive(self):
+        return self.future is not None and not self.future.done()
+
+    def status(self):
+        return {'name': self.name,
+                'role': self.role,
+                'pid': None,
+                'alive': self.is_alive(),
+                'restarts': self.restarts,
+                'last_exit': self.last_exit}
+
+
+# Runs plugins and backends on a thread pool from asyncio tasks and restarts them with exponential backoff,
+# counterpart of scitags.supervisor.Supervisor for the single process runtime
+class TaskSupervisor(scitags.supervisor.Supervisor):
+    def __init__(self, term_event):
+        super(TaskSupervisor, self).__init__(term_event)
+        self.loop = asyncio.new_event_loop()
+        self.executor = None
+        self.tasks = list()
+
+    def add(self, name, role, target, args, on_restart=None):
+        # on_restart is not needed, restarted task keeps the subscription including the events left pending
+        st = SupervisedTask(name, role, target, args)
+        self.processes.append(st)
+        return st
+
+    def start(self):
+        # tasks start running with the event loop (see run)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.processes), 1))
+        self.tasks = [self.loop.create_task(self.supervise(st)) for st in self.processes]
+        self.write_status()
+
+    async def supervise(self, st):
+        while True:
+            st.started = time.time()
+            st.future = self.executor.submit(st.target, *st.args)
+            try:
+                await asyncio.wrap_future(st.future)
+                last_exit = 'returned'
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                # including sys.exit() called by the module
+                last_exit = '{}: {}'.format(type(e).__name__, e)
+                if isinstance(e, Exception):
+                    log.error('{} {} failed'.format(st.role, st.name), exc_info=e)
+            if self.term_event.is_set():
+                return
+            st.last_exit = last_exit
+            if st.backoff and time.time() - st.started > scitags.settings.SUPERVISOR_STABLE_TIME:
+                st.backoff = 0
+            if st.backoff:
+                st.backoff = min(st.backoff * 2, scitags.settings.SUPERVISOR_BACKOFF_MAX)
+            else:
+                st.backoff = scitags.settings.SUPERVISOR_BACKOFF
+            log.error('{} {} terminated: {}, restarting in {}s'.format(st.role, st.name, st.last_exit, st.backoff))
+            self.write_status()
+            await asyncio.sleep(st.backoff)
+            if self.term_event.is_set():
+                return
+            st.restarts += 1
+            log.warning('{} {} restarted (restarts: {}, last exit: {})'.format(st.role, st.name, st.restarts,
+                                                                              st.last_exit))
+            self.write_status()
+
+    def check(self):
+        # restarts are done by the tasks themselves
+        pass
+
+    async def watch(self, interval, tick):
+        while not self.term_event.is_set():
+            await asyncio.sleep(interval)
+            if self.term_event.is_set():
+                break
+            tick()
+        # run() of the plugins and backends returns once they notice term_event
+        if self.tasks:
+            done, pending = await asyncio.wait(self.tasks, timeout=scitags.settings.SUPERVISOR_INTERVAL)
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(self.tasks)
+
+    def run(self, interval, tick):
+        # runs the event loop until term_event is set, tick is called every interval seconds
+        try:
+            self.loop.run_until_complete(self.watch(interval, tick))
+        finally:
+            self.loop.close()
+
+    def join(self, timeout, role=None):
+        futures = [st.future for st in self.processes if st.future is not None and (role is None or st.role == role)]
+        if futures:
+            concurrent.futures.wait(futures, timeout)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
@@ -10,6 +10,7 @@ except ImportError:
 
 from scitags.config import config
 import scitags.settings
+import scitags.logs
 
 # Needed for eBPF backend
 
@@ -29,7 +30,7 @@ except ImportError as e:
     log.error("Unable to import ebpf/bcc library, please install via python3-bcc package or pip install flowd[ebpf]")
     sys.exit(-1)
 
-ipr = IPRoute()
+ipr = None
 
 text = """
 #include <uapi/linux/ptrace.h>
@@ -154,7 +155,9 @@ class NetFlowId(ctypes.Structure):
 
 
 def ebpf_init():
-    global flowlabel_table, tobedeleted, idxdict
+    global flowlabel_table, tobedeleted, idxdict, ipr
+    # netlink socket is opened by the backend process, not when the module is imported by the service
+    ipr = IPRoute()
     interfacelist = []
     idxdict = {}
     # Load eBPF program
@@ -233,96 +236,110 @@ def bitpattern(exp_id, act_id):
 
 def run(flow_queue, term_event, flow_map, ip_config):
     ebpf_init()
+    # flow label changes are logged up to LOG_EVENTS_RATE per second
+    events_log = scitags.logs.EventLog('ebpf', config.get('LOG_EVENTS_RATE', scitags.settings.LOG_EVENTS_RATE),
+                                       config.get('PLUGIN_STATS_INTERVAL', scitags.settings.PLUGIN_STATS_INTERVAL))
     while not term_event.is_set():
         try:
-            flow_id = flow_queue.get(block=True, timeout=0.5)
+            flow_ids = flow_queue.get_batch(scitags.settings.EVENT_BATCH_SIZE, timeout=0.5)
         except queue.Empty:
             continue
 
-        if flow_id.state == "start":
-            if flow_id.exp in flow_map['experiments'].keys():
-                exp_id = flow_map['experiments'][flow_id.exp]
-            elif type(flow_id.exp) == int:
-                exp_id = flow_id.exp
-            else:
-                err = 'Failed to map experiment ({}) to id'.format(flow_id.exp)
-                log.error(err)
-
-                # Clean up, or backend won't be able to restart
-                for key in idxdict:
-                    ipr.tc("del", "sfq", idxdict[key], "1:")
-                raise scitags.FlowIdException(err)
-
-            if not flow_id.act:
-                act_id = 0
-            elif flow_id.act in flow_map['activities'][exp_id].keys():
-                act_id = flow_map['activities'][exp_id][flow_id.act]
-            elif type(flow_id.act) == int:
-                act_id = flow_id.act
-            else:
-                err = 'Failed to map activity ({}/{}) to id'.format(flow_id.exp, flow_id.act)
-                log.error(err)
-
-                # Clean up, or backend won't be able to restart
-                for key in idxdict:
-                    ipr.tc("del", "sfq", idxdict[key], "1:")
-                raise scitags.FlowIdException(err)
-
-            # New stuff starts here
-            try:
-                # Need to break up the IPv6 address into halves
-                log.debug(flow_id)
-                ip6 = ipaddress.IPv6Address(flow_id.dst).exploded
-                ip6_hi = int(ip6[0:4] + ip6[5:9] + ip6[10:14] + ip6[15:19], 16)
-                ip6_lo = int(ip6[20:24] + ip6[25:29] + ip6[30:34] + ip6[35:39], 16)
-                dport = flow_id.dst_port
-                sport = flow_id.src_port
-
-                key = NetFlowId(ip6_hi, ip6_lo, dport, sport)
-
-                # Get the bitpattern, including entropy bits
-                flowlabel = bitpattern(exp_id, act_id)
-
-                # Fill the BPF hash with each half of the IP pointing to the flow label
-                flowlabel_table[key] = ctypes.c_ulong(flowlabel)
-                log.info(ip6 + " added to flowlabel table")
-                log.debug("Source port is " + str(sport))
-                log.debug("Destination port is " + str(dport))
-                log.debug("Flowlabel is " + str(flowlabel))
-
-            except ipaddress.AddressValueError:
-                err = 'Flow label marking only possible with IPv6'
-                log.error(err)
+        for flow_id in flow_ids:
+            if isinstance(flow_id, scitags.FlowMapUpdate):
+                flow_map = flow_id.flow_map
+                log.info('flow map updated to version {}'.format(flow_id.version))
                 continue
-                # I don't think we want the backend to crash here?
-                #raise scitags.FlowIdException(err)
-
-        elif flow_id.state == "end":
-            try:
-                ip6 = ipaddress.IPv6Address(flow_id.dst).exploded
-                ip6_hi = int(ip6[0:4] + ip6[5:9] + ip6[10:14] + ip6[15:19], 16)
-                ip6_lo = int(ip6[20:24] + ip6[25:29] + ip6[30:34] + ip6[35:39], 16)
-                dport = flow_id.dst_port
-                sport = flow_id.src_port
-
-                key = NetFlowId(ip6_hi, ip6_lo, dport, sport)
-
-                # Remove IP from BPF hash
-                # This needs kernel 5.6 at least; have to do it differently for RHEL 8
-                #flowlabel_table.items_delete_batch(ip6_hi, ip6_lo)
-
-                # Remove IP from hash on C side instead of python side
-                tobedeleted[key] = ctypes.c_ulong(flowlabel)
-                log.info(ip6 + " removed from flowlabel table")
-                log.debug("Source port is " + str(sport))
-                log.debug("Destination port is " + str(dport))
-
-            except ipaddress.AddressValueError:
-                err = 'Flow label marking only possible with IPv6'
-                log.error(err)
-                continue
-                # I don't think we want the backend to crash here?
-                #raise scitags.FlowIdException(err)
+            if flow_id.state == "start":
+                if flow_id.exp in flow_map['experiments'].keys():
+                    exp_id = flow_map['experiments'][flow_id.exp]
+                elif type(flow_id.exp) == int:
+                    exp_id = flow_id.exp
+                else:
+                    err = 'Failed to map experiment ({}) to id'.format(flow_id.exp)
+                    log.error(err)
+                    flow_queue.count(scitags.MAPPING_ERRORS)
+
+                    # Clean up, or backend won't be able to restart
+                    for key in idxdict:
+                        ipr.tc("del", "sfq", idxdict[key], "1:")
+                    raise scitags.FlowIdException(err)
+
+                if not flow_id.act:
+                    act_id = 0
+                elif flow_id.act in flow_map['activities'][exp_id].keys():
+                    act_id = flow_map['activities'][exp_id][flow_id.act]
+                elif type(flow_id.act) == int:
+                    act_id = flow_id.act
+                else:
+                    err = 'Failed to map activity ({}/{}) to id'.format(flow_id.exp, flow_id.act)
+                    log.error(err)
+                    flow_queue.count(scitags.MAPPING_ERRORS)
+
+                    # Clean up, or backend won't be able to restart
+                    for key in idxdict:
+                        ipr.tc("del", "sfq", idxdict[key], "1:")
+                    raise scitags.FlowIdException(err)
+
+                # New stuff starts here
+                try:
+                    # Need to break up the IPv6 address into halves
+                    log.debug(flow_id)
+                    ip6 = ipaddress.IPv6Address(flow_id.dst).exploded
+                    ip6_hi = int(ip6[0:4] + ip6[5:9] + ip6[10:14] + ip6[15:19], 16)
+                    ip6_lo = int(ip6[20:24] + ip6[25:29] + ip6[30:34] + ip6[35:39], 16)
+                    dport = flow_id.dst_port
+                    sport = flow_id.src_port
+
+                    key = NetFlowId(ip6_hi, ip6_lo, dport, sport)
+
+                    # Get the bitpattern, including entropy bits
+                    flowlabel = bitpattern(exp_id, act_id)
+
+                    # Fill the BPF hash with each half of the IP pointing to the flow label
+                    flowlabel_table[key] = ctypes.c_ulong(flowlabel)
+                    if events_log.allow():
+                        log.info('%s added to flowlabel table', ip6)
+                    flow_queue.emitted(flow_id)
+                    log.debug('Source port is %s', sport)
+                    log.debug('Destination port is %s', dport)
+                    log.debug('Flowlabel is %s', flowlabel)
+
+                except ipaddress.AddressValueError:
+                    err = 'Flow label marking only possible with IPv6'
+                    log.error(err)
+                    continue
+                    # I don't think we want the backend to crash here?
+                    #raise scitags.FlowIdException(err)
+
+            elif flow_id.state == "end":
+                try:
+                    ip6 = ipaddress.IPv6Address(flow_id.dst).exploded
+                    ip6_hi = int(ip6[0:4] + ip6[5:9] + ip6[10:14] + ip6[15:19], 16)
+                    ip6_lo = int(ip6[20:24] + ip6[25:29] + ip6[30:34] + ip6[35:39], 16)
+                    dport = flow_id.dst_port
+                    sport = flow_id.src_port
+
+                    key = NetFlowId(ip6_hi, ip6_lo, dport, sport)
+
+                    # Remove IP from BPF hash
+                    # This needs kernel 5.6 at least; have to do it differently for RHEL 8
+                    #flowlabel_table.items_delete_batch(ip6_hi, ip6_lo)
+
+                    # Remove IP from hash on C side instead of python side
+                    tobedeleted[key] = ctypes.c_ulong(flowlabel)
+                    if events_log.allow():
+                        log.info('%s removed from flowlabel table', ip6)
+                    flow_queue.emitted(flow_id)
+                    log.debug('Source port is %s', sport)
+                    log.debug('Destination port is %s', dport)
+
+                except ipaddress.AddressValueError:
+                    err = 'Flow label marking only possible with IPv6'
+                    log.error(err)
+                    continue
+                    # I don't think we want the backend to crash here?
+                    #raise scitags.FlowIdException(err)
 
     # Clean up
     for key in idxdict:
@@ -14,6 +14,11 @@ from scitags.config import config
 
 log = logging.getLogger('scitags')
 
+# with the asyncio runtime (see scitags.aio) a restarted backend runs in the same process, the http server
+# is started only once and the collector of the previous run is replaced
+_server_port = None
+_collector = None
+
 # todo: override prometheus.start_http_server so we have a way how to shut it down
 # def start_wsgi_server(port: int, addr: str = '0.0.0.0', registry: CollectorRegistry = REGISTRY) -> None:
 #     """Starts a WSGI server for prometheus metrics as a daemon thread."""
@@ -29,15 +34,36 @@ log = logging.getLogger('scitags')
 #     t.start()
 
 
+def start_server(port, collector):
+    global _server_port, _collector
+    if _server_port is None:
+        prometheus_client.start_http_server(port)
+        _server_port = port
+    if _collector is not None:
+        prometheus_client.core.REGISTRY.unregister(_collector)
+    prometheus_client.core.REGISTRY.register(collector)
+    _collector = collector
+
+
+# reverse flow_map indexes, ids to experiment/activity names
+def flow_map_index(flow_map):
+    exp_index = {y: x for x, y in flow_map['experiments'].items()}
+    act_index = dict()
+    for k, v in flow_map['activities'].items():
+        act_index[k] = {y: x for x, y in v.items()}
+    return exp_index, act_index
+
+
 class FlowCollector(object):
-    def __init__(self, netlink_cache, flow_cache, exp_index, act_index):
+    def __init__(self, netlink_cache, flow_cache, index):
         self.netlink_cache = netlink_cache
         self.flow_cache = flow_cache
-        self.exp_index = exp_index
-        self.act_index = act_index
+        # (exp_index, act_index), replaced as a whole on flow map updates as collect runs in the http server thread
+        self.index = index
 
     def collect(self):
         labels = ['src', 'dst', 'exp', 'act', 'flow']
+        exp_index, act_index = self.index
         log.debug('prometheus collect')
         log.debug(self.netlink_cache)
         for c, ci in self.netlink_cache.items():
@@ -49,8 +75,8 @@ class FlowCollector(object):
             log.debug(c)
             if (src, src_port, dst, dst_port) in self.flow_cache.keys():
                 e_id, a_id = self.flow_cache[(src, src_port, dst, dst_port)]
-                exp = self.exp_index[e_id]
-                act = self.act_index[e_id][a_id]
+                exp = exp_index[e_id]
+                act = act_index[e_id][a_id]
             else:
                 exp = 'default'
                 act = 'default'
@@ -88,45 +114,47 @@ def run(flow_queue, term_event, flow_map, ip_config):
     if not os.path.isfile(scitags.settings.SS_PATH):
         if 'PROMETHEUS_SS_PATH' in config.keys() and not os.path.isfile(config['PROMETHEUS_SS_PATH']):
             raise FlowConfigException('Unable to find ss, please check config')
-    prometheus_client.start_http_server(port)
     netlink_cache = dict()
     flow_cache = dict()
-    # flow_map indexes
-    exp_index = {y: x for x, y in flow_map['experiments'].items()}
-    act_index = dict()
-    for k, v in flow_map['activities'].items():
-        act_index[k] = {y: x for x, y in v.items()}
     # create another dict that holds flow to exp+act mapping 
-    netlink_plugin = 'netlink' in config['PLUGIN']
+    # netlink plugin delivers netlink data with the events, otherwise it's fetched via ss
+    netlink_plugin = [x.strip() for x in config['PLUGIN'].split(',')] == ['netlink']
     init_done = False
-    prometheus_client.core.REGISTRY.register(FlowCollector(netlink_cache, flow_cache, exp_index, act_index))
+    collector = FlowCollector(netlink_cache, flow_cache, flow_map_index(flow_map))
+    start_server(port, collector)
     log.debug('prometheus client started on 0.0.0.0:{}'.format(port))
     log.debug('entering event loop')
     while not term_event.is_set():
         try:
-            flow_id = flow_queue.get(block=True, timeout=5)
+            flow_ids = flow_queue.get_batch(scitags.settings.EVENT_BATCH_SIZE, timeout=5)
         except queue.Empty:
             if not netlink_plugin and init_done:
                 scitags.netlink.cache_ss.netlink_cache_update(netlink_cache)
             continue
-        log.debug(flow_id)
-
-        if 'start' in flow_id.state and flow_id.netlink:
-            init_done = True
-            netlink_cache[(flow_id.src, flow_id.src_port,
-                           flow_id.dst, flow_id.dst_port)] = (flow_id.state, flow_id.netlink)
-        elif 'end' in flow_id.state and flow_id.netlink:
-            del netlink_cache[(flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)]
-        elif 'start' in flow_id.state and not flow_id.netlink:
-            init_done = True
-            scitags.netlink.cache_ss.netlink_cache_add(flow_id.state, flow_id.src, flow_id.src_port, flow_id.dst,
-                                                    flow_id.dst_port, netlink_cache)
-            flow_cache[(flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)] = (flow_id.exp, flow_id.act)
-        elif 'end' in flow_id.state and not flow_id.netlink:
-            scitags.netlink.cache_ss.netlink_cache_del(flow_id.src, flow_id.src_port, flow_id.dst,
-                                                    flow_id.dst_port, netlink_cache)
-            if (flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port) in flow_cache.keys():
-                del flow_cache[(flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)]
+        for flow_id in flow_ids:
+            log.debug(flow_id)
+            if isinstance(flow_id, scitags.FlowMapUpdate):
+                collector.index = flow_map_index(flow_id.flow_map)
+                log.info('flow map updated to version {}'.format(flow_id.version))
+                continue
+
+            if 'start' in flow_id.state and flow_id.netlink:
+                init_done = True
+                netlink_cache[(flow_id.src, flow_id.src_port,
+                               flow_id.dst, flow_id.dst_port)] = (flow_id.state, flow_id.netlink)
+            elif 'end' in flow_id.state and flow_id.netlink:
+                netlink_cache.pop((flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port), None)
+            elif 'start' in flow_id.state and not flow_id.netlink:
+                init_done = True
+                scitags.netlink.cache_ss.netlink_cache_add(flow_id.state, flow_id.src, flow_id.src_port, flow_id.dst,
+                                                        flow_id.dst_port, netlink_cache)
+                flow_cache[(flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)] = (flow_id.exp, flow_id.act)
+            elif 'end' in flow_id.state and not flow_id.netlink:
+                scitags.netlink.cache_ss.netlink_cache_del(flow_id.src, flow_id.src_port, flow_id.dst,
+                                                        flow_id.dst_port, netlink_cache)
+                if (flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port) in flow_cache.keys():
+                    del flow_cache[(flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)]
+            flow_queue.emitted(flow_id)
 
 
 
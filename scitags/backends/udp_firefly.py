@@ -1,23 +1,23 @@
 import logging
+import time
 from datetime import datetime
 
 try:
     import queue
 except ImportError:
     import Queue as queue
+import importlib
 import socket
 import json
 
 from scitags.config import config
+import scitags.config
 import scitags.settings
-try:
-    import scitags.netlink.cache
-except ImportError:
-    pass
+import scitags.logs
+import scitags.udp
+import scitags.timers
 
 log = logging.getLogger('scitags')
-sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-sock4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 SYSLOG_FACILITY_LOCAL0 = 16
 SYSLOG_SEVERITY_INFORMATIONAL = 6
@@ -32,133 +32,283 @@ SYSLOG_STRUCT_DATA = "-"
 NETLINK_ENABLED = False
 
 
-def firefly_json(flow_id, flow_map, ipconfig, netlink_cache):
-    if isinstance(flow_id.exp, int):
-        exp_id = flow_id.exp
-    elif flow_id.exp in flow_map['experiments'].keys():
-        exp_id = flow_map['experiments'][flow_id.exp]
-    else:
-        err = 'Failed to map experiment ({}) to id'.format(flow_id.exp)
-        log.error(err)
-        raise scitags.FlowIdException(err)
-
-    if not flow_id.act:
-        act_id = 0
-    elif isinstance(flow_id.act, int):
-        act_id = flow_id.act
-    elif flow_id.act in flow_map['activities'][exp_id].keys():
-        act_id = flow_map['activities'][exp_id][flow_id.act]
-    else:
-        err = 'Failed to map activity ({}/{}) to id'.format(flow_id.exp, flow_id.act)
-        log.error(err)
-        raise scitags.FlowIdException(err)
-
-    if ":" in flow_id.dst:
-        afi = 'ipv6'
-    else:
-        afi = 'ipv4'
-
-    firefly = {
-        "version": 1,
-        "flow-lifecycle": {
-            "state": flow_id.state,
-            "current-time": datetime.utcnow().isoformat()+'+00:00',
-        },
-        "flow-id": {
-            "afi": afi,
-            "src-ip": flow_id.src,
-            "dst-ip": flow_id.dst,
-            "protocol": flow_id.prot,
-            "src-port": flow_id.src_port,
-            "dst-port": flow_id.dst_port,
-        },
-        "context": {
-            "experiment-id": exp_id,
-            "activity-id": act_id,
-            "application": "flowd v{}".format(scitags.VERSION),
-        },
-    }
-    if flow_id.state == 'start':
-        firefly['flow-lifecycle']["start-time"] = flow_id.start_time
-    if flow_id.state == 'end':
-        firefly['flow-lifecycle']["start-time"] = flow_id.start_time
-        firefly['flow-lifecycle']["end-time"] = flow_id.end_time
-
-    if flow_id.netlink:
-        firefly['netlink'] = flow_id.netlink
-    elif NETLINK_ENABLED and 'tcp' in flow_id.prot and 'start' in flow_id.state:
-        scitags.netlink.cache.netlink_cache_add(flow_id.state, flow_id.src, flow_id.src_port,
-                                                flow_id.dst, flow_id.dst_port, netlink_cache)
-        netlink = netlink_cache[('tcp', flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)]
-        firefly['netlink'] = netlink
-    elif NETLINK_ENABLED and 'tcp' in flow_id.prot and 'end' in flow_id.state:
-        netlink = netlink_cache[('tcp', flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)]
-        # get last known netlink state
-        firefly['netlink'] = netlink
-        scitags.netlink.cache.netlink_cache_del(flow_id.src, flow_id.src_port,
-                                                flow_id.dst, flow_id.dst_port, netlink_cache)
-
-    if ipconfig and afi == 'ipv6' and ipconfig.pub_ip6:
-        if firefly['flow-id']['src-ip'] == ipconfig.int_ip6:
-            firefly['flow-id']['src-ip'] = ipconfig.pub_ip6
-        if firefly['flow-id']['dst-ip'] == ipconfig.int_ip6:
-            firefly['flow-id']['dst-ip'] = ipconfig.pub_ip6
-    if ipconfig and afi == 'ipv4' and ipconfig.pub_ip4:
-        if firefly['flow-id']['src-ip'] == ipconfig.int_ip4:
-            firefly['flow-id']['src-ip'] = ipconfig.pub_ip4
-        if firefly['flow-id']['dst-ip'] == ipconfig.int_ip4:
-            firefly['flow-id']['dst-ip'] = ipconfig.pub_ip4
-
-    if afi == 'ipv4' and 'UDP_FIREFLY_IP4_SRC' in config.keys():
-        firefly['flow-id']['src-ip'] = config['UDP_FIREFLY_IP4_SRC']
-    if afi == 'ipv6' and 'UDP_FIREFLY_IP6_SRC' in config.keys():
-        firefly['flow-id']['src-ip'] = config['UDP_FIREFLY_IP6_SRC']
-    if 'UDP_FIREFLY_WITH_NETLINK' in config.keys() and config['UDP_FIREFLY_WITH_NETLINK']:
-        firefly['netlink'] = flow_id.netlink
-
-    return firefly
+_json_str = json.encoder.encode_basestring_ascii
+
+
+def _json(val):
+    # json.dumps for the values of a firefly, shortcuts for str and int
+    if type(val) is str:
+        return _json_str(val)
+    if type(val) is int:
+        return str(val)
+    return json.dumps(val)
+
+
+FIREFLY_TEMPLATE = ('{{"version": 1, "flow-lifecycle": {{"state": {state}, "current-time": "{now}"{times}}}, '
+                    '"flow-id": {{"afi": "{afi}", "src-ip": {src}, "dst-ip": {dst}, "protocol": {prot}, '
+                    '"src-port": {src_port}, "dst-port": {dst_port}}}, "context": {{"experiment-id": {exp}, '
+                    '"activity-id": {act}, "application": {application}}}{netlink}}}')
+
+
+# Firefly payloads (syslog header followed by the firefly JSON), the parts that depend on config and ip_config
+# (source IP overrides, public IP rewrites, application) are resolved once, experiment/activity ids are cached
+# per flow map and fireflies are filled into a JSON template with the current time taken once per second.
+# Has to be rebuilt on config reload (see config_version) and flow map update.
+class FireflySerializer(object):
+    def __init__(self, flow_map, ipconfig):
+        self.flow_map = flow_map
+        self.config_version = scitags.config.version
+        self._ids = dict()
+        self._src = dict()
+        for afi, key in (('ipv4', 'UDP_FIREFLY_IP4_SRC'), ('ipv6', 'UDP_FIREFLY_IP6_SRC')):
+            if key in config.keys():
+                self._src[afi] = json.dumps(config[key])
+        self._rewrite = {'ipv4': dict(), 'ipv6': dict()}
+        if ipconfig and ipconfig.pub_ip4:
+            self._rewrite['ipv4'][ipconfig.int_ip4] = ipconfig.pub_ip4
+        if ipconfig and ipconfig.pub_ip6:
+            self._rewrite['ipv6'][ipconfig.int_ip6] = ipconfig.pub_ip6
+        self._with_netlink = 'UDP_FIREFLY_WITH_NETLINK' in config.keys() and config['UDP_FIREFLY_WITH_NETLINK']
+        self._application = json.dumps("flowd v{}".format(scitags.VERSION))
+        self._header = ('<{}>{} '.format(SYSLOG_PRIORITY, SYSLOG_VERSION),
+                        ' {} {} {} {} {} '.format(SYSLOG_HOSTNAME, SYSLOG_APP_NAME, SYSLOG_PROCID, SYSLOG_MSGID,
+                                                  SYSLOG_STRUCT_DATA))
+        self._second = None
+        self._now = None
+
+    def now(self):
+        now = time.time()
+        if int(now) != self._second:
+            self._second = int(now)
+            self._now = datetime.utcfromtimestamp(now).isoformat() + '+00:00'
+        return self._now
+
+    def ids(self, flow_id):
+        # (experiment id, activity id) JSON encoded, mapping errors are not cached
+        key = (flow_id.exp, flow_id.act)
+        ids = self._ids.get(key)
+        if ids:
+            return ids
+        flow_map = self.flow_map
+        if isinstance(flow_id.exp, int):
+            exp_id = flow_id.exp
+        elif flow_id.exp in flow_map['experiments'].keys():
+            exp_id = flow_map['experiments'][flow_id.exp]
+        else:
+            err = 'Failed to map experiment ({}) to id'.format(flow_id.exp)
+            log.error(err)
+            raise scitags.FlowIdException(err)
+
+        if not flow_id.act:
+            act_id = 0
+        elif isinstance(flow_id.act, int):
+            act_id = flow_id.act
+        elif flow_id.act in flow_map['activities'][exp_id].keys():
+            act_id = flow_map['activities'][exp_id][flow_id.act]
+        else:
+            err = 'Failed to map activity ({}/{}) to id'.format(flow_id.exp, flow_id.act)
+            log.error(err)
+            raise scitags.FlowIdException(err)
+        if len(self._ids) > 10000:
+            self._ids.clear()
+        ids = self._ids[key] = (_json(exp_id), _json(act_id))
+        return ids
+
+    def netlink(self, flow_id, netlink_cache):
+        # returns (netlink, True) if the firefly has netlink info
+        found = None
+        if flow_id.netlink:
+            found = (flow_id.netlink, True)
+        elif NETLINK_ENABLED and 'tcp' in flow_id.prot and 'start' in flow_id.state:
+            scitags.netlink.cache.netlink_cache_add(flow_id.state, flow_id.src, flow_id.src_port,
+                                                    flow_id.dst, flow_id.dst_port, netlink_cache)
+            found = (netlink_cache[('tcp', flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)], True)
+        elif NETLINK_ENABLED and 'tcp' in flow_id.prot and 'end' in flow_id.state:
+            netlink = netlink_cache.get(('tcp', flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port))
+            if netlink:
+                found = (netlink, True)
+            scitags.netlink.cache.netlink_cache_del(flow_id.src, flow_id.src_port,
+                                                    flow_id.dst, flow_id.dst_port, netlink_cache)
+        elif NETLINK_ENABLED and 'tcp' in flow_id.prot and flow_id.state == 'ongoing':
+            netlink = netlink_cache.get(('tcp', flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port))
+            if netlink:
+                found = (netlink, True)
+        if self._with_netlink:
+            found = (flow_id.netlink, True)
+        return found if found else (None, False)
+
+    def serialize(self, flow_id, netlink_cache):
+        exp_id, act_id = self.ids(flow_id)
+        afi = 'ipv6' if ':' in flow_id.dst else 'ipv4'
+        rewrite = self._rewrite[afi]
+        src = self._src.get(afi) or _json(rewrite.get(flow_id.src, flow_id.src))
+        netlink, has_netlink = self.netlink(flow_id, netlink_cache)
+        if flow_id.state in ('start', 'ongoing'):
+            times = ', "start-time": {}'.format(_json(flow_id.start_time))
+        elif flow_id.state == 'end':
+            times = ', "start-time": {}, "end-time": {}'.format(_json(flow_id.start_time),
+                                                                _json(flow_id.end_time))
+        else:
+            times = ''
+        now = self.now()
+        netlink = ', "netlink": {}'.format(json.dumps(netlink)) if has_netlink else ''
+        return self._header[0] + now + self._header[1] + FIREFLY_TEMPLATE.format(
+            state=_json(flow_id.state), now=now, times=times, afi=afi, src=src,
+            dst=_json(rewrite.get(flow_id.dst, flow_id.dst)), prot=_json(flow_id.prot),
+            src_port=_json(flow_id.src_port), dst_port=_json(flow_id.dst_port), exp=exp_id, act=act_id,
+            application=self._application, netlink=netlink)
+
+
+def update_interval():
+    # seconds between the ongoing fireflies of a flow, 0 disables them
+    return config.get('UDP_FIREFLY_UPDATE_INTERVAL', scitags.settings.UDP_FIREFLY_UPDATE_INTERVAL)
+
+
+def update_max_age():
+    # seconds after the start of a flow when its ongoing fireflies stop (in case its end was lost), 0 - no limit
+    return config.get('UDP_FIREFLY_UPDATE_MAX_AGE', scitags.settings.UDP_FIREFLY_UPDATE_MAX_AGE)
+
+
+def pool_size():
+    # number of worker processes, flows are sharded between them by their 5-tuple
+    return config.get('UDP_FIREFLY_WORKERS', scitags.settings.UDP_FIREFLY_WORKERS)
 
 
 def run(flow_queue, term_event, flow_map, ip_config):
     global NETLINK_ENABLED
+    # with UDP_FIREFLY_WORKERS each worker only sees its own shard of the flows,
+    # so it keeps its own netlink cache for them
     netlink_cache = dict()
     init_done = False
+    # fireflies sent are logged up to LOG_EVENTS_RATE per second
+    events_log = scitags.logs.EventLog('udp_firefly', config.get('LOG_EVENTS_RATE', scitags.settings.LOG_EVENTS_RATE),
+                                       config.get('PLUGIN_STATS_INTERVAL', scitags.settings.PLUGIN_STATS_INTERVAL))
     if 'UDP_FIREFLY_NETLINK' in config.keys() and config['UDP_FIREFLY_NETLINK']:
-        # note: if udp_firefly runs as pool in the future, netlink will need new implementation
+        # pyroute2 is only loaded when needed (availability is checked by the service on startup)
+        importlib.import_module('scitags.netlink.cache')
         NETLINK_ENABLED = True
+    serializer = FireflySerializer(flow_map, ip_config)
+
+    def send_error(addr, e):
+        flow_queue.count(scitags.SEND_ERRORS)
+        log.error('Failed to send firefly to {}: {}'.format(addr[0], e))
+
+    # fireflies are sent after each batch, datagrams the kernel doesn't take right away are retried shortly
+    sender = scitags.udp.UDPSender(flow_queue.destinations,
+                                   config.get('UDP_FIREFLY_SEND_QUEUE', scitags.settings.UDP_FIREFLY_SEND_QUEUE),
+                                   config.get('UDP_FIREFLY_SNDBUF', scitags.settings.UDP_FIREFLY_SNDBUF),
+                                   on_error=send_error,
+                                   resolver=scitags.udp.Resolver(
+                                       config.get('UDP_FIREFLY_DNS_TTL', scitags.settings.UDP_FIREFLY_DNS_TTL),
+                                       config.get('UDP_FIREFLY_DNS_NEGATIVE_TTL',
+                                                  scitags.settings.UDP_FIREFLY_DNS_NEGATIVE_TTL)))
+    collectors = config.get('UDP_FIREFLY_DST')
+    if collectors:
+        sender.set_collectors(scitags.udp.parse_collectors(collectors, scitags.settings.UDP_FIREFLY_PORT))
+
+    # ongoing fireflies of the flows in progress are due on the timer wheel (keyed by the 5-tuple, the value
+    # is the start event and when it was seen), each tick only looks at the flows due in it and refreshes their
+    # netlink state by exact lookups; updates of a flow stop with its end, when its connection is gone
+    # (UDP_FIREFLY_NETLINK) or after UDP_FIREFLY_UPDATE_MAX_AGE
+    interval = update_interval()
+    updates = scitags.timers.TimerWheel()
+
+    def refresh_netlink():
+        # full refresh, only when there are no events to process
+        for key in scitags.netlink.cache.netlink_cache_update(netlink_cache):
+            updates.cancel(key)
+
+    def send_updates():
+        due = updates.advance()
+        if not due:
+            return
+        now = time.monotonic()
+        max_age = update_max_age()
+        for key, (start, seen) in due:
+            if max_age and now - seen >= max_age:
+                log.debug('no more ongoing fireflies for {}, flow older than {}s'.format(key, max_age))
+                continue
+            if NETLINK_ENABLED and key in netlink_cache:
+                _, src, src_port, dst, dst_port = key
+                if scitags.netlink.cache.netlink_cache_refresh(src, src_port, dst, dst_port, netlink_cache) is False:
+                    log.debug('no more ongoing fireflies for {}, connection is gone'.format(key))
+                    continue
+            try:
+                udp_payload = serializer.serialize(start._replace(state='ongoing', netlink=None, stamps=None),
+                                                   netlink_cache)
+            except scitags.FlowIdException as e:
+                # experiment/activity gone from the flow map, no more updates for the flow
+                flow_queue.count(scitags.MAPPING_ERRORS)
+                log.exception(e)
+                continue
+            except Exception as e:
+                log.exception(e)
+                udp_payload = None
+            updates.schedule(key, interval, (start, seen))
+            if not udp_payload:
+                continue
+            if events_log.allow():
+                log.info(udp_payload)
+            data = udp_payload.encode('utf-8')
+            sender.send(data, start.dst, scitags.settings.UDP_FIREFLY_PORT, 'flow')
+            sender.send_collectors(data)
+            flow_queue.count(scitags.FLOW_UPDATES)
+
     while not term_event.is_set():
         try:
-            flow_id = flow_queue.get(block=True, timeout=0.5)
+            flow_ids = flow_queue.get_batch(scitags.settings.EVENT_BATCH_SIZE,
+                                            timeout=0.01 if sender.pending() else 0.5)
         except queue.Empty:
+            if updates:
+                send_updates()
+            sender.flush()
             if NETLINK_ENABLED and init_done:
-                scitags.netlink.cache.netlink_cache_update(netlink_cache)
+                refresh_netlink()
             continue
+        if serializer.config_version != scitags.config.version:
+            serializer = FireflySerializer(serializer.flow_map, ip_config)
+            if update_interval() != interval:
+                interval = update_interval()
+                if not interval:
+                    updates.clear()
+            if config.get('UDP_FIREFLY_DST') != collectors:
+                collectors = config.get('UDP_FIREFLY_DST')
+                sender.set_collectors(scitags.udp.parse_collectors(collectors, scitags.settings.UDP_FIREFLY_PORT)
+                                      if collectors else ())
 
-        log.debug(flow_id)
+        for flow_id in flow_ids:
+            log.debug(flow_id)
+            if isinstance(flow_id, scitags.FlowMapUpdate):
+                serializer = FireflySerializer(flow_id.flow_map, ip_config)
+                log.info('flow map updated to version {}'.format(flow_id.version))
+                continue
 
-        if 'start' in flow_id.state:
-            # first queue event arrived
-            init_done = True
-        try:
-            global sock4, sock6
-            if not sock4:
-                sock4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            if not sock6:
-                sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-            dst = flow_id.dst
-            syslog_header = '<{}>{} {} {} {} {} {} {} '.format(SYSLOG_PRIORITY, SYSLOG_VERSION,
-                                                               datetime.utcnow().isoformat() + '+00:00',
-                                                               SYSLOG_HOSTNAME,
-                                                               SYSLOG_APP_NAME, SYSLOG_PROCID, SYSLOG_MSGID,
-                                                               SYSLOG_STRUCT_DATA)
-            udp_payload = syslog_header + json.dumps(firefly_json(flow_id, flow_map, ip_config, netlink_cache))
-            log.info(udp_payload)
-            if ':' in flow_id.dst:
-                sock6.sendto(udp_payload.encode('utf-8'), (dst, scitags.settings.UDP_FIREFLY_PORT))
-            else:
-                sock4.sendto(udp_payload.encode('utf-8'), (dst, scitags.settings.UDP_FIREFLY_PORT))
-            if 'UDP_FIREFLY_DST' in config.keys():
-                dst = config['UDP_FIREFLY_DST']
-                sock4.sendto(udp_payload.encode('utf-8'), (dst, scitags.settings.UDP_FIREFLY_PORT))
-        except Exception as e:
-            log.exception(e)
+            if 'start' in flow_id.state:
+                # first queue event arrived
+                init_done = True
+            try:
+                udp_payload = serializer.serialize(flow_id, netlink_cache)
+                if events_log.allow():
+                    log.info(udp_payload)
+            except scitags.FlowIdException as e:
+                flow_queue.count(scitags.MAPPING_ERRORS)
+                log.exception(e)
+                continue
+            except Exception as e:
+                log.exception(e)
+                continue
+            data = udp_payload.encode('utf-8')
+            sender.send(data, flow_id.dst, scitags.settings.UDP_FIREFLY_PORT, 'flow')
+            sender.send_collectors(data)
+            flow_queue.emitted(flow_id)
+            if interval and flow_id.state in ('start', 'end'):
+                key = (flow_id.prot, flow_id.src, flow_id.src_port, flow_id.dst, flow_id.dst_port)
+                if flow_id.state == 'start':
+                    updates.schedule(key, interval, (flow_id, time.monotonic()))
+                else:
+                    updates.cancel(key)
+        if updates:
+            send_updates()
+        sender.flush()
+    sender.flush()
+    sender.close()
@@ -0,0 +1,274 @@
+import datetime
+import pickle
+import socket
+import struct
+
+import scitags
+
+# Compact binary encoding of scitags.FlowID for the event bus
+#
+# Fixed layout header (64 bytes, network byte order):
+#   version, flags, state, protocol (uint8)
+#   src, dst (16 bytes, IPv4 stored in the last 4 bytes)
+#   src_port, dst_port (uint16)
+#   exp, act (int32)
+#   start_time, end_time (int64, ns since epoch, -1 if not set)
+# followed by optional stamps (FlowID.stamps, 2 doubles) and sections (uint32 length + pickled payload):
+#   extra - fields that can't be represented in the header (e.g. experiment names)
+#   netlink - FlowID.netlink
+# Batches are a sequence of uint32 length prefixed events.
+VERSION = 1
+
+F_SRC_IP4 = 0x01
+F_DST_IP4 = 0x02
+F_EXTRA = 0x04
+F_NETLINK = 0x08
+F_STAMPS = 0x10
+
+STATES = (None, 'start', 'end', 'ongoing')
+STATE_IDS = {s: i for i, s in enumerate(STATES) if s}
+PROTOCOLS = {6: 'tcp', 17: 'udp'}
+PROTOCOL_IDS = {p: i for i, p in PROTOCOLS.items()}
+
+_EVENT = struct.Struct('!BBBB16s16sHHiiqq')
+_LEN = struct.Struct('!I')
+_STAMPS = struct.Struct('!dd')
+_IP4_PREFIX = b'\x00' * 12
+_NO_IP = _IP4_PREFIX + b'\x00' * 4
+_EPOCH = datetime.datetime(1970, 1, 1)
+_INT32 = (-2 ** 31, 2 ** 31 - 1)
+
+# addresses and the seconds part of the timestamps repeat across events, their conversions are cached
+# (in each direction, cleared when they reach _CACHE_SIZE entries)
+_CACHE_SIZE = 10000
+_packed_ips = dict()
+_unpacked_ips = dict()
+_seconds = dict()
+_iso_seconds = dict()
+
+
+def _cache(cache, key, value):
+    if len(cache) >= _CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+def _ns_to_iso(ns):
+    if ns < 0:
+        return None
+    seconds, us = divmod(ns // 1000, 1000000)
+    iso = _iso_seconds.get(seconds)
+    if iso is None:
+        iso = _cache(_iso_seconds, seconds, (_EPOCH + datetime.timedelta(seconds=seconds)).isoformat())
+    if us:
+        return '{}.{:06d}+00:00'.format(iso, us)
+    return iso + '+00:00'
+
+
+def _parse_seconds(ts):
+    # seconds since epoch of YYYY-MM-DDTHH:MM:SS, None if it's not a valid timestamp
+    if ts[4] != '-' or ts[7] != '-' or ts[10] != 'T' or ts[13] != ':' or ts[16] != ':':
+        return None
+    try:
+        delta = datetime.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]),
+                                  int(ts[17:19])) - _EPOCH
+    except ValueError:
+        return None
+    if delta.days < 0:
+        return None
+    return delta.days * 86400 + delta.seconds
+
+
+def _iso_to_ns(ts):
+    # only timestamps as produced by the plugins (utcnow().isoformat()+'+00:00') are packed,
+    # anything else goes to the extra section so that decode returns exactly what was sent
+    if ts is None:
+        return -1
+    if type(ts) is not str or not ts.endswith('+00:00'):
+        return None
+    if len(ts) == 32:
+        us = ts[20:26]
+        if ts[19] != '.' or us == '000000' or not us.isdigit():
+            return None
+        us = int(us)
+    elif len(ts) == 25:
+        us = 0
+    else:
+        return None
+    key = ts[:19]
+    seconds = _seconds.get(key)
+    if seconds is None:
+        seconds = _parse_seconds(key)
+        if seconds is None:
+            return None
+        _cache(_seconds, key, seconds)
+    return (seconds * 1000000 + us) * 1000
+
+
+def _convert_ip(ip):
+    try:
+        if ':' in ip:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+            if socket.inet_ntop(socket.AF_INET6, packed) != ip:
+                return None
+            return packed, False
+        packed = socket.inet_pton(socket.AF_INET, ip)
+        if socket.inet_ntop(socket.AF_INET, packed) != ip:
+            return None
+        return _IP4_PREFIX + packed, True
+    except (socket.error, TypeError, ValueError):
+        return None
+
+
+def _pack_ip(ip):
+    # returns (packed, is_ip4), None if ip doesn't survive a round-trip
+    if type(ip) is not str:
+        return None
+    try:
+        return _packed_ips[ip]
+    except KeyError:
+        return _cache(_packed_ips, ip, _convert_ip(ip))
+
+
+def _unpack_ip(packed, is_ip4):
+    key = (packed, is_ip4)
+    ip = _unpacked_ips.get(key)
+    if ip is None:
+        if is_ip4:
+            ip = socket.inet_ntop(socket.AF_INET, packed[12:])
+        else:
+            ip = socket.inet_ntop(socket.AF_INET6, packed)
+        _cache(_unpacked_ips, key, ip)
+    return ip
+
+
+def _is_int(v, low, high):
+    return type(v) is int and low <= v <= high
+
+
+def _section(obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return _LEN.pack(len(data)) + data
+
+
+def encode(flow_id):
+    state, prot, src, src_port, dst, dst_port, exp, act, start_time, end_time, netlink, stamps = flow_id
+    flags = 0
+    extra = dict()
+
+    state_id = STATE_IDS.get(state, 0)
+    if not state_id:
+        extra['state'] = state
+    prot_id = PROTOCOL_IDS.get(prot, 0)
+    if not prot_id:
+        extra['prot'] = prot
+
+    packed = _pack_ip(src)
+    if packed is None:
+        extra['src'] = src
+        src = _NO_IP
+    else:
+        src = packed[0]
+        if packed[1]:
+            flags |= F_SRC_IP4
+    packed = _pack_ip(dst)
+    if packed is None:
+        extra['dst'] = dst
+        dst = _NO_IP
+    else:
+        dst = packed[0]
+        if packed[1]:
+            flags |= F_DST_IP4
+
+    if not _is_int(src_port, 0, 65535):
+        extra['src_port'] = src_port
+        src_port = 0
+    if not _is_int(dst_port, 0, 65535):
+        extra['dst_port'] = dst_port
+        dst_port = 0
+    if not _is_int(exp, _INT32[0], _INT32[1]):
+        extra['exp'] = exp
+        exp = 0
+    if not _is_int(act, _INT32[0], _INT32[1]):
+        extra['act'] = act
+        act = 0
+
+    start_ns = _iso_to_ns(start_time)
+    if start_ns is None:
+        extra['start_time'] = start_time
+        start_ns = -1
+    end_ns = _iso_to_ns(end_time)
+    if end_ns is None:
+        extra['end_time'] = end_time
+        end_ns = -1
+
+    if stamps is not None and (type(stamps) is not tuple or len(stamps) != 2):
+        extra['stamps'] = stamps
+        stamps = None
+    if stamps is not None:
+        flags |= F_STAMPS
+    if extra:
+        flags |= F_EXTRA
+    if netlink is not None:
+        flags |= F_NETLINK
+
+    buf = _EVENT.pack(VERSION, flags, state_id, prot_id, src, dst, src_port, dst_port, exp, act, start_ns, end_ns)
+    if stamps is not None:
+        buf += _STAMPS.pack(*stamps)
+    if not extra and netlink is None:
+        return buf
+    parts = [buf]
+    if extra:
+        parts.append(_section(extra))
+    if netlink is not None:
+        parts.append(_section(netlink))
+    return b''.join(parts)
+
+
+def decode(buf):
+    (version, flags, state, prot, src, dst, src_port, dst_port, exp, act,
+     start_ns, end_ns) = _EVENT.unpack_from(buf, 0)
+    if version != VERSION:
+        raise scitags.FlowIdException('Unsupported event encoding version {}'.format(version))
+    off = _EVENT.size
+    stamps = None
+    if flags & F_STAMPS:
+        stamps = _STAMPS.unpack_from(buf, off)
+        off += _STAMPS.size
+    extra = None
+    if flags & F_EXTRA:
+        n, = _LEN.unpack_from(buf, off)
+        extra = pickle.loads(buf[off + _LEN.size:off + _LEN.size + n])
+        off += _LEN.size + n
+    netlink = None
+    if flags & F_NETLINK:
+        n, = _LEN.unpack_from(buf, off)
+        netlink = pickle.loads(buf[off + _LEN.size:off + _LEN.size + n])
+    flow_id = scitags.FlowID(STATES[state] if state < len(STATES) else None, PROTOCOLS.get(prot),
+                             _unpack_ip(src, flags & F_SRC_IP4), src_port, _unpack_ip(dst, flags & F_DST_IP4),
+                             dst_port, exp, act, _ns_to_iso(start_ns), _ns_to_iso(end_ns), netlink, stamps)
+    if extra:
+        return flow_id._replace(**extra)
+    return flow_id
+
+
+def encode_batch(flow_ids):
+    parts = list()
+    for flow_id in flow_ids:
+        event = encode(flow_id)
+        parts.append(_LEN.pack(len(event)))
+        parts.append(event)
+    return b''.join(parts)
+
+
+def split_batch(buf):
+    # returns events as memoryviews into buf, they're decoded only when handed out to the backend
+    mv = memoryview(buf)
+    events = list()
+    off = 0
+    while off < len(mv):
+        n, = _LEN.unpack_from(mv, off)
+        events.append(mv[off + _LEN.size:off + _LEN.size + n])
+        off += _LEN.size + n
+    return events
@@ -9,17 +9,54 @@ __all__ = ['config']
 log = logging.getLogger('scitags')
 _bcf = settings.CONFIG_PATH
 
+# keys that are only used when the processes are created, changing them requires a restart
+STATIC_KEYS = ('PLUGIN', 'BACKEND', 'EVENT_BUS', 'EVENT_BUS_SIZE', 'EVENT_BUS_CODEC', 'EVENT_BUS_CAPACITY',
+               'EVENT_BUS_POLICY', 'IP_DISCOVERY_ENABLED', 'LATENCY_STATS', 'UDP_FIREFLY_WORKERS',
+               'PROMETHEUS_SRV_PORT', 'FIREFLY_LISTENER_HOST', 'FIREFLY_LISTENER_PORT', 'NETWORK_INTERFACE',
+               'METRICS_SOCKET', 'METRICS_PORT', 'METRICS_HOST', 'FLOW_COALESCE_WINDOW', 'FLOW_MIN_LIFETIME',
+               'RUNTIME', 'LOG_QUEUE', 'UDP_FIREFLY_SNDBUF', 'UDP_FIREFLY_SEND_QUEUE',
+               'UDP_FIREFLY_DNS_TTL', 'UDP_FIREFLY_DNS_NEGATIVE_TTL', 'EVENT_BUS_BLOCK_TIMEOUT',
+               'LOG_EVENTS_RATE', 'UDP_FIREFLY_NETLINK')
+
+# number of config updates applied in this process, lets plugins/backends rebuild state derived from config
+version = 0
+
+
+def load(path):
+    cfg = {}
+    if sys.version_info[0] == 2:
+        execfile(path, {}, cfg)
+    else:
+        with open(path) as f:
+            code = compile(f.read(), os.path.basename(path), 'exec')
+            exec(code, {}, cfg)
+    return cfg
+
+
+def delta(old, new):
+    # returns (changed, removed) - dict of new/changed keys and list of removed keys
+    changed = dict((k, v) for k, v in new.items() if k not in old or old[k] != v)
+    removed = [k for k in old.keys() if k not in new]
+    return changed, removed
+
+
+def apply_update(update, cfg=None):
+    # applies scitags.ConfigUpdate in place, modules keep referencing the same config dict
+    global version
+    if cfg is None:
+        cfg = config
+    cfg.update(update.changed)
+    for k in update.removed:
+        cfg.pop(k, None)
+    version += 1
+    log.info('configuration updated to version {}'.format(update.version))
+    log.debug('config: {}'.format(cfg))
+
+
 if not os.path.exists(_bcf):
     log.error("Config error {}".format(settings.CONFIG_PATH))
     sys.exit(1)
 
-config = {}
-if sys.version_info[0] == 2:
-    execfile(_bcf, {}, config)
-else:
-    with open(_bcf) as f:
-        code = compile(f.read(), os.path.basename(_bcf), 'exec')
-        exec(code, {}, config)
+config = load(_bcf)
 log.info("configuration loaded")
 log.debug("config: {}".format(config))
-
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import random
+import threading
+
+import scitags
+
+log = logging.getLogger('scitags')
+
+
+# Flow map registry (FLOW_MAP_API) client with on-disk cache
+#
+# The cache keeps the raw registry response together with its ETag/Last-Modified headers,
+# so that refreshes can use conditional requests and only transfer the registry when it changed.
+def parse(raw):
+    # flow_map stores flow_id lookup dict; e.g.
+    # 'experiments': {u'atlas': 16, ..}
+    # 'activities': {16: {u'rebalancing': 16, u'production': 14}, etc.
+    flow_map = dict()
+    flow_map['experiments'] = dict()
+    flow_map['activities'] = dict()
+    for exp in raw['experiments']:
+        flow_map['experiments'][exp['expName']] = exp['expId']
+        flow_map['activities'][exp['expId']] = dict()
+        for act in exp['activities']:
+            flow_map['activities'][exp['expId']][act['activityName']] = act['activityId']
+    return flow_map
+
+
+def fetch(url, entry=None, timeout=None):
+    # returns new cache entry or None if registry was not modified since entry was fetched
+    headers = dict()
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    flow_api = scitags.get_requests().get(url, headers=headers, verify=False, timeout=timeout)
+    if flow_api.status_code == 304:
+        return None
+    if flow_api.status_code != 200:
+        raise scitags.FlowConfigException('Failed to access FLOW MAP API at {} got {}'.format(url,
+                                                                                          flow_api.status_code))
+    return {'raw': json.loads(flow_api.content),
+            'etag': flow_api.headers.get('ETag'),
+            'last_modified': flow_api.headers.get('Last-Modified')}
+
+
+def load_cache(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        parse(entry['raw'])
+    except Exception as e:
+        log.warning('Ignoring invalid flow map cache {} ({})'.format(path, e))
+        return None
+    return entry
+
+
+def save_cache(path, entry):
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        log.warning('Unable to write flow map cache {} ({})'.format(path, e))
+
+
+# Periodically refreshes flow_map (in place) from the registry and updates the cache
+class FlowMapRefresher(threading.Thread):
+    def __init__(self, url, flow_map, entry, cache_path, interval, timeout, on_update=None):
+        super(FlowMapRefresher, self).__init__(name='flow-map-refresh')
+        self.daemon = True
+        self.url = url
+        self.flow_map = flow_map
+        self.entry = entry
+        self.cache_path = cache_path
+        self.interval = interval
+        self.timeout = timeout
+        self.on_update = on_update
+        self._stop_event = threading.Event()
+
+    def refresh(self):
+        entry = fetch(self.url, self.entry, self.timeout)
+        if entry is None:
+            log.debug('flow map not modified')
+            return False
+        flow_map = parse(entry['raw'])
+        self.entry = entry
+        save_cache(self.cache_path, entry)
+        if flow_map == self.flow_map:
+            return False
+        self.flow_map['experiments'] = flow_map['experiments']
+        self.flow_map['activities'] = flow_map['activities']
+        log.info('flow map registry updated')
+        log.debug(self.flow_map)
+        if self.on_update:
+            self.on_update(self.flow_map)
+        return True
+
+    def run(self):
+        # spread the first refresh so that restarting many nodes at once doesn't hit the registry together
+        if self._stop_event.wait(random.uniform(0, min(self.interval, 60))):
+            return
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.warning('Failed to refresh flow map from {} ({})'.format(self.url, e))
+            if self._stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,79 @@
+import ctypes
+import math
+import time
+import multiprocessing as mp
+
+# Per-stage event latency histograms of a backend subscription
+#
+# Plugin publishers stamp every FlowID with (detected, enqueued) time.monotonic() timestamps
+# (FlowID.stamps), the subscriber takes the dequeue time and the backend reports emission
+# (BusSubscriber.emitted). Stages:
+#   plugin  - detected to enqueued (plugin processing after the poll)
+#   bus     - enqueued to dequeued (queueing on the event bus)
+#   backend - dequeued to emitted (backend work, e.g. netlink lookup, sendto)
+#   total   - detected to emitted
+# Histograms live in shared memory, they're written by the backend process and read by the service.
+# CLOCK_MONOTONIC is system-wide, so timestamps taken in different processes can be compared.
+STAGES = ('plugin', 'bus', 'backend', 'total')
+PLUGIN, BUS, BACKEND, TOTAL = range(len(STAGES))
+
+# bucket i counts latencies up to 1.1^(i+1) us (10% resolution, up to ~190s)
+BUCKETS = 200
+_INV_LOG_BASE = 1 / math.log(1.1)
+
+
+def bucket(latency):
+    us = latency * 1e6
+    if us <= 1:
+        return 0
+    return min(int(math.log(us) * _INV_LOG_BASE), BUCKETS - 1)
+
+
+def percentile(hist, p):
+    # upper bound of the bucket containing the p-th percentile in seconds, None if hist is empty
+    total = sum(hist)
+    n = 0
+    for i, count in enumerate(hist):
+        n += count
+        if n and n >= total * p:
+            return 1.1 ** (i + 1) / 1e6
+    return None
+
+
+class LatencyStats(object):
+    def __init__(self):
+        self._hist = mp.RawArray(ctypes.c_uint64, len(STAGES) * BUCKETS)
+        self._dequeued = None
+        self._last = [0] * (len(STAGES) * BUCKETS)
+
+    def record(self, stage, latency):
+        self._hist[stage * BUCKETS + bucket(latency)] += 1
+
+    def dequeued(self, items):
+        # called by the subscriber with the events handed out to the backend
+        self._dequeued = now = time.monotonic()
+        for item in items:
+            stamps = getattr(item, 'stamps', None)
+            if stamps:
+                self.record(PLUGIN, stamps[1] - stamps[0])
+                self.record(BUS, now - stamps[1])
+
+    def emitted(self, flow_id):
+        if not flow_id.stamps or self._dequeued is None:
+            return
+        now = time.monotonic()
+        self.record(BACKEND, now - self._dequeued)
+        self.record(TOTAL, now - flow_id.stamps[0])
+
+    def histogram(self, stage):
+        return self._hist[stage * BUCKETS:(stage + 1) * BUCKETS]
+
+    def interval(self, percentiles=(0.5, 0.99)):
+        # returns {stage: (count, [percentiles])} for the events recorded since the previous call
+        hist = self._hist[:]
+        stats = dict()
+        for stage, name in enumerate(STAGES):
+            delta = [hist[i] - self._last[i] for i in range(stage * BUCKETS, (stage + 1) * BUCKETS)]
+            stats[name] = (sum(delta), [percentile(delta, p) for p in percentiles])
+        self._last = hist
+        return stats
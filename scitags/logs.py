@@ -0,0 +1,76 @@
+import logging
+import logging.handlers
+import time
+import multiprocessing as mp
+
+log = logging.getLogger('scitags')
+
+# Logging of the plugin and backend processes
+#
+# With LOG_QUEUE the service starts a listener thread that passes the records sent over a queue to the handlers
+# of the 'scitags' logger, processes forked afterwards replace their handlers by one that sends the records over
+# the queue, so they don't wait for stdout (syslog) themselves; the service itself keeps logging to the handlers
+# directly. Records are formatted (message only) before they're queued, the listener adds time, level, module and
+# pid of the process that logged them.
+# Per-event info lines are rate limited with EventLog.
+
+_queue = None
+
+
+def start(logger):
+    # starts the listener for logger in this process, returns it (stop() flushes the queue)
+    global _queue
+    _queue = mp.Queue()
+    listener = logging.handlers.QueueListener(_queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def attach(logger):
+    # called in the forked processes, records are sent to the listener of the service if it was started
+    if _queue is None:
+        return
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(_queue))
+
+
+# Rate limit of per-event info lines, at most rate lines per second are logged (0 - none), the number of events
+# and suppressed lines is logged every interval seconds (if any were suppressed), e.g.
+#   if events_log.allow():
+#       log.info('%s added', flow_id)
+class EventLog(object):
+    def __init__(self, name, rate, interval=60, logger=log):
+        self.name = name
+        self.rate = rate
+        self.interval = interval
+        self.logger = logger
+        self.events = 0
+        self.suppressed = 0
+        self.lines = 0
+        self.second = 0
+        self.last_summary = time.monotonic()
+
+    def allow(self):
+        # counts the event, returns True if it can be logged
+        now = time.monotonic()
+        if now - self.last_summary >= self.interval:
+            self.summary(now)
+        self.events += 1
+        if int(now) != self.second:
+            self.second = int(now)
+            self.lines = 0
+        if self.lines < self.rate:
+            self.lines += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def summary(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.suppressed:
+            self.logger.info('{}: {} events in the last {:.0f}s, {} of them not logged (LOG_EVENTS_RATE)'.format(
+                self.name, self.events, now - self.last_summary, self.suppressed))
+        self.events = 0
+        self.suppressed = 0
+        self.last_summary = now
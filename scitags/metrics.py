@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socketserver
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import SocketServer as socketserver
+
+import scitags
+import scitags.latency
+
+log = logging.getLogger('scitags')
+
+# Internal metrics of flowd (event bus, plugins, backends and processes) in Prometheus text format
+#
+# Served by the service process, independently of the prometheus backend, from a unix socket
+# (METRICS_SOCKET) and optionally from a TCP port (METRICS_PORT), e.g.
+#   curl --unix-socket /var/cache/flowd/metrics.sock http://localhost/metrics
+# Values are read on each scrape from the shared memory counters of the plugin publishers and
+# bus subscribers, CPU and RSS of the processes are taken from psutil.
+
+
+def _metric(lines, name, mtype, text, samples):
+    lines.append('# HELP {} {}'.format(name, text))
+    lines.append('# TYPE {} {}'.format(name, mtype))
+    for labels, value in samples:
+        if value is None:
+            continue
+        label_str = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+        lines.append('{}{{{}}} {}'.format(name, label_str, value))
+
+
+def process_stats(pid):
+    # returns (cpu seconds, rss bytes) or None if the process is gone
+    import psutil
+    try:
+        proc = psutil.Process(pid)
+        with proc.oneshot():
+            cpu = proc.cpu_times()
+            return cpu.user + cpu.system, proc.memory_info().rss
+    except psutil.Error:
+        return None
+
+
+def collect(service):
+    lines = list()
+    pubs = [(('plugin', pub.name),) for pub in service.plugin_pub]
+    _metric(lines, 'flowd_plugin_events_total', 'counter', 'Events published by the plugin',
+            zip(pubs, [pub.events.value for pub in service.plugin_pub]))
+    _metric(lines, 'flowd_plugin_polls_total', 'counter', 'Poll cycles done by the plugin',
+            zip(pubs, [pub.polls.value for pub in service.plugin_pub]))
+    _metric(lines, 'flowd_plugin_poll_duration_seconds', 'gauge', 'Duration of the last poll',
+            zip(pubs, [pub.poll_duration.value for pub in service.plugin_pub]))
+    _metric(lines, 'flowd_plugin_poll_sockets', 'gauge', 'Sockets seen in the last poll',
+            zip(pubs, [pub.poll_sockets.value for pub in service.plugin_pub]))
+
+    subs = [(('backend', name),) for name, _ in service.backend_sub]
+    for i, counter in enumerate(scitags.BACKEND_COUNTERS):
+        _metric(lines, 'flowd_backend_{}_total'.format(counter), 'counter',
+                'Backend {}'.format(counter.replace('_', ' ')),
+                zip(subs, [sub.counters[i] for _, sub in service.backend_sub]))
+    _metric(lines, 'flowd_bus_depth', 'gauge', 'Events (queue) or frames (ring) waiting on the event bus',
+            zip(subs, [sub.depth() for _, sub in service.backend_sub]))
+    _metric(lines, 'flowd_bus_overruns_total', 'counter', 'Event bus overruns (ring)',
+            zip(subs, [getattr(sub, 'overruns', None) for _, sub in service.backend_sub]))
+    _metric(lines, 'flowd_bus_lost_total', 'counter', 'Frames lost in overruns (ring)',
+            zip(subs, [getattr(sub, 'lost', None) for _, sub in service.backend_sub]))
+    for i, counter in enumerate(scitags.DESTINATION_COUNTERS):
+        samples = list()
+        for name, sub in service.backend_sub:
+            for dst, values in sub.destinations.items():
+                samples.append(((('backend', name), ('destination', dst)), values[i]))
+        _metric(lines, 'flowd_backend_{}_total'.format(counter), 'counter',
+                'Backend {} per destination'.format(counter.replace('_', ' ')), samples)
+    samples = list()
+    for name, sub in service.backend_sub:
+        for dst, state in sub.destinations.states():
+            samples.append(((('backend', name), ('destination', dst)), state))
+    _metric(lines, 'flowd_backend_destination_up', 'gauge', 'Destination is up (1) or down after failures (0)',
+            samples)
+    samples = list()
+    for name, sub in service.backend_sub:
+        for dst, seconds in sub.destinations.times():
+            samples.append(((('backend', name), ('destination', dst)), seconds))
+    _metric(lines, 'flowd_backend_dns_lookup_seconds_total', 'counter', 'Time spent resolving the destination',
+            samples)
+    samples = list()
+    for name, sub in service.backend_sub:
+        if not sub.latency:
+            continue
+        for i, stage in enumerate(scitags.latency.STAGES):
+            hist = sub.latency.histogram(i)
+            for q in (0.5, 0.99):
+                samples.append(((('backend', name), ('stage', stage), ('quantile', q)),
+                                scitags.latency.percentile(hist, q)))
+    _metric(lines, 'flowd_backend_latency_seconds', 'gauge', 'Event latency per stage since start', samples)
+
+    procs = [('service', 'service', os.getpid(), 0, True)]
+    for sp in service.supervisor.processes:
+        alive = sp.is_alive()
+        # tasks of the asyncio runtime have no process of their own, they're accounted to the service
+        procs.append((sp.name, sp.role, sp.proc.pid if alive and sp.proc else None, sp.restarts, alive))
+    stats = dict((pid, process_stats(pid)) for _, _, pid, _, _ in procs if pid)
+    labels = [(('process', name), ('role', role)) for name, role, _, _, _ in procs]
+    _metric(lines, 'flowd_process_up', 'gauge', 'Process is running',
+            zip(labels, [int(alive) for _, _, _, _, alive in procs]))
+    _metric(lines, 'flowd_process_restarts_total', 'counter', 'Process restarts',
+            zip(labels, [restarts for _, _, _, restarts, _ in procs]))
+    _metric(lines, 'flowd_process_cpu_seconds_total', 'counter', 'User and system CPU time of the process',
+            zip(labels, [stats[pid][0] if stats.get(pid) else None for _, _, pid, _, _ in procs]))
+    _metric(lines, 'flowd_process_resident_memory_bytes', 'gauge', 'Resident memory of the process',
+            zip(labels, [stats[pid][1] if stats.get(pid) else None for _, _, pid, _, _ in procs]))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = collect(self.server.service).encode('utf-8')
+        except Exception as e:
+            log.exception('Failed to collect metrics')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not logged (client address of unix socket connections is empty anyway)
+        pass
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+
+# Serves collect(service) from the configured unix socket and/or TCP port, each in its own thread
+class MetricsServer(object):
+    def __init__(self, service, path=None, port=None, host='127.0.0.1'):
+        self.service = service
+        self.path = path
+        self.port = port
+        self.host = host
+        self.servers = list()
+
+    def _serve(self, srv):
+        srv.service = self.service
+        t = threading.Thread(target=srv.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        self.servers.append(srv)
+
+    def start(self):
+        if self.path:
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self._serve(UnixHTTPServer(self.path, MetricsHandler))
+                log.info('metrics available at unix socket {}'.format(self.path))
+            except (IOError, OSError) as e:
+                log.warning('Unable to serve metrics at {} ({})'.format(self.path, e))
+        if self.port:
+            try:
+                self._serve(HTTPServer((self.host, self.port), MetricsHandler))
+                log.info('metrics available at http://{}:{}/metrics'.format(self.host, self.port))
+            except (IOError, OSError) as e:
+                log.warning('Unable to serve metrics at {}:{} ({})'.format(self.host, self.port, e))
+
+    def stop(self):
+        for srv in self.servers:
+            srv.shutdown()
+            srv.server_close()
+        self.servers = list()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
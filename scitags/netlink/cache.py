@@ -1,65 +1,126 @@
 from scitags.netlink.pyroute_tcp import TCP
 from pyroute2.netlink.diag import DiagSocket
 from pyroute2.netlink.diag import SS_CONN
+import errno
 import logging
 
 log = logging.getLogger('scitags')
 
+# flows are looked up by their 4-tuple (inet_diag exact match) over a netlink socket kept open by the backend,
+# falling back to a dump of all the TCP sockets if the kernel doesn't support it
+EXACT_LOOKUP = True
+_diag_socket = None
 
-def netlink_cache_add(flow_state, src, src_port, dst, dst_port, netlink_cache):
+
+def _socket():
+    global _diag_socket
+    if _diag_socket is None:
+        ds = DiagSocket()
+        ds.bind()
+        _diag_socket = ds
+    return _diag_socket
+
+
+def _close():
+    global _diag_socket
+    if _diag_socket is not None:
+        try:
+            _diag_socket.close()
+        except Exception:
+            pass
+        _diag_socket = None
+
+
+def _dump():
     try:
         with DiagSocket() as ds:
             ds.bind()
             p = TCP(sk_states=SS_CONN)
-            netc = p(ds)
-    except Exception as e:
+            return p(ds)
+    except Exception:
         log.exception('Exception caught while querying netlink')
-        return
+        return None
+
+
+def _lookup(src, src_port, dst, dst_port):
+    # returns the matching connections (none if it's gone) or None if the lookup failed
+    global EXACT_LOOKUP
+    try:
+        return TCP(sk_states=SS_CONN).lookup(_socket(), src, src_port, dst, dst_port)
+    except OSError as e:
+        _close()
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP, errno.EPROTONOSUPPORT, errno.EAFNOSUPPORT):
+            # rejected by the kernel, dumps are used from now on
+            EXACT_LOOKUP = False
+            log.warning('netlink socket lookup not available ({}), using full dumps'.format(e))
+        else:
+            log.exception('Exception caught while looking up {}:{} in netlink'.format(src, src_port))
+    except Exception:
+        _close()
+        log.exception('Exception caught while looking up {}:{} in netlink'.format(src, src_port))
+    return None
+
+
+def _cache_key(entry):
+    saddr = u'{}'.format(entry['src'])
+    if '::ffff:' in saddr:
+        saddr = saddr.replace('::ffff:', '')
+    daddr = u'{}'.format(entry['dst'])
+    if '::ffff:' in daddr:
+        daddr = daddr.replace('::ffff:', '')
+    return 'tcp', saddr, entry['src_port'], daddr, entry['dst_port']
+
+
+def netlink_cache_add(flow_state, src, src_port, dst, dst_port, netlink_cache):
+    netc = _lookup(src, src_port, dst, dst_port) if EXACT_LOOKUP else None
+    if netc is None:
+        netc = _dump()
+        if netc is None:
+            return
 
     for entry in netc:
         if 'tcp_info' not in entry.keys():
             continue
-        saddr = u'{}'.format(entry['src'])
-        if '::ffff:' in saddr:
-            saddr = saddr.replace('::ffff:', '')
-        sport = entry['src_port']
-        daddr = u'{}'.format(entry['dst'])
-        if '::ffff:' in daddr:
-            daddr = daddr.replace('::ffff:', '')
-        dport = entry['dst_port']
-        if not (saddr, sport, daddr, dport) == (src, src_port, dst, dst_port):
+        key = _cache_key(entry)
+        if not key[1:] == (src, src_port, dst, dst_port):
             continue
-        prot = 'tcp'
         status = entry['tcp_info']['state']
-        netlink_cache[(prot, saddr, sport, daddr, dport)] = (status, entry)
+        netlink_cache[key] = (status, entry)
+
+
+def netlink_cache_refresh(src, src_port, dst, dst_port, netlink_cache):
+    # refreshes a single connection by exact lookup, returns False if it's gone (its last known state is kept)
+    # and None if it can't be looked up
+    netc = _lookup(src, src_port, dst, dst_port) if EXACT_LOOKUP else None
+    if netc is None:
+        return None
+    for entry in netc:
+        if 'tcp_info' not in entry.keys():
+            continue
+        key = _cache_key(entry)
+        if key[1:] == (src, src_port, dst, dst_port):
+            netlink_cache[key] = (entry['tcp_info']['state'], entry)
+            return True
+    return False
 
 
 def netlink_cache_update(netlink_cache):
+    # returns the keys of the connections that are gone, their last known state is kept until the end of the flow
     if not netlink_cache:     # if cache is empty there is nothing to update
-        return
-    try:
-        with DiagSocket() as ds:
-            ds.bind()
-            p = TCP(sk_states=SS_CONN)
-            netc = p(ds)
-    except Exception as e:
-        log.exception('Exception caught while querying netlink')
-        return
+        return set()
+    netc = _dump()
+    if netc is None:
+        return set()
+    found = set()
     for entry in netc:
         if 'tcp_info' not in entry.keys():
             continue
-        saddr = u'{}'.format(entry['src'])
-        if '::ffff:' in saddr:
-            saddr = saddr.replace('::ffff:', '')
-        sport = entry['src_port']
-        daddr = u'{}'.format(entry['dst'])
-        if '::ffff:' in daddr:
-            daddr = daddr.replace('::ffff:', '')
-        dport = entry['dst_port']
-        if ('tcp', saddr, sport, daddr, dport) in netlink_cache.keys():
+        key = _cache_key(entry)
+        if key in netlink_cache.keys():
             status = entry['tcp_info']['state']
-            netlink_cache[('tcp', saddr, sport, daddr, dport)] = (status, entry)
-    # todo: cleanup - check if connections in cache are still there
+            netlink_cache[key] = (status, entry)
+            found.add(key)
+    return set(netlink_cache.keys()) - found
 
 
 def netlink_cache_del(src, src_port, dst, dst_port, netlink_cache):
@@ -2,8 +2,10 @@
 # Copyright pyroute2 Developers
 # License: https://github.com/svinota/pyroute2/blob/master/LICENSE
 #
+import errno
 import json
-from socket import (AF_INET, AF_INET6)
+import struct
+from socket import (AF_INET, AF_INET6, IPPROTO_TCP, inet_pton)
 import logging
 import sys
 
@@ -33,13 +35,19 @@ from pyroute2.netlink.diag import (SS_ESTABLISHED,
                                      SS_LISTEN,
                                      SS_CLOSING,
                                      SS_ALL,
-                                     SS_CONN)
+                                     SS_CONN,
+                                     SOCK_DIAG_BY_FAMILY,
+                                     inet_diag_req)
+from pyroute2.netlink import (NLM_F_REQUEST, NLMSG_ERROR)
 try:
     from collections.abc import Mapping
     from collections.abc import Callable
 except ImportError:
     from collections import Mapping
     from collections import Callable
+
+# inet_diag_req_v2 cookie matching any socket
+INET_DIAG_NOCOOKIE = 0xffffffffffffffff
 # UDIAG_SHOW_ICONS,
 # UDIAG_SHOW_RQLEN,
 # UDIAG_SHOW_MEMINFO
@@ -89,6 +97,31 @@ class TCP(Protocol):
         refined_stats_ip6 = self._refine_diag_raw(sstats_ip6, False, None)
         return refined_stats_ip4['TCP']['flows'] + refined_stats_ip6['TCP']['flows']
 
+    def lookup(self, nl_diag_sk, src, src_port, dst, dst_port):
+        # exact match on the (local) src and (remote) dst of a single socket instead of a dump of all of them,
+        # returns the refined socket (as a list of 0 or 1) or raises OSError if the kernel can't look it up
+        family = AF_INET6 if ':' in src else AF_INET
+        req = inet_diag_req()
+        req['sdiag_family'] = family
+        req['sdiag_protocol'] = IPPROTO_TCP
+        req['idiag_states'] = self._states
+        req['idiag_ext'] = self.ext_f
+        req['idiag_sport'] = src_port
+        req['idiag_dport'] = dst_port
+        req['idiag_src'] = struct.unpack('>4I', inet_pton(family, src).ljust(16, b'\0'))
+        req['idiag_dst'] = struct.unpack('>4I', inet_pton(family, dst).ljust(16, b'\0'))
+        req['idiag_cookie'] = INET_DIAG_NOCOOKIE
+        found = list()
+        for msg in nl_diag_sk.nlm_request(req, SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST):
+            if msg['header']['type'] == NLMSG_ERROR:
+                # errors aren't decoded by pyroute2 (see MarshalDiag), errno follows the nlmsg header
+                code = -struct.unpack_from('i', msg.data, msg.offset + 16)[0]
+                if code and code != errno.ENOENT:
+                    raise OSError(code, 'inet_diag lookup failed: {}'.format(errno.errorcode.get(code, code)))
+                continue
+            found.append(msg)
+        return self._refine_diag_raw(found, False, None)['TCP']['flows']
+
     def _refine_diag_raw(self, raw_stats, do_resolve, usr_ctxt):
 
         refined = {'TCP': {'flows': []}}
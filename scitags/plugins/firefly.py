@@ -14,8 +14,7 @@ class ThreadedUDPRequestHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         data = self.request[0].strip()
-        current_thread = threading.current_thread()
-        print("{}: client: {}, wrote: {}".format(current_thread.name, self.client_address, data))
+        log.debug("{}: client: {}, wrote: {}".format(threading.current_thread().name, self.client_address, data))
         if b'firefly-json' not in data:
             log.debug("Ignoring incoming firefly {}".format(data))
             return
@@ -41,7 +40,7 @@ class ThreadedUDPRequestHandler(socketserver.BaseRequestHandler):
             end_time = firefly_json['flow-lifecycle']["end-time"]
 
         flow_id = scitags.FlowID(state, protocol, src, src_port, dst, dst_port, exp, activity, start_time, end_time)
-        log.debug('   --> {}'.format(flow_id))
+        log.debug('   --> %s', flow_id)
         self.server.queue.put(flow_id)
 
 
@@ -74,6 +73,7 @@ def run(flow_queue, term_event, ip_config):
     log.debug("firefly listener started @{}/{}".format(host, port))
     while not term_event.is_set():
         time.sleep(2)
+        flow_queue.flush()
 
     server.shutdown()
     server.server_close()
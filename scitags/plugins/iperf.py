@@ -8,6 +8,7 @@ import random
 
 import scitags
 import scitags.settings
+import scitags.config
 from scitags.config import config
 
 log = logging.getLogger('scitags')
@@ -50,20 +51,28 @@ def __int_ip(ip, int_networks):
 
 def run(flow_queue, term_event, ip_config):
     netstat_index = dict()
-    int_networks = set()
     init_pass = True
-    if 'NETSTAT_INTERNAL_NETWORKS' in config.keys():
-        for net in config['NETSTAT_INTERNAL_NETWORKS']:
-            int_networks.add(ipaddress.ip_network(u'{}'.format(net)))
+    config_version = None
 
     while not term_event.is_set():
+        if config_version != scitags.config.version:
+            # internal networks can change on config reload, flow index is kept
+            config_version = scitags.config.version
+            int_networks = set()
+            if 'NETSTAT_INTERNAL_NETWORKS' in config.keys():
+                for net in config['NETSTAT_INTERNAL_NETWORKS']:
+                    int_networks.add(ipaddress.ip_network(u'{}'.format(net)))
         netstat = dict()
+        flow_ids = list()
+        poll_start = time.monotonic()
         try:
             netc = psutil.net_connections(kind='tcp')
         except Exception as e:
             log.exception('Exception caught while calling psutil')
             time.sleep(scitags.settings.NETSTAT_TIMEOUT)
             continue
+        # events found in this poll are stamped with its time (see scitags.latency)
+        detected = time.monotonic()
 
         for entry in netc:
             if entry.status == 'LISTEN':
@@ -112,8 +121,8 @@ def run(flow_queue, term_event, ip_config):
                 netstat_index[k]['exp'] = exp
                 netstat_index[k]['act'] = act
                 f_id = scitags.FlowID('start', *k + (exp, act, netstat_index[k]['start_time']))
-                log.debug('   --> {}'.format(f_id))
-                flow_queue.put(f_id)
+                log.debug('   --> %s', f_id)
+                flow_ids.append(f_id)
             elif k in netstat_index.keys() and v in ['TIME_WAIT', 'LAST_ACK', 'FIN_WAIT1', 'FIN_WAIT2', 'CLOSING',
                                                      'CLOSE_WAIT', 'CLOSED']:
                 if netstat_index[k]['end_time']:   # end_time set indicates firefly was sent already
@@ -123,25 +132,28 @@ def run(flow_queue, term_event, ip_config):
                 netstat_index[k]['end_time'] = datetime.utcnow().isoformat()+'+00:00'
                 f_id = scitags.FlowID('end', *k + (netstat_index[k]['exp'], netstat_index[k]['act'],
                                                    netstat_index[k]['start_time'], netstat_index[k]['end_time']))
-                log.debug('   --> {}'.format(f_id))
-                flow_queue.put(f_id)
+                log.debug('   --> %s', f_id)
+                flow_ids.append(f_id)
 
         # cleanup
         closed_connections = set(netstat_index.keys()) - set(netstat.keys())
         if closed_connections:
-            log.debug("  closed: {}".format(closed_connections))
+            log.debug("  closed: %s", closed_connections)
         for c in closed_connections:
             # connections where we didn't catch end state ?
             if netstat_index[c]['start_time'] and not netstat_index[c]['end_time']:
                 netstat_index[c]['end_time'] = datetime.utcnow().isoformat() + '+00:00'
                 f_id = scitags.FlowID('end', *c + (netstat_index[c]['exp'], netstat_index[c]['act'],
                                                    netstat_index[c]['start_time'], netstat_index[c]['end_time']))
-                log.debug('   --> {}'.format(f_id))
-                flow_queue.put(f_id)
+                log.debug('   --> %s', f_id)
+                flow_ids.append(f_id)
             netstat_index.pop(c, None)
-        for k, v in netstat_index.items():
-            if not netstat_index[k]['start_time'] or not netstat_index[k]['end_time']:
-                continue
-            log.debug("  netstat_index: {} -> {}".format(k, v))
+        if log.isEnabledFor(logging.DEBUG):
+            for k, v in netstat_index.items():
+                if not netstat_index[k]['start_time'] or not netstat_index[k]['end_time']:
+                    continue
+                log.debug("  netstat_index: %s -> %s", k, v)
 
-        term_event.wait(scitags.settings.NETSTAT_TIMEOUT)
+        flow_queue.put_many(flow_ids, detected)
+        flow_queue.polled(detected - poll_start, len(netc))
+        term_event.wait(config.get('NETSTAT_TIMEOUT', scitags.settings.NETSTAT_TIMEOUT))
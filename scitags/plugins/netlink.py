@@ -9,6 +9,7 @@ from pyroute2.netlink.diag import SS_CONN
 import scitags
 import scitags.settings
 from scitags.netlink import TCP
+import scitags.config
 from scitags.config import config
 
 log = logging.getLogger('scitags')
@@ -49,14 +50,20 @@ def __int_ip(ip, int_networks):
 
 def run(flow_queue, term_event, ip_config):
     netlink_index = dict()
-    int_networks = set()
     init_pass = True
-    if 'NETLINK_INTERNAL_NETWORKS' in config.keys():
-        for net in config['NETLINK_INTERNAL_NETWORKS']:
-            int_networks.add(ipaddress.ip_network(u'{}'.format(net)))
+    config_version = None
 
     while not term_event.is_set():
+        if config_version != scitags.config.version:
+            # internal networks can change on config reload, flow index is kept
+            config_version = scitags.config.version
+            int_networks = set()
+            if 'NETLINK_INTERNAL_NETWORKS' in config.keys():
+                for net in config['NETLINK_INTERNAL_NETWORKS']:
+                    int_networks.add(ipaddress.ip_network(u'{}'.format(net)))
         netlink = dict()
+        flow_ids = list()
+        poll_start = time.monotonic()
         try:
             with DiagSocket() as ds:
                 ds.bind()
@@ -66,6 +73,8 @@ def run(flow_queue, term_event, ip_config):
             log.exception('Exception caught while querying netlink')
             time.sleep(scitags.settings.NETLINK_TIMEOUT)
             continue
+        # events found in this poll are stamped with its time (see scitags.latency)
+        detected = time.monotonic()
 
         for entry in netc:
             if 'tcp_info' not in entry:
@@ -116,8 +125,8 @@ def run(flow_queue, term_event, ip_config):
                 netlink_index[k]['netlink'] = v[1]
                 f_id = scitags.FlowID('start', *k + (config['NETLINK_EXPERIMENT'], config['NETLINK_ACTIVITY'],
                                                      netlink_index[k]['start_time'], None, netlink_index[k]['netlink']))
-                log.debug('   --> {}'.format(f_id))
-                flow_queue.put(f_id)
+                log.debug('   --> %s', f_id)
+                flow_ids.append(f_id)
             elif k in netlink_index.keys() and v == 'established':
                 # update netlink info for known connections
                 netlink_index[k]['netlink'] = v[1]
@@ -132,8 +141,10 @@ def run(flow_queue, term_event, ip_config):
                 f_id = scitags.FlowID('end', *c + (config['NETLINK_EXPERIMENT'], config['NETLINK_ACTIVITY'],
                                                    netlink_index[c]['start_time'], netlink_index[c]['end_time'],
                                                    netlink_index[c]['netlink']))
-                log.debug('   <-- {}'.format(f_id))
-                flow_queue.put(f_id)
+                log.debug('   <-- %s', f_id)
+                flow_ids.append(f_id)
             netlink_index.pop(c, None)
 
-        term_event.wait(scitags.settings.NETLINK_TIMEOUT)
+        flow_queue.put_many(flow_ids, detected)
+        flow_queue.polled(detected - poll_start, len(netc))
+        term_event.wait(config.get('NETLINK_TIMEOUT', scitags.settings.NETLINK_TIMEOUT))
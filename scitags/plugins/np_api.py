@@ -37,6 +37,7 @@ def run(flow_queue, term_event, ip_config):
         try:
             tr = sp.poll(3)
             if not tr:
+                flow_queue.flush()
                 continue
             np_content = os.read(np_api_fd, 65535)
         except IOError as e:
@@ -46,6 +47,7 @@ def run(flow_queue, term_event, ip_config):
         log.debug(np_content)
         flow_ids = np_content.decode('utf-8').splitlines()
         log.debug(flow_ids)
+        batch = list()
         for f_id in flow_ids:
             entry = f_id.strip().split(' ')
             if len(entry) != 8:
@@ -91,7 +93,8 @@ def run(flow_queue, term_event, ip_config):
 
             flow_id = scitags.FlowID(flow_state, proto, src, src_port, dst, dst_port, exp_id, activity_id,
                                      start_time, end_time, netlink)
-            log.debug('   --> {}'.format(flow_id))
-            flow_queue.put(flow_id)
+            log.debug('   --> %s', flow_id)
+            batch.append(flow_id)
+        flow_queue.put_many(batch)
 
     os.unlink(scitags.settings.NP_API_FILE)
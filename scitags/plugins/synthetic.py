@@ -0,0 +1,62 @@
+import collections
+import ipaddress
+import logging
+import time
+from datetime import datetime
+
+import scitags
+import scitags.settings
+from scitags.config import config
+
+log = logging.getLogger('scitags')
+
+# Synthetic load generator (used by flowd-bench)
+#
+# Starts SYNTHETIC_RATE flows per second, each of them ends SYNTHETIC_LIFETIME seconds later.
+# Flows are tcp from 10.0.0.0/8 (unique 5-tuple per flow) to SYNTHETIC_DST:1094.
+
+
+def init():
+    log.debug('synthetic init')
+    for k in ('SYNTHETIC_EXPERIMENT', 'SYNTHETIC_ACTIVITY'):
+        if k not in config.keys():
+            raise scitags.FlowConfigException('{} is required for synthetic plugin'.format(k))
+    try:
+        ipaddress.ip_address(u'{}'.format(config.get('SYNTHETIC_DST', scitags.settings.SYNTHETIC_DST)))
+    except ValueError:
+        raise scitags.FlowConfigException('Unable to parse SYNTHETIC_DST')
+    log.info('   synthetic init: done')
+
+
+def flow(n):
+    # n-th synthetic flow, source port cycles through 1024-65535 then source address is increased
+    src = ipaddress.IPv4Address(u'10.0.0.1') + n // 64512
+    return str(src), 1024 + n % 64512
+
+
+def run(flow_queue, term_event, ip_config):
+    rate = config.get('SYNTHETIC_RATE', scitags.settings.SYNTHETIC_RATE)
+    lifetime = config.get('SYNTHETIC_LIFETIME', scitags.settings.SYNTHETIC_LIFETIME)
+    interval = config.get('SYNTHETIC_INTERVAL', scitags.settings.SYNTHETIC_INTERVAL)
+    dst = config.get('SYNTHETIC_DST', scitags.settings.SYNTHETIC_DST)
+    exp = config['SYNTHETIC_EXPERIMENT']
+    act = config['SYNTHETIC_ACTIVITY']
+    active = collections.deque()   # (end time, flow_id) in order of expiration
+    started = time.time()
+    n = 0
+    while not term_event.is_set():
+        now = time.time()
+        detected = time.monotonic()
+        ts = datetime.utcnow().isoformat() + '+00:00'
+        flow_ids = list()
+        while active and active[0][0] <= now:
+            flow_ids.append(active.popleft()[1]._replace(state='end', end_time=ts))
+        # catch up with the configured rate if a tick was late
+        for _ in range(int((now - started) * rate) - n):
+            src, src_port = flow(n)
+            f_id = scitags.FlowID('start', 'tcp', src, src_port, dst, 1094, exp, act, ts)
+            active.append((now + lifetime, f_id))
+            flow_ids.append(f_id)
+            n += 1
+        flow_queue.put_many(flow_ids, detected)
+        term_event.wait(interval)
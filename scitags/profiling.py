@@ -0,0 +1,116 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import scitags.settings
+
+log = logging.getLogger('scitags')
+
+# On-demand profiling of the flowd processes (service, plugins and backends)
+#
+# SIGUSR1 starts/stops a sampling CPU profiler: SIGPROF is delivered every PROFILE_INTERVAL seconds of CPU
+# time used by the process and the stacks of its threads are counted; when stopped they're written in folded
+# format (flamegraph.pl, speedscope) to WORK_DIR/profile-<role>-<name>-<pid>-<time>.folded
+# SIGUSR2 starts tracemalloc, the next SIGUSR2 writes the top PROFILE_TOP allocation sites to
+# WORK_DIR/heap-<role>-<name>-<pid>-<time>.txt and stops it
+# While off nothing is armed (no timer, no tracing), e.g.
+#   kill -USR1 <pid>; sleep 60; kill -USR1 <pid>    (pids are listed in WORK_DIR/processes.json)
+
+
+def frame_stack(frame):
+    # root first, file:function for each frame
+    stack = list()
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    def __init__(self, role, name):
+        self.role = role
+        self.name = name
+        self.stacks = collections.Counter()
+        self.started = None
+        self.heap_started = None
+
+    def path(self, kind, ext):
+        return os.path.join(scitags.settings.WORK_DIR, '{}-{}-{}-{}-{}.{}'.format(
+            kind, self.role, self.name, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), ext))
+
+    def sample(self, signum, frame):
+        # SIGPROF handler, runs on the main thread; stacks of other threads are prefixed by the thread name
+        self.stacks[frame_stack(frame)] += 1
+        current = threading.current_thread().ident
+        frames = sys._current_frames()
+        if len(frames) == 1:
+            return
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, f in frames.items():
+            if ident != current:
+                self.stacks['{};{}'.format(names.get(ident, ident), frame_stack(f))] += 1
+
+    def toggle_profile(self, signum=None, frame=None):
+        if self.started is None:
+            self.stacks.clear()
+            signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, scitags.settings.PROFILE_INTERVAL, scitags.settings.PROFILE_INTERVAL)
+            self.started = time.time()
+            log.info('{} {}: profiler started'.format(self.role, self.name))
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        path = self.path('profile', 'folded')
+        try:
+            with open(path, 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+            log.info('{} {}: profile of {} samples in {:.1f}s written to {}'.format(
+                self.role, self.name, sum(self.stacks.values()), time.time() - self.started, path))
+        except (IOError, OSError) as e:
+            log.error('{} {}: unable to write profile {} ({})'.format(self.role, self.name, path, e))
+        self.started = None
+        self.stacks.clear()
+
+    def toggle_heap(self, signum=None, frame=None):
+        try:
+            import tracemalloc
+        except ImportError:
+            log.warning('{} {}: heap snapshots require tracemalloc'.format(self.role, self.name))
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.heap_started = time.time()
+            log.info('{} {}: tracemalloc started'.format(self.role, self.name))
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        stats = snapshot.statistics('lineno')
+        path = self.path('heap', 'txt')
+        try:
+            with open(path, 'w') as f:
+                f.write('# {} {} (pid {}), allocations traced for {:.1f}s: {:.1f} KiB in {} blocks\n'.format(
+                    self.role, self.name, os.getpid(), time.time() - self.heap_started,
+                    sum(s.size for s in stats) / 1024.0, sum(s.count for s in stats)))
+                for stat in stats[:scitags.settings.PROFILE_TOP]:
+                    frame = stat.traceback[0]
+                    f.write('{:>10.1f} KiB {:>8} blocks  {}:{}\n'.format(stat.size / 1024.0, stat.count,
+                                                                       frame.filename, frame.lineno))
+            log.info('{} {}: heap snapshot written to {}'.format(self.role, self.name, path))
+        except (IOError, OSError) as e:
+            log.error('{} {}: unable to write heap snapshot {} ({})'.format(self.role, self.name, path, e))
+
+
+def install(role, name):
+    # SIGUSR1/SIGUSR2 handlers of this process
+    profiler = Profiler(role, name)
+    signal.signal(signal.SIGUSR1, profiler.toggle_profile)
+    signal.signal(signal.SIGUSR2, profiler.toggle_heap)
+    return profiler
@@ -0,0 +1,274 @@
+import ctypes
+import logging
+import mmap
+import pickle
+import struct
+import time
+import multiprocessing as mp
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import scitags
+import scitags.settings
+
+log = logging.getLogger('scitags')
+
+# Shared memory ring buffer (single writer lock, multiple readers)
+#
+# Every frame is written once into an anonymous shared mapping, each subscriber
+# reads it through its own cursor. Positions are monotonic byte offsets, physical
+# offset in the mapping is pos % size. Frame layout:
+#   length (uint32), kind (uint32), seq (uint64), payload
+# where payload is either a pickled object or a batch of events encoded by codec.
+# A frame never straddles the end of the mapping, if it doesn't fit the writer
+# puts a wrap marker (or nothing if there is no space for the header) and
+# continues at the beginning.
+#
+# The writer keeps the oldest intact frame in tail and announces the region it's
+# about to overwrite in reserve before touching it. Readers falling behind tail
+# have been overrun; they re-sync to tail and count the frames lost from seq gaps
+# (control frames included, the service re-sends config and flow map updates to
+# subscribers that lost events, see FlowService.resync_backends).
+# Readers never take the writer lock, they're woken up via their own semaphore, so
+# a reader that gets killed can't block the writer.
+#
+# The ring is bounded by its size, overload policy (see scitags.PubSubQueue) decides what
+# happens when the writer would overwrite frames not read yet by all subscribers:
+#   drop-oldest - slow readers are overrun (as above)
+#   block - writer waits (up to block_timeout, then the frame is dropped) until all readers are
+#           past the region it's about to overwrite, control messages are always written
+#   drop-newest - event frames are dropped (and counted by every subscriber), control messages
+#                 are always written
+_FRAME_HDR = struct.Struct('=IIQ')
+_WRAP = 0xFFFFFFFF
+
+_KIND_PICKLE = 0
+_KIND_ENCODED = 1
+
+# indexes in the control block
+_HEAD = 0
+_RESERVE = 1
+_TAIL = 2
+_SEQ = 3
+
+
+class RingBufferQueue(object):
+    def __init__(self, size=scitags.settings.EVENT_BUS_SIZE, codec=None, dedup=False, latency=False,
+                 policy='drop-oldest', coalesce=None, block_timeout=scitags.settings.EVENT_BUS_BLOCK_TIMEOUT):
+        if size < 4 * mmap.PAGESIZE:
+            raise scitags.FlowConfigException('Event bus size too small ({} bytes)'.format(size))
+        if policy not in ('block', 'drop-oldest', 'drop-newest'):
+            raise scitags.FlowConfigException('Event bus policy {} is not supported by ring'.format(policy))
+        self._policy = policy
+        self._block_timeout = block_timeout
+        self._size = size
+        self._mm = mmap.mmap(-1, size)
+        self._ctl = mp.RawArray(ctypes.c_uint64, 4)
+        self._lock = mp.Lock()
+        self._codec = codec
+        self._dedup = dedup
+        self._latency = latency
+        self._coalesce = coalesce
+        self._subscribers = []
+
+    def register(self, shard=None):
+        with self._lock:
+            sub = RingSubscriber(self, self._ctl[_HEAD], self._ctl[_SEQ], self._codec, self._dedup, shard,
+                                 scitags.latency_stats(self._latency), self._coalesce)
+        self._subscribers.append(sub)
+        return sub
+
+    def register_shards(self, shards):
+        # pool of subscribers, all of them read every frame but each passes only its own flows
+        return [self.register((i, shards)) for i in range(shards)]
+
+    def _evict(self, end):
+        # advance tail past all frames that will be (partially) overwritten by [.., end)
+        tail = self._ctl[_TAIL]
+        while tail + self._size < end:
+            off = tail % self._size
+            if self._size - off < _FRAME_HDR.size:
+                tail += self._size - off
+                continue
+            length, _, _ = _FRAME_HDR.unpack_from(self._mm, off)
+            if length == _WRAP:
+                tail += self._size - off
+            else:
+                tail += _FRAME_HDR.size + length
+        self._ctl[_TAIL] = tail
+
+    def _frame_fits(self, data):
+        return _FRAME_HDR.size + len(data) <= self._size // 4
+
+    def _unread(self, end):
+        # True if some subscriber hasn't read everything before end - size yet
+        return any(sub._cursor.value < end - self._size for sub in self._subscribers)
+
+    def _put_frame(self, data, kind=_KIND_PICKLE, events=0):
+        # events - number of events in the frame, 0 for control messages
+        n = _FRAME_HDR.size + len(data)
+        if not self._frame_fits(data):
+            log.error('Event of {} bytes exceeds event bus frame limit, dropping it'.format(len(data)))
+            return
+        deadline = None
+        while True:
+            with self._lock:
+                head = self._ctl[_HEAD]
+                off = head % self._size
+                start = head
+                if self._size - off < n:
+                    start = head + self._size - off
+                end = start + n
+                # control messages are always written, slow readers are overrun by them
+                if not events or self._policy == 'drop-oldest' or not self._unread(end):
+                    self._write(data, kind, head, start, end)
+                    break
+                if self._policy == 'drop-newest' or (deadline is not None and time.monotonic() >= deadline):
+                    for sub in self._subscribers:
+                        sub.counters[scitags.EVENTS_DROPPED] += events
+                    return
+            # block - waits for the readers without holding the lock (up to block_timeout, then the frame is dropped)
+            if deadline is None:
+                deadline = time.monotonic() + self._block_timeout
+            time.sleep(0.001)
+        self._wakeup()
+
+    def _write(self, data, kind, head, start, end):
+        # called with the lock held
+        self._ctl[_RESERVE] = end
+        self._evict(end)
+        off = head % self._size
+        if start != head and self._size - off >= _FRAME_HDR.size:
+            _FRAME_HDR.pack_into(self._mm, off, _WRAP, 0, 0)
+        seq = self._ctl[_SEQ]
+        s_off = start % self._size
+        _FRAME_HDR.pack_into(self._mm, s_off, len(data), kind, seq)
+        self._mm[s_off + _FRAME_HDR.size:s_off + _FRAME_HDR.size + len(data)] = data
+        self._ctl[_SEQ] = seq + 1
+        self._ctl[_HEAD] = end
+
+    def _wakeup(self):
+        for sub in self._subscribers:
+            try:
+                sub._wakeup.release()
+            except ValueError:   # already signalled
+                pass
+
+    def put(self, val):
+        if self._codec and isinstance(val, scitags.FlowID):
+            self._put_frame(self._codec.encode_batch((val,)), _KIND_ENCODED, 1)
+        else:
+            self._put_frame(pickle.dumps(val, pickle.HIGHEST_PROTOCOL), events=int(isinstance(val, scitags.FlowID)))
+
+    def put_many(self, vals):
+        if not vals:
+            return
+        if self._codec:
+            data = self._codec.encode_batch(vals)
+            kind = _KIND_ENCODED
+        else:
+            data = pickle.dumps(scitags.FlowBatch(vals), pickle.HIGHEST_PROTOCOL)
+            kind = _KIND_PICKLE
+        if not self._frame_fits(data) and len(vals) > 1:
+            # split oversized batches rather than dropping them
+            self.put_many(vals[:len(vals) // 2])
+            self.put_many(vals[len(vals) // 2:])
+            return
+        self._put_frame(data, kind, len(vals))
+
+    def flush(self):
+        # nothing is held back by the producers
+        pass
+
+    def release(self):
+        pass
+
+    def close(self):
+        self._wakeup()
+
+
+class RingSubscriber(scitags.BusSubscriber):
+    def __init__(self, ring, cursor, seq, codec=None, dedup=False, shard=None, latency=None, coalesce=None):
+        super(RingSubscriber, self).__init__(codec, dedup, shard, latency, coalesce)
+        self._ring = ring
+        self._cursor = mp.RawValue(ctypes.c_uint64, cursor)
+        self._seq = mp.RawValue(ctypes.c_uint64, seq)
+        self._overruns = mp.RawValue(ctypes.c_uint64, 0)
+        self._lost = mp.RawValue(ctypes.c_uint64, 0)
+        self._wakeup = mp.BoundedSemaphore(1)
+
+    @property
+    def overruns(self):
+        return self._overruns.value
+
+    @property
+    def lost(self):
+        return self._lost.value
+
+    def depth(self):
+        return self._ring._ctl[_SEQ] - self._seq.value
+
+    def _overrun(self, tail):
+        log.warning('event bus subscriber overrun, skipping to oldest available event')
+        self._overruns.value += 1
+        self._cursor.value = tail
+
+    def _read_frame(self):
+        ring = self._ring
+        size = ring._size
+        ctl = ring._ctl
+        while True:
+            pos = self._cursor.value
+            if pos == ctl[_HEAD]:
+                return None, None
+            tail = ctl[_TAIL]
+            if pos < tail:
+                self._overrun(tail)
+                continue
+            off = pos % size
+            if size - off < _FRAME_HDR.size:
+                self._cursor.value = pos + size - off
+                continue
+            length, kind, seq = _FRAME_HDR.unpack_from(ring._mm, off)
+            if length == _WRAP:
+                data = None
+                n = size - off
+            elif off + _FRAME_HDR.size + length <= size:
+                data = ring._mm[off + _FRAME_HDR.size:off + _FRAME_HDR.size + length]
+                n = _FRAME_HDR.size + length
+            else:
+                data = None
+                n = 0
+            # writer might have overwritten the frame while it was being copied
+            if ctl[_RESERVE] > pos + size or n == 0:
+                self._overrun(ctl[_TAIL])
+                continue
+            self._cursor.value = pos + n
+            if data is None:
+                continue
+            if seq != self._seq.value:
+                self._lost.value += seq - self._seq.value
+            self._seq.value = seq + 1
+            return kind, data
+
+    def _get_frame(self, block, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            kind, data = self._read_frame()
+            if kind == _KIND_ENCODED:
+                return data
+            elif data is not None:
+                return pickle.loads(data)
+            if not block:
+                raise queue.Empty
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise queue.Empty
+            self._wakeup.acquire(True, remaining)
@@ -1,4 +1,6 @@
+import ctypes
 import datetime
+import ipaddress
 import logging
 import importlib
 import os
@@ -11,38 +13,192 @@ try:
 except ImportError:
     import Queue as queue
 import signal
-import requests
-import json
+import threading
+import time
 
 import scitags
 import scitags.settings
 import scitags.plugins
 import scitags.backends
-import scitags.stun.services
+import scitags.ring
+import scitags.codec
+import scitags.supervisor
+import scitags.flowmap
+import scitags.config
+import scitags.startup
+import scitags.latency
+import scitags.metrics
+import scitags.profiling
+import scitags.logs
+import scitags.udp
 from scitags.config import config
 
 log = logging.getLogger('scitags')
 
 
+# Publishing side of the event bus as seen by a plugin, counts the events it sends (and polls it reports);
+# config updates sent to the plugin are applied when it publishes (i.e. once per poll);
+# with stamp events are stamped with the time they were detected (by default when they're
+# published, plugins pass the time of their poll) and enqueued (see scitags.latency);
+# plugins that only publish when they get an event call flush periodically, so that events held back
+# by the overload policy are sent once there is room (polling plugins publish on every poll)
+class PluginPublisher(object):
+    def __init__(self, bus, name, stamp=False):
+        self.name = name
+        self.events = mp.RawValue(ctypes.c_uint64, 0)
+        self.last_events = 0
+        self.polls = mp.RawValue(ctypes.c_uint64, 0)
+        self.poll_duration = mp.RawValue(ctypes.c_double, 0)
+        self.poll_sockets = mp.RawValue(ctypes.c_uint64, 0)
+        self._bus = bus
+        self._lock = threading.Lock()   # plugins can publish from several threads
+        self._stamp = stamp
+        self._control = mp.Queue()
+        self._config_version = mp.RawValue(ctypes.c_uint64, 0)
+        self._applied_version = 0
+
+    def send_config(self, update):
+        self._control.put(update)
+        self._config_version.value = update.version
+
+    def _check_config(self):
+        if self._config_version.value == self._applied_version:
+            return
+        while True:
+            try:
+                update = self._control.get(block=False)
+            except queue.Empty:
+                break
+            scitags.config.apply_update(update)
+            self._applied_version = update.version
+
+    def polled(self, duration, sockets):
+        # called by polling plugins after each cycle with its duration and number of sockets seen
+        self.polls.value += 1
+        self.poll_duration.value = duration
+        self.poll_sockets.value = sockets
+
+    @staticmethod
+    def stamp(vals, detected=None):
+        now = time.monotonic()
+        stamps = (now if detected is None else detected, now)
+        return [val._replace(stamps=stamps) if isinstance(val, scitags.FlowID) else val for val in vals]
+
+    def put(self, val, detected=None):
+        self._check_config()
+        if self._stamp:
+            val = self.stamp((val,), detected)[0]
+        with self._lock:
+            self._bus.put(val)
+        self.events.value += 1
+
+    def put_many(self, vals, detected=None):
+        self._check_config()
+        if self._stamp and vals:
+            vals = self.stamp(vals, detected)
+        with self._lock:
+            self._bus.put_many(vals)
+        self.events.value += len(vals)
+
+    def flush(self):
+        self._check_config()
+        with self._lock:
+            self._bus.flush()
+
+    def close(self):
+        with self._lock:
+            self._bus.release()
+
+
+def run_plugin(run, pub, term_event, ip_config):
+    # events still held back when the plugin stops are sent if possible, the rest is counted as dropped
+    try:
+        run(pub, term_event, ip_config)
+    finally:
+        pub.close()
+
+
 class FlowService(object):
-    def __init__(self, args):
+    def __init__(self, args, startup=None):
+        self.startup = startup if startup else scitags.startup.StartupProfile()
         self.backend = config.get('BACKEND', scitags.settings.DEFAULT_BACKEND)
         if ',' in self.backend:
             self.backend = [x.strip() for x in self.backend.split(',')]
         else:
             self.backend = (self.backend,)
         self.backend_mod = list()
-        self.backend_proc = list()
         self.plugin = config.get('PLUGIN')
-        self.plugin_mod = None
-        self.plugin_proc = None
+        if ',' in self.plugin:
+            self.plugin = [x.strip() for x in self.plugin.split(',')]
+        else:
+            self.plugin = (self.plugin,)
+        self.plugin_mod = list()
+        self.plugin_pub = list()
+        self.backend_sub = list()
+        self.last_drops = dict()
+        self.last_lost = dict()
         if args.debug or args.fg:
             self.debug = True
         else:
             self.debug = False
         #self.flow_id_queue = mp.Queue()
-        self.flow_id_bus = scitags.PubSubQueue()
-        self.term_event = mp.Event()
+        bus = config.get('EVENT_BUS', scitags.settings.EVENT_BUS)
+        codec = config.get('EVENT_BUS_CODEC', scitags.settings.EVENT_BUS_CODEC)
+        if codec == 'binary':
+            codec = scitags.codec
+        elif codec == 'pickle':
+            codec = None
+        else:
+            log.error('Unknown EVENT_BUS_CODEC {}, expected pickle or binary'.format(codec))
+            sys.exit(1)
+        # flows reported by more than one plugin are de-duplicated on the backend side, a specific tag
+        # replaces the catch-all tag of the plugins that report all connections (see FlowDedup)
+        dedup = (self.catch_all_tags() or True) if len(self.plugin) > 1 else False
+        self.latency = config.get('LATENCY_STATS', scitags.settings.LATENCY_STATS)
+        policy = config.get('EVENT_BUS_POLICY', scitags.settings.EVENT_BUS_POLICY)
+        block_timeout = config.get('EVENT_BUS_BLOCK_TIMEOUT', scitags.settings.EVENT_BUS_BLOCK_TIMEOUT)
+        # short flows are coalesced (or suppressed) by the backends' subscriptions
+        coalesce = (config.get('FLOW_COALESCE_WINDOW', scitags.settings.FLOW_COALESCE_WINDOW),
+                    config.get('FLOW_MIN_LIFETIME', scitags.settings.FLOW_MIN_LIFETIME))
+        if not any(coalesce):
+            coalesce = None
+        self.runtime = config.get('RUNTIME', scitags.settings.RUNTIME)
+        if self.runtime not in ('process', 'asyncio'):
+            log.error('Unknown RUNTIME {}, expected process or asyncio'.format(self.runtime))
+            sys.exit(1)
+        try:
+            if self.runtime == 'asyncio':
+                # plugins and backends run in this process, events are passed over in-process queues
+                self.aio = importlib.import_module('scitags.aio')
+                self.flow_id_bus = self.aio.ThreadQueue(dedup, self.latency,
+                                                        config.get('EVENT_BUS_CAPACITY',
+                                                                   scitags.settings.EVENT_BUS_CAPACITY), policy,
+                                                        coalesce, block_timeout)
+            elif bus == 'ring':
+                self.flow_id_bus = scitags.ring.RingBufferQueue(config.get('EVENT_BUS_SIZE',
+                                                                           scitags.settings.EVENT_BUS_SIZE),
+                                                                codec, dedup, self.latency, policy, coalesce,
+                                                                block_timeout)
+            elif bus == 'queue':
+                self.flow_id_bus = scitags.PubSubQueue(codec, dedup, self.latency,
+                                                       config.get('EVENT_BUS_CAPACITY',
+                                                                  scitags.settings.EVENT_BUS_CAPACITY), policy,
+                                                       coalesce, block_timeout)
+            else:
+                log.error('Unknown EVENT_BUS {}, expected queue or ring'.format(bus))
+                sys.exit(1)
+        except scitags.FlowConfigException as e:
+            log.error(e)
+            sys.exit(1)
+        # plugins are stopped by term_event, backends by backend_term_event once they've drained the bus
+        if self.runtime == 'asyncio':
+            self.term_event = threading.Event()
+            self.backend_term_event = threading.Event()
+            self.supervisor = self.aio.TaskSupervisor(self.term_event)
+        else:
+            self.term_event = mp.Event()
+            self.backend_term_event = mp.Event()
+            self.supervisor = scitags.supervisor.Supervisor(self.term_event)
 
         header = list()
         header.append("Flow and Packet Marking Service (scitags.org)")
@@ -54,83 +210,121 @@ class FlowService(object):
             log.info('* {0:<{1}s} *'.format(line, l_max))
         log.info('*' * (l_max + 4))
 
-        if 'IP_DISCOVERY_ENABLED' in config.keys() and config['IP_DISCOVERY_ENABLED']:
-            try:
-                eip4, iip4, eip6, iip6 = scitags.stun.services.get_ext_ip()
-                log.info('network info:')
-                log.info('              {}/{}'.format(iip4, eip4))
-                log.info('              {}/{}'.format(iip6, eip6))
-                self.ip_config = scitags.IPConfig(eip4, iip4, eip6, iip6)
-            except Exception as e:
-                log.exception(e)
-                sys.exit(1)
-        else:
-            self.ip_config = None
+        with self.startup.phase('ip discovery'):
+            if 'IP_DISCOVERY_ENABLED' in config.keys() and config['IP_DISCOVERY_ENABLED']:
+                try:
+                    eip4, iip4, eip6, iip6 = importlib.import_module('scitags.stun.services').get_ext_ip()
+                    log.info('network info:')
+                    log.info('              {}/{}'.format(iip4, eip4))
+                    log.info('              {}/{}'.format(iip6, eip6))
+                    self.ip_config = scitags.IPConfig(eip4, iip4, eip6, iip6)
+                except Exception as e:
+                    log.exception(e)
+                    sys.exit(1)
+            else:
+                self.ip_config = None
 
-        flow_api = requests.get(config['FLOW_MAP_API'], verify=False)
-        if flow_api.status_code != 200:
-            log.error('Failed to access FLOW MAP API at {} got {}'.format(config.FLOW_MAP_API, flow_api.status_code))
-            sys.exit(1)
-        try:
-            # self.flow_map stores flow_id lookup dict; e.g.
-            # 'experiments': {u'atlas': 16, ..}
-            # 'activities': {16: {u'rebalancing': 16, u'production': 14}, etc.
-            self.flow_map = dict()
-            flow_map_raw = json.loads(flow_api.content)
-            self.flow_map['experiments'] = dict()
-            self.flow_map['activities'] = dict()
-            for exp in flow_map_raw['experiments']:
-                self.flow_map['experiments'][exp['expName']] = exp['expId']
-                self.flow_map['activities'][exp['expId']] = dict()
-                for act in exp['activities']:
-                    self.flow_map['activities'][exp['expId']][act['activityName']] = act['activityId']
-            log.debug('flow map loaded')
+        # flow map is taken from the on-disk cache if available and refreshed in the background,
+        # registry is only queried at startup if there is no usable cache
+        with self.startup.phase('flow map'):
+            cache_path = os.path.join(scitags.settings.WORK_DIR, scitags.settings.FLOW_MAP_CACHE)
+            timeout = config.get('FLOW_MAP_TIMEOUT', scitags.settings.FLOW_MAP_TIMEOUT)
+            entry = scitags.flowmap.load_cache(cache_path)
+            if entry:
+                self.flow_map = scitags.flowmap.parse(entry['raw'])
+                log.info('flow map registry loaded from cache {}'.format(cache_path))
+            else:
+                try:
+                    entry = scitags.flowmap.fetch(config['FLOW_MAP_API'], timeout=timeout)
+                    self.flow_map = scitags.flowmap.parse(entry['raw'])
+                except Exception as e:
+                    log.exception('Failed to load FLOW MAP API')
+                    sys.exit(1)
+                scitags.flowmap.save_cache(cache_path, entry)
+                log.info('flow map registry loaded')
             log.debug(self.flow_map)
-        except Exception as e:
-            log.exception('Failed to parse FLOW MAP API')
-            sys.exit(1)
-        log.info('flow map registry loaded')
+        self.flow_map_refresher = scitags.flowmap.FlowMapRefresher(
+            config['FLOW_MAP_API'], self.flow_map, entry, cache_path,
+            config.get('FLOW_MAP_REFRESH', scitags.settings.FLOW_MAP_REFRESH), timeout,
+            on_update=self.publish_flow_map)
+        metrics_socket = config.get('METRICS_SOCKET', scitags.settings.METRICS_SOCKET)
+        self.metrics = scitags.metrics.MetricsServer(
+            self, os.path.join(scitags.settings.WORK_DIR, metrics_socket) if metrics_socket else None,
+            config.get('METRICS_PORT', scitags.settings.METRICS_PORT),
+            config.get('METRICS_HOST', scitags.settings.METRICS_HOST))
+        self.flow_map_version = 0
+        self.config_version = 0
+        self.removed_keys = set()
+        self.reload_requested = False
+        self.last_report = time.time()
+        self.log_listener = None
 
-    def check_config(self):
-        if 'netstat' in config['PLUGIN'] and 'NETSTAT_EXPERIMENT' not in config.keys() and \
-                'NETSTAT_ACTIVITY' not in config.keys():
-            log.error("NETSTAT: netstat plugin requires EXPERIMENT and ACTIVITY")
-            sys.exit(-1)
-        if 'UDP_FIREFLY_NETLINK' in config.keys() and config['UDP_FIREFLY_NETLINK']:
+    @staticmethod
+    def validate_config(cfg):
+        if 'FLOW_MAP_API' not in cfg.keys():
+            raise scitags.FlowConfigException('FLOW_MAP_API is required')
+        if 'netstat' in cfg.get('PLUGIN', '') and 'NETSTAT_EXPERIMENT' not in cfg.keys() and \
+                'NETSTAT_ACTIVITY' not in cfg.keys():
+            raise scitags.FlowConfigException('NETSTAT: netstat plugin requires EXPERIMENT and ACTIVITY')
+        for key in ('NETSTAT_INTERNAL_NETWORKS', 'NETLINK_INTERNAL_NETWORKS'):
+            for net in cfg.get(key, ()):
+                try:
+                    ipaddress.ip_network(u'{}'.format(net))
+                except ValueError:
+                    raise scitags.FlowConfigException('{}: unable to parse network {}'.format(key, net))
+        if cfg.get('UDP_FIREFLY_DST'):
+            scitags.udp.parse_collectors(cfg['UDP_FIREFLY_DST'], scitags.settings.UDP_FIREFLY_PORT)
+        if 'UDP_FIREFLY_NETLINK' in cfg.keys() and cfg['UDP_FIREFLY_NETLINK']:
             try:
                 import pyroute2.netlink.diag
                 import scitags.netlink
             except ImportError as e:
-                log.error('UDP_FIREFLY_NETLINK: import error, please check if netlink plugin package is installed')
-                log.exception(e)
-                sys.exit(-1)
+                raise scitags.FlowConfigException('UDP_FIREFLY_NETLINK: import error ({}), please check if netlink '
+                                                  'plugin package is installed'.format(e))
 
-    def init_plugins(self):
-        log.debug("    Loading plugin {}".format(self.plugin))
+    def catch_all_tags(self):
+        # (experiment, activity) the plugins that report every connection tag them with (<PLUGIN>_EXPERIMENT/ACTIVITY)
+        tags = list()
+        for plugin in self.plugin:
+            key = plugin.upper() + '_EXPERIMENT'
+            if key in config.keys():
+                tags.append((config[key], config.get(plugin.upper() + '_ACTIVITY')))
+        return tuple(tags)
+
+    def check_config(self):
         try:
-            default_pkg = os.path.dirname(scitags.plugins.__file__)
-            if self.plugin in [name for _, name, _ in pkgutil.iter_modules([default_pkg])]:
-                if sys.version_info[0] < 3:
-                    self.plugin_mod = __import__("scitags.plugins.{}".format(self.plugin), globals(), locals(),
-                                                 [self.plugin])
+            self.validate_config(config)
+        except scitags.FlowConfigException as e:
+            log.error(e)
+            sys.exit(-1)
+
+    def init_plugins(self):
+        for plugin in self.plugin:
+            log.debug("    Loading plugin {}".format(plugin))
+            try:
+                default_pkg = os.path.dirname(scitags.plugins.__file__)
+                if plugin in [name for _, name, _ in pkgutil.iter_modules([default_pkg])]:
+                    if sys.version_info[0] < 3:
+                        plugin_mod = __import__("scitags.plugins.{}".format(plugin), globals(), locals(), [plugin])
+                    else:
+                        plugin_mod = importlib.import_module("scitags.plugins.{}".format(plugin))
                 else:
-                    self.plugin_mod = importlib.import_module("scitags.plugins.{}".format(self.plugin))
-            else:
-                log.error("Configured plugin not found")
-                return False
-        except ImportError as e:
-            log.exception(e)
-            log.error("Exception caught {} while loading plugin {}".format(e, self.plugin))
-            sys.exit(1)
+                    log.error("Configured plugin {} not found".format(plugin))
+                    sys.exit(1)
+            except ImportError as e:
+                log.exception(e)
+                log.error("Exception caught {} while loading plugin {}".format(e, plugin))
+                sys.exit(1)
 
-        try:
-            log.debug("    Calling plugin init: {}".format(self.plugin))
-            self.plugin_mod.init()
-        except Exception as e:
-            log.exception(e)
-            log.error("Exception was thrown while initialing plugin {} ({})".format(self.plugin, e))
-            sys.exit(1)
-        log.info('plugin loaded: {}'.format(self.plugin))
+            try:
+                log.debug("    Calling plugin init: {}".format(plugin))
+                plugin_mod.init()
+            except Exception as e:
+                log.exception(e)
+                log.error("Exception was thrown while initialing plugin {} ({})".format(plugin, e))
+                sys.exit(1)
+            self.plugin_mod.append(plugin_mod)
+            log.info('plugin loaded: {}'.format(plugin))
 
         for backend in self.backend:
             log.debug("    Loading backend {}".format(backend))
@@ -150,10 +344,42 @@ class FlowService(object):
                 sys.exit(1)
             log.info('backend loaded: {}'.format(backend))
 
+    def drain(self, timeout):
+        # two-phase shutdown: plugins are stopped first, then the backends get what's left of timeout
+        # to process the events still on the bus before they're stopped; returns the number of events
+        # emitted by the backends meanwhile and of events left on the bus (frames with the ring bus)
+        deadline = time.time() + timeout
+        self.term_event.set()
+        self.supervisor.join(timeout, role='plugin')
+        emitted = dict((name, sub.counters[scitags.EVENTS_OUT]) for name, sub in self.backend_sub)
+        self.flow_id_bus.put(scitags.DrainRequest())
+        alive = set(sp.name for sp in self.supervisor.processes if sp.role == 'backend' and sp.is_alive())
+        draining = [(name, sub) for name, sub in self.backend_sub if name in alive]
+        while draining and time.time() < deadline:
+            time.sleep(0.01)
+            draining = [(name, sub) for name, sub in draining if sub.drain_state.value != scitags.DRAINED]
+        self.backend_term_event.set()
+        flushed = sum(sub.counters[scitags.EVENTS_OUT] - emitted[name] for name, sub in self.backend_sub)
+        dropped = 0
+        for name, sub in self.backend_sub:
+            if sub.drain_state.value == scitags.DRAINED:
+                continue
+            depth = sub.depth() or 0
+            if sub.drain_state.value == scitags.DRAIN_NONE:
+                # DrainRequest itself is still queued
+                depth = max(depth - 1, 0)
+            if depth:
+                log.warning('backend {}: not drained in {}s, {} events left on the bus'.format(name, timeout, depth))
+            dropped += depth
+        return flushed, dropped
+
     def cleanup(self, sig, frame):
         log.info('caught signal {}'.format(sig))
-        self.term_event.set()
+        self.flow_map_refresher.stop()
+        self.metrics.stop()
 
+        flushed, dropped = self.drain(config.get('SHUTDOWN_DRAIN_TIMEOUT', scitags.settings.SHUTDOWN_DRAIN_TIMEOUT))
+        log.info('shutdown: {} events flushed, {} dropped'.format(flushed, dropped))
         self.flow_id_bus.close()
         #while True:
         #    try:
@@ -165,54 +391,180 @@ class FlowService(object):
         #self.flow_id_queue.close()
         #self.flow_id_queue.join_thread()
 
-        if self.plugin_proc and self.plugin_proc.is_alive():
-            self.plugin_proc.join(5)
-
-        for bpi in self.backend_proc:
-            if bpi and bpi.is_alive():
-                bpi.join(5)
-
-        # wait -> if self.plugin_proc.is_alive()
-        # self.plugin_proc.terminate()
-        if sys.version_info[0] < 3:
-            pass
-        else:
-            self.plugin_proc.close()
-            for bpi in self.backend_proc:
-                bpi.close()
+        self.supervisor.join(5)
+        self.supervisor.close()
+        if self.log_listener:
+            self.log_listener.stop()
         if os.path.isfile(scitags.settings.PID_FILE):
             os.remove(scitags.settings.PID_FILE)
         log.info('cleanup done')
 
-    @staticmethod
-    def reload_config():
-        if sys.version_info[0] < 3:
-            reload(scitags.config)
-        else:
-            importlib.reload(scitags.config)
+    def request_reload(self, sig, frame):
+        # reload is done from the watch loop, not in the signal handler
+        log.info('caught signal {}, reloading config'.format(sig))
+        self.reload_requested = True
+
+    def reload_config(self):
+        # re-reads and validates the config, changes are applied in place in every process so that
+        # plugins and backends keep their flow state; keys in STATIC_KEYS still require a restart
+        try:
+            new_config = scitags.config.load(scitags.settings.CONFIG_PATH)
+            self.validate_config(new_config)
+        except Exception as e:
+            log.error('Config reload failed, keeping current config: {}'.format(e))
+            return False
+        changed, removed = scitags.config.delta(config, new_config)
+        for k in scitags.config.STATIC_KEYS:
+            if k in changed or k in removed:
+                log.warning('Config reload: change of {} requires restart, ignoring it'.format(k))
+                changed.pop(k, None)
+                if k in removed:
+                    removed.remove(k)
+        if not changed and not removed:
+            log.info('Config reload: no changes')
+            return False
+        self.config_version += 1
+        self.removed_keys.update(removed)
+        self.removed_keys.difference_update(changed)
+        update = scitags.ConfigUpdate(self.config_version, changed, removed)
+        scitags.config.apply_update(update)
+        if self.runtime == 'process':
+            # with the asyncio runtime plugins and backends share the config of this process
+            self.flow_id_bus.put(update)
+            for pub in self.plugin_pub:
+                pub.send_config(update)
+        self.flow_map_refresher.url = config['FLOW_MAP_API']
+        self.flow_map_refresher.interval = config.get('FLOW_MAP_REFRESH', scitags.settings.FLOW_MAP_REFRESH)
+        self.flow_map_refresher.timeout = config.get('FLOW_MAP_TIMEOUT', scitags.settings.FLOW_MAP_TIMEOUT)
+        log.info('Config reload: changed {}, removed {}'.format(sorted(changed.keys()), sorted(removed)))
+        return True
+
+    def publish_flow_map(self, flow_map):
+        # running backends get the new map over the bus, restarted ones start with the updated self.flow_map
+        self.flow_map_version += 1
+        self.flow_id_bus.put(scitags.FlowMapUpdate(self.flow_map_version, dict(flow_map)))
+        log.info('flow map version {} sent to backends'.format(self.flow_map_version))
+
+    def resync_backends(self):
+        # a drop-oldest overrun of the ring buffer (see scitags.ring) can skip config and flow map updates as well,
+        # backends that lost events get the current versions again, the others skip them as already seen
+        for name, sub in self.backend_sub:
+            lost = getattr(sub, 'lost', 0)
+            if lost == self.last_lost.get(name, 0):
+                continue
+            self.last_lost[name] = lost
+            if self.runtime == 'process' and sub.config_version.value < self.config_version:
+                log.warning('backend {}: config updates lost, re-sending version {}'.format(name, self.config_version))
+                self.flow_id_bus.put(scitags.ConfigUpdate(self.config_version, dict(config), sorted(self.removed_keys)))
+            if sub.flow_map_version.value < self.flow_map_version:
+                log.warning('backend {}: flow map updates lost, re-sending version {}'.format(
+                    name, self.flow_map_version))
+                self.flow_id_bus.put(scitags.FlowMapUpdate(self.flow_map_version, dict(self.flow_map)))
+
+    def report_plugin_stats(self, interval):
+        for pub in self.plugin_pub:
+            events = pub.events.value
+            log.info('plugin {}: {:.2f} events/s'.format(pub.name, (events - pub.last_events) / interval))
+            pub.last_events = events
+
+    def report_latency(self):
+        # per-stage p50/p99 of the events emitted by each backend since the last report
+        for name, sub in self.backend_sub:
+            if not sub.latency:
+                continue
+            stats = sub.latency.interval()
+            if not stats['total'][0]:
+                continue
+            stages = list()
+            for stage in scitags.latency.STAGES:
+                count, (p50, p99) = stats[stage]
+                if count:
+                    stages.append('{} {:.2f}/{:.2f}'.format(stage, p50 * 1000, p99 * 1000))
+            stages = ', '.join(stages)
+            log.info('backend {}: latency p50/p99 ms: {} ({} events)'.format(name, stages, stats['total'][0]))
+
+    def report_drops(self):
+        # events dropped/cancelled by the event bus overload policy since the last report
+        for name, sub in self.backend_sub:
+            drops = (sub.counters[scitags.EVENTS_DROPPED], sub.counters[scitags.EVENTS_CANCELLED])
+            last = self.last_drops.get(name, (0, 0))
+            if drops != last:
+                log.warning('backend {}: event bus overloaded, {} events dropped, {} cancelled'.format(
+                    name, drops[0] - last[0], drops[1] - last[1]))
+            self.last_drops[name] = drops
+
+    def tick(self):
+        # reloads config if requested, restarts crashed plugins/backends and logs events/s per plugin
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload_config()
+        self.supervisor.check()
+        self.resync_backends()
+        now = time.time()
+        if now - self.last_report >= config.get('PLUGIN_STATS_INTERVAL', scitags.settings.PLUGIN_STATS_INTERVAL):
+            self.report_plugin_stats(now - self.last_report)
+            self.report_latency()
+            self.report_drops()
+            self.last_report = now
+
+    def watch(self):
+        # runs tick() every SUPERVISOR_INTERVAL until terminated
+        self.last_report = time.time()
+        if self.runtime == 'asyncio':
+            self.supervisor.run(scitags.settings.SUPERVISOR_INTERVAL, self.tick)
+            return
+        # sleep rather than term_event.wait(): cleanup() sets term_event from the signal handler on this thread
+        # and multiprocessing Event.set() blocks until the waiters wake up
+        while not self.term_event.is_set():
+            time.sleep(scitags.settings.SUPERVISOR_INTERVAL)
+            if self.term_event.is_set():
+                break
+            self.tick()
 
     def main(self):
         # 1. create queue and process pool for backend
-        # 2. create process or pool for plugin
-        # 3. watch plugin and backend pools until they finish
+        # 2. create process for each plugin
+        # 3. watch plugin and backend processes, restart them if they fail
         log.info('entering main loop')
-        for bm in self.backend_mod:
-            bpi = mp.Process(target=bm.run, args=(self.flow_id_bus.register(), self.term_event, self.flow_map, self.ip_config))
-            bpi.daemon = True
-            self.backend_proc.append(bpi)
-        self.plugin_proc = mp.Process(target=self.plugin_mod.run,
-                                      args=(self.flow_id_bus, self.term_event, self.ip_config))
-        self.plugin_proc.daemon = True
+        for backend, bm in zip(self.backend, self.backend_mod):
+            # backends can run as a pool of workers, each handling its own shard of the flows
+            workers = bm.pool_size() if hasattr(bm, 'pool_size') else 1
+            if workers > 1 and self.runtime == 'asyncio':
+                log.warning('backend {}: worker pool is not available with RUNTIME asyncio, using one worker'.format(
+                    backend))
+                workers = 1
+            if workers > 1:
+                subscribers = self.flow_id_bus.register_shards(workers)
+                log.info('backend {}: starting {} workers'.format(backend, workers))
+            else:
+                subscribers = [self.flow_id_bus.register()]
+            for i, sub in enumerate(subscribers):
+                name = '{}-{}'.format(backend, i) if workers > 1 else backend
+                self.backend_sub.append((name, sub))
+                # restarted backend takes over the same subscription, events queued meanwhile are kept
+                self.supervisor.add(name, 'backend', bm.run,
+                                    (sub, self.backend_term_event, self.flow_map, self.ip_config),
+                                    on_restart=sub.reattach)
+        for plugin, pm in zip(self.plugin, self.plugin_mod):
+            pub = PluginPublisher(self.flow_id_bus, plugin, self.latency)
+            self.plugin_pub.append(pub)
+            self.supervisor.add(plugin, 'plugin', run_plugin, (pm.run, pub, self.term_event, self.ip_config))
 
         try:
-            for bpi in self.backend_proc:
-                bpi.start()
-            self.plugin_proc.start()
+            if self.runtime == 'process' and config.get('LOG_QUEUE', scitags.settings.LOG_QUEUE):
+                # plugins and backends send their log records to a single writer thread in this process
+                self.log_listener = scitags.logs.start(log)
+            with self.startup.phase('spawn'):
+                self.supervisor.start()
+            self.startup.report()
+            self.flow_map_refresher.start()
+            self.metrics.start()
 
             signal.signal(signal.SIGINT, self.cleanup)
             signal.signal(signal.SIGTERM, self.cleanup)
-            self.plugin_proc.join()
+            signal.signal(signal.SIGHUP, self.request_reload)
+            scitags.profiling.install('service', 'service')
+            self.watch()
         except Exception as e:
             log.exception('Exception caught in main')
         log.info('flowd terminated')
-
@@ -4,6 +4,13 @@ WORK_DIR = '/var/cache/flowd'
 DEFAULT_BACKEND = 'udp_firefly'
 NP_API_FILE = '/var/run/flowd'
 UDP_FIREFLY_PORT = 10514
+UDP_FIREFLY_WORKERS = 1
+UDP_FIREFLY_SEND_QUEUE = 10000
+UDP_FIREFLY_SNDBUF = 0
+UDP_FIREFLY_DNS_TTL = 300
+UDP_FIREFLY_DNS_NEGATIVE_TTL = 30
+UDP_FIREFLY_UPDATE_INTERVAL = 0
+UDP_FIREFLY_UPDATE_MAX_AGE = 86400
 IP4_DISCOVERY = ('10.255.255.255', 1)
 IP6_DISCOVERY = ('fc00::', 1)
 STUN_SERVERS = [('stun.l.google.com', 19305), ('stun.services.mozilla.org', 3478)]
@@ -13,3 +20,34 @@ FIREFLY_LISTENER_PORT = 10514
 NETLINK_TIMEOUT = 2
 PROMETHEUS_SRV_PORT = 9000
 SS_PATH = '/usr/sbin/ss'
+EVENT_BUS = 'queue'
+EVENT_BUS_SIZE = 16 * 1024 * 1024
+EVENT_BATCH_SIZE = 512
+EVENT_BUS_CODEC = 'pickle'
+EVENT_BUS_CAPACITY = 100000
+EVENT_BUS_POLICY = 'drop-oldest'
+EVENT_BUS_BLOCK_TIMEOUT = 5
+FLOW_COALESCE_WINDOW = 0
+FLOW_MIN_LIFETIME = 0
+PLUGIN_STATS_INTERVAL = 60
+LOG_QUEUE = True
+LOG_EVENTS_RATE = 10
+SHUTDOWN_DRAIN_TIMEOUT = 5
+RUNTIME = 'process'
+SUPERVISOR_INTERVAL = 1
+SUPERVISOR_BACKOFF = 1
+SUPERVISOR_BACKOFF_MAX = 60
+SUPERVISOR_STABLE_TIME = 60
+PROFILE_INTERVAL = 0.01
+PROFILE_TOP = 25
+FLOW_MAP_CACHE = 'flow_map.json'
+FLOW_MAP_REFRESH = 3600
+FLOW_MAP_TIMEOUT = 10
+LATENCY_STATS = True
+METRICS_SOCKET = 'metrics.sock'
+METRICS_PORT = None
+METRICS_HOST = '127.0.0.1'
+SYNTHETIC_RATE = 100
+SYNTHETIC_LIFETIME = 10
+SYNTHETIC_INTERVAL = 0.01
+SYNTHETIC_DST = '127.0.0.1'
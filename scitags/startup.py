@@ -0,0 +1,31 @@
+import contextlib
+import logging
+import time
+
+log = logging.getLogger('scitags')
+
+
+# Per-phase timing of the daemon startup (flowd --startup-profile)
+class StartupProfile(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.monotonic()
+        self.phases = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = time.monotonic() - self.started
+        log.info('startup profile:')
+        for name, duration in self.phases:
+            log.info('    {:<14} {:>9.1f} ms'.format(name, duration * 1000))
+        log.info('    {:<14} {:>9.1f} ms'.format('other', (total - sum(d for _, d in self.phases)) * 1000))
+        log.info('    {:<14} {:>9.1f} ms'.format('total', total * 1000))
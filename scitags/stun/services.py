@@ -1,5 +1,4 @@
 import socket
-import requests
 import ipaddress
 import logging
 
@@ -40,7 +39,7 @@ def get_stun_ip():
 
 
 def get_my_ip(ip_ver=4):
-    ip = requests.get('https://api{}.my-ip.io/ip'.format(ip_ver))
+    ip = scitags.get_requests().get('https://api{}.my-ip.io/ip'.format(ip_ver))
     if ip.status_code == 200 and ip.text:
         log.debug('    MY-IP: {}'.format(ip.text))
         return ip.text
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import signal
+import time
+import multiprocessing as mp
+
+import scitags.settings
+import scitags.profiling
+import scitags.logs
+
+log = logging.getLogger('scitags')
+
+
+def exit_reason(exitcode):
+    if exitcode is None:
+        return None
+    if exitcode < 0:
+        try:
+            return 'killed by {}'.format(signal.Signals(-exitcode).name)
+        except ValueError:
+            return 'killed by signal {}'.format(-exitcode)
+    return 'exit code {}'.format(exitcode)
+
+
+def child_main(target, args, role, name):
+    # processes (re)started after the service installed its signal handlers must not inherit them
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # config reload is handled by the service and propagated to the children
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # SIGUSR1/SIGUSR2 - CPU profile and heap snapshot of the process
+    scitags.profiling.install(role, name)
+    scitags.logs.attach(log)
+    target(*args)
+
+
+# Plugin or backend process watched by the Supervisor
+class SupervisedProcess(object):
+    def __init__(self, name, role, target, args, on_restart=None):
+        self.name = name
+        self.role = role
+        self.target = target
+        self.args = args
+        self.on_restart = on_restart
+        self.proc = None
+        self.restarts = 0
+        self.last_exit = None
+        self.started = None
+        self.backoff = 0
+        self.restart_at = None
+
+    def start(self):
+        self.proc = mp.Process(target=child_main, args=(self.target, self.args, self.role, self.name),
+                               name=self.name)
+        self.proc.daemon = True
+        self.proc.start()
+        self.started = time.time()
+        self.restart_at = None
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.is_alive()
+
+    def status(self):
+        return {'name': self.name,
+                'role': self.role,
+                'pid': self.proc.pid if self.is_alive() else None,
+                'alive': self.is_alive(),
+                'restarts': self.restarts,
+                'last_exit': self.last_exit}
+
+
+# Watches plugin and backend processes and restarts them with exponential backoff
+class Supervisor(object):
+    def __init__(self, term_event):
+        self.term_event = term_event
+        self.processes = list()
+
+    def add(self, name, role, target, args, on_restart=None):
+        sp = SupervisedProcess(name, role, target, args, on_restart)
+        self.processes.append(sp)
+        return sp
+
+    def start(self):
+        for sp in self.processes:
+            sp.start()
+        self.write_status()
+
+    def check(self):
+        changed = False
+        now = time.time()
+        for sp in self.processes:
+            if sp.is_alive():
+                if sp.backoff and now - sp.started > scitags.settings.SUPERVISOR_STABLE_TIME:
+                    sp.backoff = 0
+                continue
+            if self.term_event.is_set():
+                return
+            if sp.restart_at is None:
+                # process just died, schedule restart
+                sp.last_exit = exit_reason(sp.proc.exitcode)
+                if sp.backoff:
+                    sp.backoff = min(sp.backoff * 2, scitags.settings.SUPERVISOR_BACKOFF_MAX)
+                else:
+                    sp.backoff = scitags.settings.SUPERVISOR_BACKOFF
+                sp.restart_at = now + sp.backoff
+                log.error('{} {} (pid {}) terminated: {}, restarting in {}s'.format(sp.role, sp.name, sp.proc.pid,
+                                                                                  sp.last_exit, sp.backoff))
+                changed = True
+            elif now >= sp.restart_at:
+                if sp.on_restart:
+                    sp.on_restart()
+                if hasattr(sp.proc, 'close'):
+                    sp.proc.close()
+                sp.start()
+                sp.restarts += 1
+                log.warning('{} {} restarted (pid {}, restarts: {}, last exit: {})'.format(
+                    sp.role, sp.name, sp.proc.pid, sp.restarts, sp.last_exit))
+                changed = True
+        if changed:
+            self.write_status()
+
+    def status(self):
+        return [sp.status() for sp in self.processes]
+
+    def write_status(self):
+        # restart counts and last exit reasons, e.g. for monitoring crash-looping backends
+        status_file = os.path.join(scitags.settings.WORK_DIR, 'processes.json')
+        try:
+            with open(status_file + '.tmp', 'w') as f:
+                json.dump({'timestamp': time.time(), 'processes': self.status()}, f, indent=2)
+            os.rename(status_file + '.tmp', status_file)
+        except (IOError, OSError) as e:
+            log.debug('Unable to write process status {}: {}'.format(status_file, e))
+
+    def join(self, timeout, role=None):
+        # waits up to timeout seconds in total for the processes (of the given role) to exit
+        deadline = time.time() + timeout
+        for sp in self.processes:
+            if sp.is_alive() and (role is None or sp.role == role):
+                sp.proc.join(max(deadline - time.time(), 0))
+
+    def close(self):
+        for sp in self.processes:
+            if sp.proc is not None and hasattr(sp.proc, 'close') and not sp.proc.is_alive():
+                sp.proc.close()
@@ -0,0 +1,60 @@
+import math
+import time
+
+
+# Hashed timer wheel, timers are kept in slots by the tick they expire at (modulo the number of slots), so
+# scheduling and cancelling are O(1) and advancing the wheel by a tick only looks at the timers in a single
+# slot, regardless of how many are pending; timers further out than a full turn of the wheel stay in their
+# slot until their tick comes. Keys are unique, scheduling a key again replaces its timer.
+class TimerWheel(object):
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self._slots = [dict() for _ in range(slots)]
+        self._timers = dict()     # key -> slot
+        self._current = int((time.monotonic() if now is None else now) / tick)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, delay, value=None, now=None):
+        # timer fires on the first tick at or after now + delay (but at least a tick from the current one)
+        now = time.monotonic() if now is None else now
+        self.cancel(key)
+        expires = max(int(math.ceil((now + delay) / self.tick)), self._current + 1)
+        slot = expires % len(self._slots)
+        self._slots[slot][key] = (expires, value)
+        self._timers[key] = slot
+
+    def cancel(self, key):
+        slot = self._timers.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+        self._timers.clear()
+
+    def advance(self, now=None):
+        # returns the (key, value) of the timers expired since the last call, after a long pause
+        # each slot is visited once at most
+        now = time.monotonic() if now is None else now
+        target = int(now / self.tick)
+        expired = list()
+        if target <= self._current:
+            return expired
+        ticks = min(target - self._current, len(self._slots))
+        for i in range(1, ticks + 1):
+            slot = self._slots[(self._current + i) % len(self._slots)]
+            if not slot:
+                continue
+            for key in [key for key, (expires, _) in slot.items() if expires <= target]:
+                expired.append((key, slot.pop(key)[1]))
+                del self._timers[key]
+        self._current = target
+        return expired
@@ -0,0 +1,533 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import scitags
+
+log = logging.getLogger('scitags')
+
+# Non-blocking batched UDP sender
+#
+# Datagrams are queued by send() (any destination, over one unconnected socket per address family) and
+# send_collectors() (fan-out to the collectors, see Collector) and written by flush(), one sendmmsg(2) call
+# per socket and batch where the C library provides it, one sendto() per datagram otherwise (and for
+# destinations given by hostname, they're resolved by sendto). Sockets are non-blocking, datagrams the kernel
+# doesn't take (EAGAIN, send buffer full) stay queued for the next flush, once more than queue_size datagrams
+# are queued the oldest ones are dropped. Datagrams sent, EAGAIN, dropped and rate limited datagrams and
+# errors are counted per destination name in scitags.DestinationCounters; failed sends are dropped and
+# reported to on_error((host, port), exception). Collector hostnames are resolved in the background
+# (see Resolver), datagrams for a collector wait in its queue until its address is known.
+
+MAX_BATCH = 1024   # UIO_MAXIOV
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.c_void_p), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+# struct mmsghdr and iovec packed with struct, padding is taken from the ctypes layout
+_MSG_HDR = '@PIPNPNi'
+_MMSG_HDR = struct.Struct('{}{}xI{}x'.format(_MSG_HDR, _MMsgHdr.msg_len.offset - struct.calcsize(_MSG_HDR),
+                                            ctypes.sizeof(_MMsgHdr) - _MMsgHdr.msg_len.offset - 4))
+_IOVEC = struct.Struct('@PN')
+
+
+def load_sendmmsg():
+    # sendmmsg from the C library or None if it's not available
+    try:
+        func = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+def sockaddr(family, host, port):
+    # struct sockaddr_in/sockaddr_in6 of a numeric address, None for hostnames (or addresses with zone index)
+    try:
+        addr = socket.inet_pton(family, host)
+    except (socket.error, ValueError):
+        return None
+    if family == socket.AF_INET:
+        return struct.pack('=H', family) + struct.pack('!H', port) + addr + b'\0' * 8
+    return struct.pack('=H', family) + struct.pack('!HI', port, 0) + addr + struct.pack('=I', 0)
+
+
+def endpoint_name(host, port):
+    return '[{}]:{}'.format(host, port) if ':' in host else '{}:{}'.format(host, port)
+
+
+def parse_collector(entry, port):
+    # Collector from a UDP_FIREFLY_DST entry: 'host', 'host:port', '[ipv6]:port', 'ipv6' or a dict
+    # with host and optionally port, rate, backup and enabled; port is the default port
+    if isinstance(entry, dict):
+        if 'host' not in entry:
+            raise scitags.FlowConfigException('UDP_FIREFLY_DST: collector {} has no host'.format(entry))
+        unknown = set(entry.keys()) - set(('host', 'port', 'rate', 'backup', 'enabled'))
+        if unknown:
+            raise scitags.FlowConfigException('UDP_FIREFLY_DST: unknown collector option(s) {}'.format(
+                ', '.join(sorted(unknown))))
+        return Collector(entry['host'], int(entry.get('port', port)), entry.get('rate', 0),
+                         entry.get('backup', False), entry.get('enabled', True))
+    if not isinstance(entry, str) or not entry:
+        raise scitags.FlowConfigException('UDP_FIREFLY_DST: unable to parse collector {!r}'.format(entry))
+    host = entry
+    if entry.startswith('['):
+        host, _, rest = entry[1:].partition(']')
+        if rest:
+            port = rest.lstrip(':')
+    elif entry.count(':') == 1:
+        host, port = entry.split(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise scitags.FlowConfigException('UDP_FIREFLY_DST: unable to parse port of {}'.format(entry))
+    return Collector(host, port)
+
+
+def parse_collectors(value, port):
+    # list of Collectors from UDP_FIREFLY_DST (a single entry or a list of them)
+    if isinstance(value, (list, tuple)):
+        return [parse_collector(entry, port) for entry in value]
+    return [parse_collector(value, port)]
+
+
+# Resolves hostnames on a background thread and caches the addresses for ttl seconds (failures for
+# negative_ttl); expired entries are refreshed in the background and used until the new result is in,
+# addresses that were resolved before are kept if the refresh fails. Numeric addresses are not looked up.
+# on_resolved(host, port, seconds, error) is called from the resolver thread after each lookup.
+class Resolver(object):
+    def __init__(self, ttl=300, negative_ttl=30, on_resolved=None, getaddrinfo=socket.getaddrinfo):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.on_resolved = on_resolved
+        self._getaddrinfo = getaddrinfo
+        self._cache = dict()   # (host, port) -> (addresses, expires, error)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @staticmethod
+    def numeric(host, port):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+            except (socket.error, ValueError):
+                continue
+            return [(family, (host, port))]
+        return None
+
+    def lookup(self, host, port):
+        # list of (family, sockaddr), None if the lookup is still in progress; raises the lookup error
+        # (socket.gaierror) while it's cached
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is None:
+            addrs = self.numeric(host, port)
+            if addrs:
+                self._cache[key] = (addrs, float('inf'), None)
+                return addrs
+        if entry is None or time.monotonic() >= entry[1]:
+            self._resolve(key)
+        if entry is None:
+            return None
+        addrs, _, error = entry
+        if error is not None:
+            raise error
+        return addrs
+
+    def _resolve(self, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='resolver')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(key)
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                break
+            host, port = key
+            start = time.monotonic()
+            error = None
+            try:
+                addrs = list()
+                for family, _, _, _, addr in self._getaddrinfo(host, port, 0, socket.SOCK_DGRAM):
+                    if (family, addr) not in addrs:
+                        addrs.append((family, addr))
+                entry = (addrs, time.monotonic() + self.ttl, None)
+            except (socket.error, OSError) as e:
+                error = e
+                old = self._cache.get(key)
+                if old and old[0]:
+                    entry = (old[0], time.monotonic() + self.negative_ttl, None)
+                else:
+                    entry = (None, time.monotonic() + self.negative_ttl, e)
+            seconds = time.monotonic() - start
+            with self._lock:
+                self._cache[key] = entry
+                self._pending.discard(key)
+            if self.on_resolved:
+                self.on_resolved(host, port, seconds, error)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+
+
+# Firefly collector with its own connected socket (so it can be IPv4 or IPv6 and ICMP errors are reported
+# back), rate limit (datagrams/s, 0 - none) and health state: after FAILURES send errors less than
+# FAILURE_WINDOW seconds apart (ICMP errors are reported by one of the next sends, so the sends in between
+# succeed) or if it can't be resolved, the collector is taken down for backoff seconds (doubled each time,
+# up to BACKOFF_MAX, reset after FAILURE_WINDOW without errors) and then tried again; after each send error
+# the next address of the collector is used (if it has several); backup collectors are only sent to while
+# none of the other collectors is up
+class Collector(object):
+    FAILURES = 3
+    FAILURE_WINDOW = 10
+    BACKOFF = 1
+    BACKOFF_MAX = 60
+
+    def __init__(self, host, port, rate=0, backup=False, enabled=True):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.backup = backup
+        self.enabled = enabled
+        self.name = endpoint_name(host, port)
+        self.sock = None
+        self.addr_index = 0
+        self.failures = 0
+        self.last_failure = None
+        self.backoff = 0
+        self.down_until = 0
+        self._tokens = rate
+        self._last = time.monotonic()
+
+    def is_up(self, now):
+        return self.enabled and now >= self.down_until
+
+    def allow(self, now):
+        # token bucket of rate datagrams/s (burst of one second)
+        if not self.rate:
+            return True
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def connect(self, addrs, sndbuf=0):
+        # addrs as returned by Resolver.lookup
+        family, addr = addrs[self.addr_index % len(addrs)]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            if sndbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+            sock.connect(addr)
+        except (socket.error, OSError):
+            sock.close()
+            raise
+        self.sock = sock
+        return sock
+
+    def failed(self, now):
+        # returns True if the collector was taken down
+        if self.last_failure is not None and now - self.last_failure > self.FAILURE_WINDOW:
+            self.failures = 0
+            self.backoff = 0
+        self.last_failure = now
+        self.failures += 1
+        if self.failures < self.FAILURES:
+            return False
+        self.take_down(now)
+        return True
+
+    def take_down(self, now):
+        self.failures = 0
+        self.backoff = min(self.backoff * 2, self.BACKOFF_MAX) if self.backoff else self.BACKOFF
+        self.down_until = now + self.backoff
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+Datagram = collections.namedtuple('Datagram', ['data', 'addr', 'sockaddr', 'slot'])
+
+
+class UDPSender(object):
+    def __init__(self, counters=None, queue_size=10000, sndbuf=0, on_error=None, use_sendmmsg=True,
+                 resolver=None):
+        self.counters = counters
+        self.queue_size = queue_size
+        self.sndbuf = sndbuf
+        self.on_error = on_error
+        self.resolver = resolver if resolver else Resolver()
+        if self.resolver.on_resolved is None:
+            self.resolver.on_resolved = self._resolved
+        self.collectors = list()
+        self._sendmmsg = load_sendmmsg() if use_sendmmsg else None
+        self._socks = dict()
+        # queues of the unconnected sockets (by address family) and of the collectors
+        self._queues = {socket.AF_INET: collections.deque(), socket.AF_INET6: collections.deque()}
+        self._slots = dict()
+        self._addrs = dict()
+
+    def _sock(self, family):
+        sock = self._socks.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            if self.sndbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            self._socks[family] = sock
+        return sock
+
+    def _slot(self, name):
+        slot = self._slots.get(name)
+        if slot is None and self.counters is not None:
+            slot = self._slots[name] = self.counters.slot(name)
+        return slot
+
+    def _count(self, slot, counter, n=1):
+        if slot is not None:
+            self.counters.count(slot, counter, n)
+
+    def _resolved(self, host, port, seconds, error):
+        # called from the resolver thread
+        name = endpoint_name(host, port)
+        slot = self._slots.get(name)
+        if slot is None or self.counters is None:
+            return
+        self.counters.count(slot, scitags.DNS_LOOKUPS)
+        self.counters.add_time(slot, seconds)
+        if error is not None:
+            self.counters.count(slot, scitags.DNS_FAILURES)
+            log.warning('Unable to resolve firefly collector {} ({})'.format(host, error))
+
+    def _set_state(self, collector, up):
+        slot = self._slot(collector.name)
+        if slot is not None:
+            self.counters.set_state(slot, up)
+
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _queue(self, key, dgram):
+        self._queues[key].append(dgram)
+        if self.pending() > self.queue_size:
+            q = max(self._queues.values(), key=len)
+            self._count(q.popleft().slot, scitags.DATAGRAMS_DROPPED)
+
+    def send(self, data, host, port, name):
+        # queues data for (host, port), name is the destination it's counted for
+        key = (host, port)
+        addr = self._addrs.get(key)
+        if addr is None:
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            if len(self._addrs) > 10000:
+                self._addrs.clear()
+            addr = self._addrs[key] = (family, sockaddr(family, host, port))
+        family, raw = addr
+        self._queue(family, Datagram(data, key, raw, self._slot(name)))
+
+    def set_collectors(self, collectors):
+        # replaces the collectors (e.g. on config reload), datagrams queued for the removed ones are dropped
+        for collector in self.collectors:
+            q = self._queues.pop(collector, None)
+            for dgram in q or ():
+                self._count(dgram.slot, scitags.DATAGRAMS_DROPPED)
+            collector.close()
+        self.collectors = list(collectors)
+        for collector in self.collectors:
+            self._queues[collector] = collections.deque()
+            self._set_state(collector, collector.enabled)
+            if collector.enabled:
+                # lookup is started right away
+                try:
+                    self.resolver.lookup(collector.host, collector.port)
+                except (socket.error, OSError):
+                    pass
+
+    def send_collectors(self, data):
+        # fans data out to the collectors that are up (and to the backup ones if none of the others is)
+        now = time.monotonic()
+        primary_up = any(c.is_up(now) for c in self.collectors if not c.backup)
+        for collector in self.collectors:
+            if collector.backup and primary_up:
+                continue
+            slot = self._slot(collector.name)
+            if not collector.is_up(now):
+                self._count(slot, scitags.DATAGRAMS_DROPPED)
+                continue
+            if not collector.allow(now):
+                self._count(slot, scitags.DATAGRAMS_RATELIMITED)
+                continue
+            # connected socket, the address is not passed to sendmmsg
+            self._queue(collector, Datagram(data, (collector.host, collector.port), b'', slot))
+
+    def flush(self):
+        # sends as much as the kernel takes without blocking, returns number of datagrams still queued
+        for key, q in list(self._queues.items()):
+            if not q:
+                continue
+            if isinstance(key, Collector):
+                self._flush_collector(key, q)
+            else:
+                self._flush(self._sock(key), q)
+        return self.pending()
+
+    def _flush_collector(self, collector, q):
+        now = time.monotonic()
+        if collector.sock is None and collector.is_up(now):
+            try:
+                addrs = self.resolver.lookup(collector.host, collector.port)
+                if addrs is None:
+                    # not resolved yet
+                    return
+                collector.connect(addrs, self.sndbuf)
+                if collector.down_until:
+                    log.info('firefly collector {} is up again'.format(collector.name))
+                    collector.down_until = 0
+                    self._set_state(collector, True)
+            except (socket.error, OSError) as e:
+                # can't be resolved or connected, taken down right away
+                self._collector_failed(collector, q, e, now, down=True)
+        if collector.sock is None:
+            return
+        self._flush(collector.sock, q, collector)
+
+    def _collector_failed(self, collector, q, e, now, down=False):
+        self._count(self._slot(collector.name), scitags.DESTINATION_ERRORS)
+        if self.on_error:
+            self.on_error((collector.host, collector.port), e)
+        if down:
+            collector.take_down(now)
+        else:
+            down = collector.failed(now)
+            # reconnected to the next address on the next flush
+            collector.addr_index += 1
+            collector.close()
+        if down:
+            log.warning('firefly collector {} is down, retrying in {}s'.format(collector.name, collector.backoff))
+            self._set_state(collector, False)
+            for dgram in q:
+                self._count(dgram.slot, scitags.DATAGRAMS_DROPPED)
+            q.clear()
+
+    def _failed(self, q, e, collector=None):
+        dgram = q.popleft()
+        self._count(dgram.slot, scitags.DATAGRAMS_DROPPED)
+        if collector:
+            self._collector_failed(collector, q, e, time.monotonic())
+        elif self.on_error:
+            self.on_error(dgram.addr, e)
+
+    def _sent(self, q, n):
+        for _ in range(n):
+            self._count(q.popleft().slot, scitags.DATAGRAMS_SENT)
+
+    def _flush(self, sock, q, collector=None):
+        while q:
+            if self._sendmmsg and q[0].sockaddr is not None:
+                batch = list()
+                for dgram in q:
+                    if dgram.sockaddr is None or len(batch) == MAX_BATCH:
+                        break
+                    batch.append(dgram)
+                n = self._send_batch(sock, batch)
+                if n > 0:
+                    self._sent(q, n)
+                    continue
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._count(q[0].slot, scitags.DATAGRAMS_EAGAIN)
+                    return
+                if err == errno.EINTR:
+                    continue
+                # sendmmsg reports the error of the first datagram only
+                self._failed(q, OSError(err, os.strerror(err)), collector)
+                if collector and collector.sock is not sock:
+                    return
+                continue
+            dgram = q[0]
+            try:
+                if collector:
+                    sock.send(dgram.data)
+                else:
+                    sock.sendto(dgram.data, dgram.addr)
+            except (BlockingIOError, InterruptedError):
+                self._count(dgram.slot, scitags.DATAGRAMS_EAGAIN)
+                return
+            except (socket.error, OSError) as e:
+                self._failed(q, e, collector)
+                if collector and collector.sock is not sock:
+                    return
+                continue
+            self._sent(q, 1)
+
+    def _send_batch(self, sock, batch):
+        # datagrams and addresses are copied to one buffer each, headers are packed with struct,
+        # which is cheaper than filling ctypes structures field by field
+        data = b''.join(dgram.data for dgram in batch)
+        names = b''.join(dgram.sockaddr for dgram in batch)
+        data_addr = ctypes.cast(data, ctypes.c_void_p).value
+        names_addr = ctypes.cast(names, ctypes.c_void_p).value if names else 0
+        iovs = bytearray(_IOVEC.size * len(batch))
+        msgs = bytearray(_MMSG_HDR.size * len(batch))
+        iovs_buf = (ctypes.c_char * len(iovs)).from_buffer(iovs)
+        msgs_buf = (ctypes.c_char * len(msgs)).from_buffer(msgs)
+        iovs_addr = ctypes.addressof(iovs_buf)
+        offset = 0
+        name_offset = 0
+        for i, dgram in enumerate(batch):
+            _IOVEC.pack_into(iovs, i * _IOVEC.size, data_addr + offset, len(dgram.data))
+            # connected sockets (collectors) have no address
+            _MMSG_HDR.pack_into(msgs, i * _MMSG_HDR.size, names_addr + name_offset if dgram.sockaddr else 0,
+                                len(dgram.sockaddr), iovs_addr + i * _IOVEC.size, 1, 0, 0, 0, 0)
+            offset += len(dgram.data)
+            name_offset += len(dgram.sockaddr)
+        return self._sendmmsg(sock.fileno(), ctypes.addressof(msgs_buf), len(batch), 0)
+
+    def close(self):
+        for sock in self._socks.values():
+            sock.close()
+        self._socks = dict()
+        for collector in self.collectors:
+            collector.close()
+        self.resolver.close()
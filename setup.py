@@ -51,7 +51,7 @@ setup(name=NAME,
       extras_requires={'ebpf': ['bcc'],
                        'netlink': ['pyroute2']},
       data_files=[
-          ('/usr/sbin', ['sbin/flowd']),
+          ('/usr/sbin', ['sbin/flowd', 'sbin/flowd-bench']),
           ('/etc/flowd', ['etc/flowd.cfg']),
           ('/usr/lib/systemd/system', ['etc/flowd.service']),
       ])
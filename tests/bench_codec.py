@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the event bus encodings: pickled scitags.FlowID vs scitags.codec
+#
+# usage: PYTHONPATH=. python tests/bench_codec.py [-n iterations]
+import argparse
+import pickle
+import timeit
+
+import scitags
+import scitags.codec
+
+NETLINK = {'src': '2001:db8::1', 'dst': '2001:db8::2', 'src_port': 43210, 'dst_port': 1094, 'inode': 123456,
+           'iface_idx': 0, 'retrans': 0, 'cong_algo': 'cubic',
+           'meminfo': {'r': 0, 'w': 0, 'f': 4096, 't': 0},
+           'tcp_info': {'state': 'established', 'pmtu': 9000, 'retrans': 0, 'ato': 40.0, 'rto': 201.0,
+                        'snd_wscale': 14, 'rcv_wscale': 14, 'snd_mss': 8948, 'snd_cwnd': 47, 'rtt': 0.361,
+                        'rttvar': 0.091, 'rcv_space': 65464, 'opts': ['ts', 'sack'], 'segs_in': 4946,
+                        'segs_out': 26162, 'bytes_acked': 1612210340, 'bytes_received': 5212,
+                        'delivery_rate': 28156559136, 'pacing_rate': 81792611416, 'min_rtt': 0.007}}
+
+EVENTS = {
+    'np_api start': scitags.FlowID('start', 'tcp', '192.168.0.1', 43210, '192.168.0.2', 1094, 2, 9,
+                                   '2024-10-14T10:11:12.123456+00:00'),
+    'netstat end': scitags.FlowID('end', 'tcp', '2001:db8::1', 43210, '2001:db8::2', 1094, 'atlas', 'production',
+                                  '2024-10-14T10:11:12.123456+00:00', '2024-10-14T11:11:12.654321+00:00'),
+    'netlink start': scitags.FlowID('start', 'tcp', '2001:db8::1', 43210, '2001:db8::2', 1094, 2, 9,
+                                    '2024-10-14T10:11:12.123456+00:00', None, NETLINK),
+}
+
+
+def bench(n):
+    print('{:<16} {:<8} {:>8} {:>12} {:>12}'.format('event', 'codec', 'bytes', 'encode us', 'decode us'))
+    for name, flow_id in EVENTS.items():
+        pickled = pickle.dumps(flow_id, pickle.HIGHEST_PROTOCOL)
+        encoded = scitags.codec.encode(flow_id)
+        assert scitags.codec.decode(encoded) == flow_id
+        results = (
+            ('pickle', len(pickled),
+             timeit.timeit(lambda: pickle.dumps(flow_id, pickle.HIGHEST_PROTOCOL), number=n),
+             timeit.timeit(lambda: pickle.loads(pickled), number=n)),
+            ('binary', len(encoded),
+             timeit.timeit(lambda: scitags.codec.encode(flow_id), number=n),
+             timeit.timeit(lambda: scitags.codec.decode(encoded), number=n)),
+        )
+        for codec, size, enc, dec in results:
+            print('{:<16} {:<8} {:>8} {:>12.2f} {:>12.2f}'.format(name, codec, size, enc / n * 1e6, dec / n * 1e6))
+
+    # bus cost per event for a batch of 100 events and 3 backends: pickle is done once per subscriber,
+    # binary encoding is done once per batch and each subscriber decodes
+    batch = [EVENTS['np_api start']._replace(src_port=i, start_time='2024-10-14T10:11:{:02d}.{:06d}+00:00'.format(
+        i % 60, i + 1)) for i in range(100)]
+    p = timeit.timeit(lambda: [pickle.loads(pickle.dumps(scitags.FlowBatch(batch), pickle.HIGHEST_PROTOCOL))
+                               for _ in range(3)], number=n // 100)
+    b = timeit.timeit(lambda: [[scitags.codec.decode(e) for e in scitags.codec.split_batch(buf)]
+                               for buf in [scitags.codec.encode_batch(batch)] * 3], number=n // 100)
+    print('batch of 100, 3 subscribers: pickle {:.2f} us/event, binary {:.2f} us/event'.format(
+        p / n * 1e6, b / n * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FlowID encoding micro-benchmark')
+    parser.add_argument('-n', type=int, default=100000, help='iterations per measurement')
+    bench(parser.parse_args().n)
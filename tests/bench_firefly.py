@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the udp_firefly payload: building the firefly as a dict + json.dumps (as udp_firefly did
+# before FireflySerializer, without netlink) vs the compiled FireflySerializer, reported as events/s on one core
+#
+# usage: PYTHONPATH=. python tests/bench_firefly.py [-n iterations]
+import argparse
+import json
+import os
+import tempfile
+import timeit
+from datetime import datetime
+
+import scitags
+import scitags.settings
+
+FLOW_MAP = {'experiments': {'atlas': 2}, 'activities': {2: {'production': 9}}}
+IP_CONFIG = scitags.IPConfig('192.0.2.1', '10.0.0.1', '2001:db8::ff', '2001:db8::1')
+
+EVENTS = {
+    'ipv4 start': scitags.FlowID('start', 'tcp', '10.0.0.1', 43210, '192.168.0.2', 1094, 'atlas', 'production',
+                                 '2024-10-14T10:11:12.123456+00:00'),
+    'ipv6 end': scitags.FlowID('end', 'tcp', '2001:db8::1', 43210, '2001:db8::2', 1094, 2, 9,
+                               '2024-10-14T10:11:12.123456+00:00', '2024-10-14T11:11:12.654321+00:00'),
+}
+
+
+def bench(n):
+    # config is read when the backend is imported
+    path = os.path.join(tempfile.mkdtemp(), 'flowd.cfg')
+    with open(path, 'w') as f:
+        f.write("PLUGIN='netstat'\nUDP_FIREFLY_IP6_SRC='2001:db8::10'\n")
+    scitags.settings.CONFIG_PATH = path
+    import scitags.backends.udp_firefly as udp_firefly
+
+    def firefly_dict(flow_id):
+        exp_id = flow_id.exp if isinstance(flow_id.exp, int) else FLOW_MAP['experiments'][flow_id.exp]
+        act_id = flow_id.act if isinstance(flow_id.act, int) else FLOW_MAP['activities'][exp_id][flow_id.act]
+        afi = 'ipv6' if ':' in flow_id.dst else 'ipv4'
+        firefly = {
+            "version": 1,
+            "flow-lifecycle": {
+                "state": flow_id.state,
+                "current-time": datetime.utcnow().isoformat() + '+00:00',
+            },
+            "flow-id": {
+                "afi": afi,
+                "src-ip": flow_id.src,
+                "dst-ip": flow_id.dst,
+                "protocol": flow_id.prot,
+                "src-port": flow_id.src_port,
+                "dst-port": flow_id.dst_port,
+            },
+            "context": {
+                "experiment-id": exp_id,
+                "activity-id": act_id,
+                "application": "flowd v{}".format(scitags.VERSION),
+            },
+        }
+        if flow_id.state in ('start', 'end'):
+            firefly['flow-lifecycle']["start-time"] = flow_id.start_time
+        if flow_id.state == 'end':
+            firefly['flow-lifecycle']["end-time"] = flow_id.end_time
+        if afi == 'ipv6' and IP_CONFIG.pub_ip6:
+            if firefly['flow-id']['src-ip'] == IP_CONFIG.int_ip6:
+                firefly['flow-id']['src-ip'] = IP_CONFIG.pub_ip6
+            if firefly['flow-id']['dst-ip'] == IP_CONFIG.int_ip6:
+                firefly['flow-id']['dst-ip'] = IP_CONFIG.pub_ip6
+        if afi == 'ipv4' and IP_CONFIG.pub_ip4:
+            if firefly['flow-id']['src-ip'] == IP_CONFIG.int_ip4:
+                firefly['flow-id']['src-ip'] = IP_CONFIG.pub_ip4
+            if firefly['flow-id']['dst-ip'] == IP_CONFIG.int_ip4:
+                firefly['flow-id']['dst-ip'] = IP_CONFIG.pub_ip4
+        if afi == 'ipv6' and 'UDP_FIREFLY_IP6_SRC' in udp_firefly.config.keys():
+            firefly['flow-id']['src-ip'] = udp_firefly.config['UDP_FIREFLY_IP6_SRC']
+        return firefly
+
+    def dict_payload(flow_id):
+        header = '<{}>{} {} {} {} {} {} {} '.format(udp_firefly.SYSLOG_PRIORITY, udp_firefly.SYSLOG_VERSION,
+                                                     datetime.utcnow().isoformat() + '+00:00',
+                                                     udp_firefly.SYSLOG_HOSTNAME, udp_firefly.SYSLOG_APP_NAME,
+                                                     udp_firefly.SYSLOG_PROCID, udp_firefly.SYSLOG_MSGID,
+                                                     udp_firefly.SYSLOG_STRUCT_DATA)
+        return header + json.dumps(firefly_dict(flow_id))
+
+    serializer = udp_firefly.FireflySerializer(FLOW_MAP, IP_CONFIG)
+    print('{:<12} {:>16} {:>16} {:>8}'.format('event', 'dict events/s', 'compiled ev/s', 'speedup'))
+    for name, flow_id in EVENTS.items():
+        before = timeit.timeit(lambda: dict_payload(flow_id), number=n)
+        after = timeit.timeit(lambda: serializer.serialize(flow_id, {}), number=n)
+        print('{:<12} {:>16.0f} {:>16.0f} {:>7.2f}x'.format(name, n / before, n / after, before / after))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='udp_firefly serializer micro-benchmark')
+    parser.add_argument('-n', type=int, default=100000, help='iterations per measurement')
+    bench(parser.parse_args().n)
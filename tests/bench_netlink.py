@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the netlink lookup done by udp_firefly (UDP_FIREFLY_NETLINK) for each start event:
+# dump of all the TCP sockets vs inet_diag exact match on the 4-tuple, reported as time per start event
+# with 1k, 10k and 100k established sockets on the host (loopback connections held by helper processes)
+#
+# usage: PYTHONPATH=. python tests/bench_netlink.py [-s 1000,10000,100000] [-n iterations] [-d dumps]
+import argparse
+import multiprocessing as mp
+import resource
+import socket
+import time
+
+import scitags.netlink.cache as cache
+
+# connections held per helper process, two sockets (and fds) each
+PAIRS_PER_PROCESS = 5000
+
+
+def hold(pairs, ready, stop):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    conns = list()
+    for _ in range(pairs):
+        c = socket.create_connection(listener.getsockname())
+        a, _ = listener.accept()
+        conns.append((c, a))
+    ready.set()
+    stop.wait()
+
+
+def per_event(lookup, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        lookup()
+    return (time.perf_counter() - start) / n
+
+
+def bench(sizes, n, dumps):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    conn = socket.create_connection(listener.getsockname())
+    peer, _ = listener.accept()
+    src, src_port = conn.getsockname()
+    dst, dst_port = conn.getpeername()
+
+    def lookup(exact):
+        cache.EXACT_LOOKUP = exact
+        netlink_cache = dict()
+        cache.netlink_cache_add('start', src, src_port, dst, dst_port, netlink_cache)
+        assert netlink_cache, 'connection not found'
+
+    stop = mp.Event()
+    helpers = list()
+    sockets = 2
+    print('{:>8} {:>16} {:>16} {:>8}'.format('sockets', 'dump ms/event', 'exact ms/event', 'speedup'))
+    try:
+        for size in sizes:
+            while sockets < size:
+                pairs = min(PAIRS_PER_PROCESS, (size - sockets + 1) // 2)
+                ready = mp.Event()
+                p = mp.Process(target=hold, args=(pairs, ready, stop))
+                p.start()
+                helpers.append(p)
+                ready.wait()
+                sockets += 2 * pairs
+            dump = per_event(lambda: lookup(False), dumps)
+            exact = per_event(lambda: lookup(True), n)
+            print('{:>8} {:>16.3f} {:>16.3f} {:>7.0f}x'.format(sockets, dump * 1000, exact * 1000, dump / exact))
+    finally:
+        stop.set()
+        for p in helpers:
+            p.join()
+        conn.close()
+        peer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='netlink lookup per start event micro-benchmark')
+    parser.add_argument('-s', default='1000,10000,100000', help='comma separated numbers of sockets')
+    parser.add_argument('-n', type=int, default=1000, help='exact lookups per measurement')
+    parser.add_argument('-d', type=int, default=3, help='dumps per measurement')
+    args = parser.parse_args()
+    bench([int(s) for s in args.s.split(',')], args.n, args.d)
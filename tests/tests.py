@@ -1,8 +1,42 @@
 import unittest
+import datetime
 import logging
+import importlib
+import json
+import os
+import signal
+import socket
 import sys
+import tempfile
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+try:
+    import pyroute2.netlink.diag
+except ImportError:
+    pyroute2 = None
 
 import scitags
+import scitags.ring
+import scitags.codec
+import scitags.settings
+import scitags.supervisor
+import scitags.flowmap
+import scitags.startup
+import scitags.latency
+import scitags.metrics
+import scitags.aio
+import scitags.profiling
+import scitags.logs
+import scitags.udp
+import scitags.timers
 import multiprocessing
 
 log = logging.getLogger("wnfm")
@@ -13,6 +47,37 @@ fh.setFormatter(formatter)
 log.addHandler(fh)
 
 
+# stand-in for FLOW_MAP_API, serves FlowMapHandler.registry and honours If-None-Match
+class FlowMapHandler(BaseHTTPRequestHandler):
+    registry = None
+    requests = list()
+
+    def do_GET(self):
+        body = json.dumps(FlowMapHandler.registry).encode()
+        etag = '"{}"'.format(hash(body))
+        FlowMapHandler.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# FlowService as seen by scitags.metrics.collect
+class ServiceStandIn(object):
+    def __init__(self):
+        self.plugin_pub = list()
+        self.backend_sub = list()
+        self.supervisor = scitags.supervisor.Supervisor(None)
+
+
 class TestScitags(unittest.TestCase):
 
     @staticmethod
@@ -21,6 +86,15 @@ class TestScitags(unittest.TestCase):
         for item in iter(q.get, None):
             assert item == flow_id
 
+    @staticmethod
+    def get_all(sub, n, max_items):
+        # mp.Queue feeder threads may deliver a batch in several chunks
+        received = list()
+        while len(received) < n:
+            batch = sub.get_batch(min(max_items, n - len(received)), timeout=1)
+            received.extend(batch)
+        return received
+
     def test_queue(self):
         queue = scitags.PubSubQueue()
         flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.1', 1, 1, 1)
@@ -36,6 +110,874 @@ class TestScitags(unittest.TestCase):
         for p in processes:
             p.join()
 
+    def test_queue_batch(self):
+        queue = scitags.PubSubQueue()
+        sub = queue.register()
+        flow_ids = [scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1) for i in range(10)]
+        queue.put_many(flow_ids[:4])
+        queue.put(flow_ids[4])
+        queue.put_many(flow_ids[5:])
+        self.assertEqual(sub.get(timeout=1), flow_ids[0])
+        batch = TestScitags.get_all(sub, 5, 5)
+        self.assertEqual(batch, flow_ids[1:6])
+        batch = TestScitags.get_all(sub, 4, 10)
+        self.assertEqual(batch, flow_ids[6:])
+
+    def test_ring_queue(self):
+        ring = scitags.ring.RingBufferQueue()
+        flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.1', 1, 1, 1)
+        processes = []
+        for _ in range(3):
+            p = multiprocessing.Process(target=TestScitags.worker, args=(ring.register(),))
+            p.start()
+            processes.append(p)
+        ring.put(flow_id)
+        ring.put(flow_id)
+        ring.put(None)  # Shut down workers
+
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+    def test_ring_queue_batch(self):
+        ring = scitags.ring.RingBufferQueue(64 * 1024)
+        sub = ring.register()
+        flow_ids = [scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1) for i in range(1000)]
+        ring.put_many(flow_ids)   # larger than frame limit, gets split
+        self.assertEqual(TestScitags.get_all(sub, len(flow_ids), 300), flow_ids)
+        self.assertEqual(sub.overruns, 0)
+
+    def test_ring_queue_overrun(self):
+        ring = scitags.ring.RingBufferQueue(64 * 1024)
+        sub = ring.register()
+        for i in range(10000):
+            ring.put(scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1))
+        ports = list()
+        while True:
+            try:
+                ports.append(sub.get(block=False).src_port)
+            except queue.Empty:
+                break
+        self.assertEqual(sub.overruns, 1)
+        self.assertEqual(sub.lost, ports[0])
+        self.assertEqual(ports, list(range(ports[0], 10000)))
+
+    def test_ring_queue_resync(self):
+        ring = scitags.ring.RingBufferQueue(64 * 1024)
+        slow = ring.register()
+        fast = ring.register()
+        update = scitags.FlowMapUpdate(1, {'experiments': {}, 'activities': {}})
+        ring.put(update)
+        self.assertEqual(fast.get(block=False), update)
+        for i in range(10000):
+            ring.put(scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1))
+        # both subscribers lost events in the overrun, only the one that lost the update gets it again
+        ring.put(update)
+        items = dict()
+        for name, sub in (('slow', slow), ('fast', fast)):
+            items[name] = list()
+            while True:
+                try:
+                    items[name].append(sub.get(block=False))
+                except queue.Empty:
+                    break
+            self.assertEqual(sub.overruns, 1)
+            self.assertEqual(sub.flow_map_version.value, 1)
+        self.assertEqual(items['slow'][-1], update)
+        self.assertEqual(items['fast'][-1].src_port, 9999)
+
+    def test_dedup(self):
+        queue = scitags.PubSubQueue(dedup=True)
+        sub = queue.register()
+        start = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.2', 2, 1, 1)
+        end = start._replace(state='end')
+        other = start._replace(src_port=3)
+        queue.put_many([start, start._replace(exp='atlas'), other])   # second plugin reports the same flow
+        queue.put_many([end, end, other._replace(state='end'), start])
+        self.assertEqual(TestScitags.get_all(sub, 5, 10), [start, other, end, other._replace(state='end'), start])
+
+        # catch-all report (netlink) seen first, specific one (np_api) replaces it, the end gets its tag
+        queue = scitags.PubSubQueue(dedup=((1, 1),))
+        sub = queue.register()
+        tagged = start._replace(exp='atlas', act='production')
+        queue.put_many([start, tagged, start, tagged, end, tagged._replace(state='end')])
+        self.assertEqual(TestScitags.get_all(sub, 3, 10), [start, tagged, tagged._replace(state='end')])
+
+    def test_reattach(self):
+        bus = scitags.PubSubQueue()
+        sub = bus.register()
+        # backend killed while blocked in get() holds the reader lock of the queue
+        reader = multiprocessing.Process(target=sub.get)
+        reader.start()
+        time.sleep(0.2)
+        reader.terminate()
+        reader.join()
+        sub.reattach()
+        flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.2', 2, 1, 1)
+        bus.put(flow_id)
+        self.assertEqual(sub.get(timeout=1), flow_id)
+        bus.close()
+
+    def test_shards(self):
+        for bus in (scitags.PubSubQueue(), scitags.ring.RingBufferQueue(codec=scitags.codec)):
+            subs = bus.register_shards(3)
+            flow_ids = [scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1) for i in range(30)]
+            flow_ids += [flow_id._replace(state='end') for flow_id in flow_ids]
+            bus.put_many(flow_ids[:30])
+            for flow_id in flow_ids[30:]:
+                bus.put(flow_id)
+            bus.put(None)   # broadcast to all shards
+            received = list()
+            for i, sub in enumerate(subs):
+                items = list()
+                while not items or items[-1] is not None:
+                    items.extend(sub.get_batch(100, timeout=1))
+                for flow_id in items[:-1]:
+                    self.assertEqual(scitags.flow_shard(flow_id, 3), i)
+                    if flow_id.state == 'end':   # per flow ordering is kept
+                        self.assertLess(items.index(flow_id._replace(state='start')), items.index(flow_id))
+                received.extend(items[:-1])
+            self.assertEqual(sorted(received), sorted(flow_ids))
+
+    @staticmethod
+    def crash(code):
+        sys.exit(code)
+
+    def test_supervisor(self):
+        backoff = scitags.settings.SUPERVISOR_BACKOFF
+        scitags.settings.SUPERVISOR_BACKOFF = 0.05
+        try:
+            term_event = multiprocessing.Event()
+            supervisor = scitags.supervisor.Supervisor(term_event)
+            sp = supervisor.add('crash', 'backend', TestScitags.crash, (3,))
+            supervisor.start()
+            deadline = time.time() + 10
+            while sp.restarts < 2 and time.time() < deadline:
+                supervisor.check()
+                time.sleep(0.01)
+            self.assertEqual(sp.restarts, 2)
+            self.assertEqual(sp.last_exit, 'exit code 3')
+            self.assertEqual(sp.backoff, 0.1)
+            term_event.set()
+            supervisor.join(1)
+        finally:
+            scitags.settings.SUPERVISOR_BACKOFF = backoff
+
+    def test_asyncio_runtime(self):
+        flow_ids = [scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1) for i in range(6)]
+        bus = scitags.aio.ThreadQueue(capacity=4, policy='drop-oldest')
+        sub = bus.register()
+        bus.put(scitags.FlowMapUpdate(1, {}))
+        for flow_id in flow_ids:
+            bus.put(flow_id)
+        # unlike with multiprocessing queues, all events still queued can be dropped, control messages are kept
+        self.assertEqual(TestScitags.get_all(sub, 4, 10), [scitags.FlowMapUpdate(1, {})] + flow_ids[3:])
+        self.assertEqual(sub.counters[scitags.EVENTS_DROPPED], 3)
+
+        received = list()
+        ticks = list()
+
+        def plugin(q, term_event):
+            if not ticks:
+                sys.exit(3)
+            q.put_many(flow_ids)
+            term_event.wait()
+
+        def backend(q, term_event):
+            while not term_event.is_set():
+                try:
+                    received.extend(q.get_batch(10, timeout=0.1))
+                except queue.Empty:
+                    continue
+                if len(received) == len(flow_ids):
+                    term_event.set()
+
+        backoff = scitags.settings.SUPERVISOR_BACKOFF
+        scitags.settings.SUPERVISOR_BACKOFF = 0.05
+        try:
+            term_event = threading.Event()
+            bus = scitags.aio.ThreadQueue()
+            supervisor = scitags.aio.TaskSupervisor(term_event)
+            supervisor.add('backend', 'backend', backend, (bus.register(), term_event))
+            st = supervisor.add('plugin', 'plugin', plugin, (bus, term_event))
+            supervisor.start()
+            timer = threading.Timer(10, term_event.set)
+            timer.start()
+            supervisor.run(0.01, lambda: ticks.append(1))
+            timer.cancel()
+            self.assertEqual(received, flow_ids)
+            self.assertEqual(st.restarts, 1)
+            self.assertEqual(st.last_exit, 'SystemExit: 3')
+            self.assertFalse(any(st.is_alive() for st in supervisor.processes))
+            supervisor.close()
+        finally:
+            scitags.settings.SUPERVISOR_BACKOFF = backoff
+
+    def test_codec(self):
+        flow_ids = [
+            scitags.FlowID('start', 'tcp', '192.168.0.1', 2345, '192.168.0.2', 5777, 1, 2,
+                           '2024-10-14T10:11:12.123456+00:00'),
+            scitags.FlowID('end', 'udp', '2001:db8::1', 1, '2001:db8::2', 65535, 500, 63,
+                           '2024-10-14T10:11:12+00:00', '2024-10-14T11:00:00.000001+00:00',
+                           {'tcp_info': {'state': 'established', 'rtt': 0.5, 'opts': ['ts', 'sack']}}),
+            scitags.FlowID('ongoing', 'tcp', '::ffff:10.0.0.1', 1, '2001:DB8::2', 2, 'atlas', None,
+                           '2024-10-14 10:11:12', None),
+            scitags.FlowID('custom', 'sctp', '10.0.0.1', 70000, 'host', '80', 2 ** 40, -1),
+            scitags.FlowID('start', 'tcp', '192.168.0.1', 1, '192.168.0.2', 2, 1, 2, stamps=(12.5, 12.75)),
+            scitags.FlowID('end', 'tcp', '192.168.0.1', 2345, '192.168.0.2', 5777, 1, 2,
+                           '2024-10-14T10:11:12.123456+00:00', '2024-10-14T10:11:12.123457+00:00', {}),
+            scitags.FlowID('start', 'tcp', '192.168.0.1', 2345, '192.168.0.2', 5777, 1, 2,
+                           '2024-10-14T10:11:99.123456+00:00', '2024-10-14T10:11:12.+12345+00:00'),
+        ]
+        for flow_id in flow_ids:
+            self.assertEqual(scitags.codec.decode(scitags.codec.encode(flow_id)), flow_id)
+        self.assertEqual(len(scitags.codec.encode(flow_ids[0])), 64)
+        batch = scitags.codec.split_batch(scitags.codec.encode_batch(flow_ids))
+        self.assertEqual([scitags.codec.decode(e) for e in batch], flow_ids)
+
+    def test_queue_codec(self):
+        for bus in (scitags.PubSubQueue(scitags.codec), scitags.ring.RingBufferQueue(codec=scitags.codec)):
+            sub = bus.register()
+            flow_ids = [scitags.FlowID('start', 'tcp', '127.0.0.1', i, '127.0.0.1', 1, 1, 1) for i in range(10)]
+            bus.put(flow_ids[0])
+            bus.put_many(flow_ids[1:])
+            bus.put(None)
+            self.assertEqual(TestScitags.get_all(sub, 11, 20), flow_ids + [None])
+
+    def test_overload_policies(self):
+        def flow(state, port):
+            return scitags.FlowID(state, 'tcp', '127.0.0.1', port, '127.0.0.1', 1, 1, 1)
+        starts = [flow('start', i) for i in range(6)]
+
+        bus = scitags.PubSubQueue(capacity=4, policy='drop-newest')
+        sub = bus.register()
+        bus.put_many(starts)
+        bus.put(scitags.FlowMapUpdate(1, {}))
+        self.assertEqual(TestScitags.get_all(sub, 5, 10), starts[:4] + [scitags.FlowMapUpdate(1, {})])
+        self.assertEqual(sub.counters[scitags.EVENTS_DROPPED], 2)
+
+        bus = scitags.PubSubQueue(capacity=4, policy='drop-oldest')
+        sub = bus.register()
+        bus.put(scitags.FlowMapUpdate(1, {}))
+        for i in range(6):
+            bus.put(starts[i])
+        received = TestScitags.get_all(sub, sub.depth(), 10)
+        # frames already written to the pipe by the feeder thread can't be dropped
+        self.assertEqual(received[0], scitags.FlowMapUpdate(1, {}))
+        self.assertEqual(received[-1], starts[-1])
+        self.assertEqual(len(received) - 1 + sub.counters[scitags.EVENTS_DROPPED], 6)
+
+        bus = scitags.PubSubQueue(capacity=4, policy='cancel')
+        sub = bus.register()
+        bus.put_many(starts[:4])
+        bus.put_many(starts[4:])
+        bus.put_many([flow('end', 4)])
+        self.assertEqual(TestScitags.get_all(sub, 4, 10), starts[:4])
+        bus.put_many([])
+        self.assertEqual(TestScitags.get_all(sub, 1, 10), [starts[5]])
+        self.assertEqual(sub.counters[scitags.EVENTS_CANCELLED], 2)
+        # held events are sent on flush, those the producer still holds when it stops are dropped
+        bus.put_many(starts)
+        self.assertEqual(TestScitags.get_all(sub, 4, 10), starts[:4])
+        bus.flush()
+        self.assertEqual(TestScitags.get_all(sub, 2, 10), starts[4:])
+        bus.put_many(starts)
+        bus.release()
+        self.assertEqual(sub.counters[scitags.EVENTS_DROPPED], 2)
+
+        bus = scitags.PubSubQueue(capacity=4, policy='block')
+        sub = bus.register()
+        t = threading.Thread(target=bus.put_many, args=(starts,))
+        t.start()
+        self.assertEqual(TestScitags.get_all(sub, 6, 10), starts)
+        t.join()
+
+        bus = scitags.PubSubQueue(capacity=4, policy='block', block_timeout=0.1)
+        sub = bus.register()
+        bus.put_many(starts)
+        self.assertEqual(TestScitags.get_all(sub, 4, 10), starts[:4])
+        self.assertEqual(sub.counters[scitags.EVENTS_DROPPED], 2)
+
+        # full ring, control messages don't wait for the reader, events wait up to block_timeout
+        bus = scitags.ring.RingBufferQueue(4 * 4096, policy='block', block_timeout=0.1)
+        sub = bus.register()
+        big = [flow('start', i) for i in range(60)]
+        for i in range(10):
+            bus.put_many(big)
+        self.assertGreater(sub.counters[scitags.EVENTS_DROPPED], 0)
+        for i in range(4):
+            bus.put(scitags.FlowMapUpdate(i + 1, {'experiments': 'x' * 3000}))
+        bus.put(scitags.DrainRequest())
+        received = list()
+        while sub.drain_state.value != scitags.DRAIN_REQUESTED:
+            received.extend(sub.get_batch(1000, 1))
+        self.assertEqual(sub.overruns, 1)
+        self.assertEqual(received[-1].version, 4)
+
+        bus = scitags.ring.RingBufferQueue(4 * 4096, policy='drop-newest')
+        sub = bus.register()
+        big = [flow('start', i) for i in range(60)]
+        for i in range(10):
+            bus.put_many(big)
+        self.assertGreater(sub.counters[scitags.EVENTS_DROPPED], 0)
+        self.assertEqual(sub.lost, 0)
+        self.assertRaises(scitags.FlowConfigException, scitags.ring.RingBufferQueue, policy='cancel')
+
+    def test_coalesce(self):
+        def flow(state, port, start='2024-10-14T10:11:12.000000+00:00', end=None):
+            return scitags.FlowID(state, 'tcp', '127.0.0.1', port, '127.0.0.1', 1, 1, 1, start, end)
+        coalescer = scitags.FlowCoalescer(1, 0.5)
+        self.assertEqual(coalescer.process([flow('start', 1), flow('start', 2), flow('start', 3)], 10), [])
+        self.assertEqual(coalescer.next_release(), 11)
+        # flow 1 lasted less than min_lifetime, flow 2 is reported only by its end
+        end2 = flow('end', 2, end='2024-10-14T10:11:13+00:00')
+        self.assertEqual(coalescer.process([flow('end', 1, end='2024-10-14T10:11:12.200000+00:00'), end2,
+                                            scitags.FlowMapUpdate(1, {})], 10.5),
+                         [end2, scitags.FlowMapUpdate(1, {})])
+        self.assertEqual(coalescer.process([], 11), [flow('start', 3)])
+        self.assertEqual(coalescer.process([flow('end', 3, end='2024-10-14T10:11:12.100000+00:00')], 11),
+                         [flow('end', 3, end='2024-10-14T10:11:12.100000+00:00')])
+        self.assertEqual(scitags.flow_lifetime(flow('end', 1, end='bad')), None)
+
+        bus = scitags.PubSubQueue(coalesce=(0.1, 0))
+        sub = bus.register()
+        bus.put_many([flow('start', 1)])
+        self.assertEqual(sub.get_batch(10, timeout=1), [])
+        start = time.time()
+        self.assertEqual(sub.get_batch(10, timeout=1), [flow('start', 1)])
+        self.assertLess(time.time() - start, 0.5)
+        bus.put_many([flow('start', 2), flow('end', 2, end='2024-10-14T10:11:13+00:00')])
+        self.assertEqual(TestScitags.get_all(sub, 1, 10), [flow('end', 2, end='2024-10-14T10:11:13+00:00')])
+        self.assertEqual(sub.counters[scitags.FLOWS_COALESCED], 1)
+
+    @staticmethod
+    def slow_backend(q, term_event):
+        while not term_event.is_set():
+            try:
+                flow_ids = q.get_batch(2, timeout=0.1)
+            except queue.Empty:
+                continue
+            for flow_id in flow_ids:
+                time.sleep(0.01)
+                q.emitted(flow_id)
+
+    def test_drain(self):
+        def flow(state, port):
+            return scitags.FlowID(state, 'tcp', '127.0.0.1', port, '127.0.0.1', 1, 1, 1,
+                                  '2024-10-14T10:11:12+00:00', '2024-10-14T10:11:13+00:00')
+        # starts held by the coalescer are handed out once the drain is requested
+        bus = scitags.PubSubQueue(coalesce=(10, 0))
+        sub = bus.register()
+        bus.put_many([flow('start', 1), flow('start', 2), flow('end', 2)])
+        bus.put(scitags.DrainRequest())
+        self.assertEqual(TestScitags.get_all(sub, 2, 10), [flow('end', 2), flow('start', 1)])
+        self.assertEqual(sub.drain_state.value, scitags.DRAIN_REQUESTED)
+        self.assertRaises(queue.Empty, sub.get_batch, 10, 0.1)
+        self.assertEqual(sub.drain_state.value, scitags.DRAINED)
+
+        # backend keeps running after the plugins stopped until it has emitted all events queued before the request
+        flow_ids = [flow('start', i) for i in range(20)]
+        term_event = multiprocessing.Event()
+        bus = scitags.PubSubQueue()
+        sub = bus.register()
+        supervisor = scitags.supervisor.Supervisor(term_event)
+        supervisor.add('backend', 'backend', TestScitags.slow_backend, (sub, term_event))
+        supervisor.start()
+        bus.put_many(flow_ids)
+        bus.put(scitags.DrainRequest())
+        deadline = time.time() + 10
+        while sub.drain_state.value != scitags.DRAINED and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sub.counters[scitags.EVENTS_OUT], len(flow_ids))
+        self.assertEqual(sub.depth(), 0)
+        term_event.set()
+        supervisor.join(1, role='backend')
+        self.assertFalse(supervisor.processes[0].is_alive())
+        bus.close()
+
+    def test_latency_stats(self):
+        for bus in (scitags.PubSubQueue(latency=True), scitags.ring.RingBufferQueue(codec=scitags.codec, latency=True)):
+            sub = bus.register()
+            now = time.monotonic()
+            flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.1', 1, 1, 1, stamps=(now - 0.2, now - 0.1))
+            bus.put_many([flow_id])
+            bus.put(scitags.FlowMapUpdate(1, {}))
+            self.assertEqual(TestScitags.get_all(sub, 2, 10), [flow_id, scitags.FlowMapUpdate(1, {})])
+            sub.emitted(flow_id)
+            stats = sub.latency.interval()
+            self.assertEqual(dict((stage, count) for stage, (count, _) in stats.items()),
+                             {'plugin': 1, 'bus': 1, 'backend': 1, 'total': 1})
+            # upper bound of the bucket, 10% resolution
+            self.assertTrue(0.1 <= stats['plugin'][1][0] <= 0.11)
+            self.assertTrue(0.2 <= stats['total'][1][1] <= 0.25)
+            self.assertEqual(sub.latency.interval()['total'][0], 0)
+
+    def test_metrics(self):
+        bus = scitags.PubSubQueue(latency=True)
+        sub = bus.register()
+        flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.1', 1, 1, 1, stamps=(1.0, 1.0))
+        bus.put_many([flow_id, flow_id])
+        self.assertEqual(TestScitags.get_all(sub, 2, 10), [flow_id, flow_id])
+        sub.emitted(flow_id)
+        sub.count(scitags.SEND_ERRORS)
+        sub.destinations.count(sub.destinations.slot('flow'), scitags.DATAGRAMS_SENT)
+        service = ServiceStandIn()
+        service.backend_sub.append(('udp_firefly', sub))
+        srv = scitags.metrics.MetricsServer(service, os.path.join(tempfile.mkdtemp(), 'metrics.sock'))
+        srv.start()
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(srv.path)
+            s.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''.join(iter(lambda: s.recv(4096), b'')).decode('utf-8')
+            s.close()
+        finally:
+            srv.stop()
+        self.assertTrue(response.startswith('HTTP/1.0 200'))
+        for line in ('flowd_backend_events_in_total{backend="udp_firefly"} 2',
+                     'flowd_backend_events_out_total{backend="udp_firefly"} 1',
+                     'flowd_backend_send_errors_total{backend="udp_firefly"} 1',
+                     'flowd_bus_depth{backend="udp_firefly"} 0',
+                     'flowd_backend_datagrams_sent_total{backend="udp_firefly",destination="flow"} 1',
+                     'flowd_process_up{process="service",role="service"} 1'):
+            self.assertIn(line, response.splitlines())
+        self.assertFalse(os.path.exists(srv.path))
+
+    def test_flow_map(self):
+        FlowMapHandler.registry = {'experiments': [
+            {'expName': 'atlas', 'expId': 2, 'activities': [{'activityName': 'production', 'activityId': 9}]}]}
+        srv = HTTPServer(('127.0.0.1', 0), FlowMapHandler)
+        t = threading.Thread(target=srv.serve_forever)
+        t.daemon = True
+        t.start()
+        url = 'http://127.0.0.1:{}/flowmap.json'.format(srv.server_address[1])
+        cache = os.path.join(tempfile.mkdtemp(), 'flow_map.json')
+        try:
+            self.assertIsNone(scitags.flowmap.load_cache(cache))
+            entry = scitags.flowmap.fetch(url, timeout=5)
+            scitags.flowmap.save_cache(cache, entry)
+            flow_map = scitags.flowmap.parse(scitags.flowmap.load_cache(cache)['raw'])
+            self.assertEqual(flow_map, {'experiments': {'atlas': 2}, 'activities': {2: {'production': 9}}})
+
+            updates = list()
+            refresher = scitags.flowmap.FlowMapRefresher(url, flow_map, scitags.flowmap.load_cache(cache), cache,
+                                                         3600, 5, on_update=updates.append)
+            # unchanged registry is not transferred again
+            self.assertFalse(refresher.refresh())
+            self.assertEqual(FlowMapHandler.requests[-1], entry['etag'])
+            FlowMapHandler.registry['experiments'][0]['activities'].append({'activityName': 'debug', 'activityId': 10})
+            self.assertTrue(refresher.refresh())
+            self.assertEqual(flow_map['activities'][2], {'production': 9, 'debug': 10})
+            self.assertEqual(updates, [flow_map])
+            self.assertEqual(scitags.flowmap.parse(scitags.flowmap.load_cache(cache)['raw']), flow_map)
+        finally:
+            srv.shutdown()
+            srv.server_close()
+        # registry down, refresh fails but the map is kept
+        self.assertRaises(Exception, refresher.refresh)
+        self.assertEqual(flow_map['experiments'], {'atlas': 2})
+
+    def test_flow_map_update(self):
+        # control message reaches every backend worker, regardless of shards and dedup
+        update = scitags.FlowMapUpdate(1, {'experiments': {'atlas': 2}, 'activities': {2: {'production': 9}}})
+        flow_id = scitags.FlowID('start', 'tcp', '127.0.0.1', 1, '127.0.0.1', 1, 'atlas', 'production')
+        for bus in (scitags.PubSubQueue(dedup=True), scitags.ring.RingBufferQueue(codec=scitags.codec, dedup=True)):
+            subs = bus.register_shards(2)
+            bus.put_many([flow_id])
+            bus.put(update)
+            bus.put(update._replace(version=2))
+            for i, sub in enumerate(subs):
+                expected = [update, update._replace(version=2)]
+                if scitags.flow_shard(flow_id, 2) == i:
+                    expected.insert(0, flow_id)
+                self.assertEqual(TestScitags.get_all(sub, len(expected), 10), expected)
+
+    def test_config_update(self):
+        path = os.path.join(tempfile.mkdtemp(), 'flowd.cfg')
+        with open(path, 'w') as f:
+            f.write("PLUGIN='netstat'\nUDP_FIREFLY_DST='127.0.0.1'\nNETSTAT_TIMEOUT=5\n")
+        config_path = scitags.settings.CONFIG_PATH
+        scitags.settings.CONFIG_PATH = path
+        try:
+            flowd_config = importlib.import_module('scitags.config')
+        finally:
+            scitags.settings.CONFIG_PATH = config_path
+        old = flowd_config.load(path)
+        self.assertEqual(flowd_config.config, old)
+        new = dict(old, UDP_FIREFLY_DST='127.0.0.2', NETSTAT_INTERNAL_NETWORKS=['10.0.0.0/8'])
+        del new['NETSTAT_TIMEOUT']
+        changed, removed = flowd_config.delta(old, new)
+        self.assertEqual(changed, {'UDP_FIREFLY_DST': '127.0.0.2', 'NETSTAT_INTERNAL_NETWORKS': ['10.0.0.0/8']})
+        self.assertEqual(removed, ['NETSTAT_TIMEOUT'])
+
+        # update is applied by the subscriber and not handed out to the backend
+        version = flowd_config.version
+        bus = scitags.ring.RingBufferQueue()
+        sub = bus.register()
+        bus.put(scitags.ConfigUpdate(1, changed, removed))
+        bus.put(None)
+        self.assertEqual(sub.get(timeout=1), None)
+        self.assertEqual(flowd_config.config, new)
+        self.assertEqual(flowd_config.version, version + 1)
+
+    def test_firefly_serializer(self):
+        path = os.path.join(tempfile.mkdtemp(), 'flowd.cfg')
+        with open(path, 'w') as f:
+            f.write("PLUGIN='netstat'\n")
+        config_path = scitags.settings.CONFIG_PATH
+        scitags.settings.CONFIG_PATH = path
+        try:
+            udp_firefly = importlib.import_module('scitags.backends.udp_firefly')
+        finally:
+            scitags.settings.CONFIG_PATH = config_path
+
+        class FixedTime(datetime.datetime):
+            @classmethod
+            def utcnow(cls):
+                return datetime.datetime(2024, 10, 14, 10, 11, 12, 123456)
+
+            @classmethod
+            def utcfromtimestamp(cls, ts):
+                return cls.utcnow()
+
+        flow_map = {'experiments': {'atlas': 2}, 'activities': {2: {'production': 9}}}
+        ip_config = scitags.IPConfig('192.0.2.1', '10.0.0.1', '2001:db8::ff', '2001:db8::1')
+        flow_ids = [scitags.FlowID('start', 'tcp', '10.0.0.1', 43210, '192.168.0.2', 1094, 'atlas', 'production',
+                                   '2024-10-14T10:11:12.123456+00:00'),
+                    scitags.FlowID('end', 'tcp', '2001:db8::1', 43210, '2001:db8::2', 1094, 2, None,
+                                   '2024-10-14T10:11:12.123456+00:00', '2024-10-14T11:11:12.654321+00:00',
+                                   {'rtt': 0.361}),
+                    scitags.FlowID('ongoing', 'tcp', '10.0.0.1', 43210, '192.168.0.2', 1094, 'atlas', 'production',
+                                   '2024-10-14T10:11:12.123456+00:00'),
+                    scitags.FlowID('update', 'udp', '10.0.0.5', 5000, '10.0.0.1', 5001, 'atlas', 9)]
+        header = '<134>1 2024-10-14T10:11:12.123456+00:00 {} flowd - firefly-json - '.format(udp_firefly.SYSLOG_HOSTNAME)
+
+        def payload(state, times, flow, ids, **netlink):
+            firefly = {'version': 1,
+                       'flow-lifecycle': dict([('state', state), ('current-time', '2024-10-14T10:11:12.123456+00:00')]
+                                              + times),
+                       'flow-id': dict(zip(('afi', 'src-ip', 'dst-ip', 'protocol', 'src-port', 'dst-port'), flow)),
+                       'context': {'experiment-id': ids[0], 'activity-id': ids[1],
+                                   'application': 'flowd v{}'.format(scitags.VERSION)}}
+            firefly.update(netlink)
+            return header + json.dumps(firefly)
+        start = [('start-time', '2024-10-14T10:11:12.123456+00:00')]
+        end = start + [('end-time', '2024-10-14T11:11:12.654321+00:00')]
+        tcp4 = ('ipv4', '192.0.2.1', '192.168.0.2', 'tcp', 43210, 1094)
+        tcp6 = ('ipv6', '2001:db8::ff', '2001:db8::2', 'tcp', 43210, 1094)
+        udp4 = ('ipv4', '10.0.0.5', '192.0.2.1', 'udp', 5000, 5001)
+        # public IPs replace the internal ones, then UDP_FIREFLY_IP4_SRC overrides the source
+        src = ('ipv4', '192.0.2.9')
+        expected = [({}, [payload('start', start, tcp4, (2, 9)),
+                          payload('end', end, tcp6, (2, 0), netlink={'rtt': 0.361}),
+                          payload('ongoing', start, tcp4, (2, 9)),
+                          payload('update', [], udp4, (2, 9))]),
+                    ({'UDP_FIREFLY_IP4_SRC': '192.0.2.9', 'UDP_FIREFLY_WITH_NETLINK': True},
+                     [payload('start', start, src + tcp4[2:], (2, 9), netlink=None),
+                      payload('end', end, tcp6, (2, 0), netlink={'rtt': 0.361}),
+                      payload('ongoing', start, src + tcp4[2:], (2, 9), netlink=None),
+                      payload('update', [], src + udp4[2:], (2, 9), netlink=None)])]
+        saved = dict(udp_firefly.config)
+        udp_datetime = udp_firefly.datetime
+        udp_firefly.datetime = FixedTime
+        try:
+            for overrides, payloads in expected:
+                udp_firefly.config.update(overrides)
+                serializer = udp_firefly.FireflySerializer(flow_map, ip_config)
+                self.assertEqual([serializer.serialize(flow_id, {}) for flow_id in flow_ids], payloads)
+            self.assertRaises(scitags.FlowIdException, serializer.serialize, flow_ids[0]._replace(exp='cms'), {})
+        finally:
+            udp_firefly.datetime = udp_datetime
+            udp_firefly.config.clear()
+            udp_firefly.config.update(saved)
+
+    def test_timer_wheel(self):
+        wheel = scitags.timers.TimerWheel(tick=1.0, slots=8, now=100.0)
+        wheel.schedule('a', 2, 'flow a', now=100.0)
+        wheel.schedule('b', 5, 'flow b', now=100.5)
+        wheel.schedule('c', 20, 'flow c', now=100.0)     # more than a turn of the wheel
+        wheel.schedule('d', 2, 'flow d', now=100.0)
+        self.assertEqual(len(wheel), 4)
+        self.assertTrue(wheel.cancel('d'))
+        self.assertFalse(wheel.cancel('d'))
+        self.assertEqual(wheel.advance(now=101.9), [])
+        self.assertEqual(wheel.advance(now=102.0), [('a', 'flow a')])
+        wheel.schedule('a', 2, 'flow a', now=102.0)
+        self.assertEqual(wheel.advance(now=105.0), [('a', 'flow a')])
+        self.assertEqual(wheel.advance(now=106.0), [('b', 'flow b')])
+        # 'c' shares its slot with the second timer of 'a'
+        self.assertIn('c', wheel)
+        self.assertEqual(wheel.advance(now=119.9), [])
+        self.assertEqual(wheel.advance(now=120.0), [('c', 'flow c')])
+        self.assertEqual(len(wheel), 0)
+        # after a pause longer than a turn all timers due are returned at once
+        for i in range(20):
+            wheel.schedule(i, i + 1, i, now=120.0)
+        self.assertEqual(sorted(v for _, v in wheel.advance(now=135.0)), list(range(15)))
+        self.assertEqual(len(wheel), 5)
+        wheel.clear()
+        self.assertEqual(wheel.advance(now=200.0), [])
+
+    @unittest.skipIf(pyroute2 is None, 'pyroute2 not installed')
+    def test_netlink_lookup(self):
+        cache = importlib.import_module('scitags.netlink.cache')
+        listener = socket.socket(socket.AF_INET6)
+        listener.bind(('::', 0))
+        listener.listen(1)
+        conns = [socket.create_connection((host, listener.getsockname()[1])) for host in ('127.0.0.1', '::1')]
+        accepted = [listener.accept()[0] for _ in conns]
+        try:
+            for conn in conns + accepted:
+                src, src_port = conn.getsockname()[:2]
+                dst, dst_port = conn.getpeername()[:2]
+                src, dst = src.replace('::ffff:', ''), dst.replace('::ffff:', '')
+                key = ('tcp', src, src_port, dst, dst_port)
+                exact, dump = dict(), dict()
+                cache.netlink_cache_add('start', src, src_port, dst, dst_port, exact)
+                self.assertTrue(cache.EXACT_LOOKUP)
+                cache.EXACT_LOOKUP = False
+                try:
+                    cache.netlink_cache_add('start', src, src_port, dst, dst_port, dump)
+                finally:
+                    cache.EXACT_LOOKUP = True
+                self.assertEqual(list(exact), [key])
+                self.assertEqual(list(dump), [key])
+                self.assertEqual(exact[key][0], 'established')
+                self.assertEqual(exact[key][1]['inode'], dump[key][1]['inode'])
+            # connection that's gone
+            missing = dict()
+            cache.netlink_cache_add('start', '127.0.0.1', 1, '127.0.0.1', 2, missing)
+            self.assertEqual(missing, {})
+            self.assertTrue(cache.EXACT_LOOKUP)
+            # refresh reports the connections that are gone and keeps their last known state
+            gone = ('tcp', '127.0.0.1', 1, '127.0.0.1', 2)
+            exact[gone] = ('established', {})
+            self.assertEqual(cache.netlink_cache_update(exact), {gone})
+            self.assertIn(gone, exact)
+            # single connection refresh (ongoing fireflies)
+            self.assertTrue(cache.netlink_cache_refresh(src, src_port, dst, dst_port, exact))
+            self.assertFalse(cache.netlink_cache_refresh('127.0.0.1', 1, '127.0.0.1', 2, exact))
+            self.assertEqual(exact[gone], ('established', {}))
+        finally:
+            for conn in conns + accepted + [listener]:
+                conn.close()
+
+    def test_udp_sender(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        port = receiver.getsockname()[1]
+        for use_sendmmsg in (True, False):
+            counters = scitags.DestinationCounters()
+            sender = scitags.udp.UDPSender(counters, use_sendmmsg=use_sendmmsg)
+            for i in range(5):
+                sender.send('firefly {}'.format(i).encode('utf-8'), '127.0.0.1', port, 'flow')
+            sender.send(b'collector', 'localhost', port, 'localhost')
+            self.assertEqual(sender.flush(), 0)
+            self.assertEqual(sorted(receiver.recv(100) for _ in range(6)),
+                             [b'collector'] + ['firefly {}'.format(i).encode('utf-8') for i in range(5)])
+            self.assertEqual(dict(counters.items()), {'flow': [5, 0, 0, 0, 0, 0, 0], 'localhost': [1, 0, 0, 0, 0, 0, 0]})
+            sender.close()
+
+        # burst larger than the socket buffer, flush doesn't block and the oldest datagrams are dropped
+        counters = scitags.DestinationCounters()
+        sender = scitags.udp.UDPSender(counters, queue_size=1000, sndbuf=4096)
+        start = time.time()
+        for i in range(10000):
+            sender.send(b'x' * 1000, '127.0.0.1', 9, 'flow')
+            if i % 512 == 0:
+                sender.flush()
+        sender.flush()
+        self.assertLess(time.time() - start, 5)
+        sent, eagain, dropped = dict(counters.items())['flow'][:3]
+        self.assertEqual(sent + dropped + sender.pending(), 10000)
+        self.assertLessEqual(sender.pending(), 1000)
+        sender.close()
+        receiver.close()
+
+    def test_collectors(self):
+        collectors = scitags.udp.parse_collectors(['collector.example.org', '192.0.2.1:9999', '[2001:db8::1]:9999',
+                                                   '2001:db8::2', {'host': '::1', 'rate': 10, 'backup': True}],
+                                                  10514)
+        self.assertEqual([c.name for c in collectors], ['collector.example.org:10514', '192.0.2.1:9999',
+                                                        '[2001:db8::1]:9999', '[2001:db8::2]:10514', '[::1]:10514'])
+        self.assertEqual((collectors[4].rate, collectors[4].backup), (10, True))
+        self.assertRaises(scitags.FlowConfigException, scitags.udp.parse_collectors, 'host:port', 10514)
+        self.assertRaises(scitags.FlowConfigException, scitags.udp.parse_collectors, [{'host': 'a', 'tls': 1}], 1)
+        now = time.monotonic()
+        self.assertEqual(sum(collectors[4].allow(now) for _ in range(20)), 10)
+        self.assertEqual(sum(collectors[4].allow(now + 0.5) for _ in range(10)), 5)
+
+        # primary collector refuses the datagrams (nothing listening), it's taken down and the backup takes over
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        for use_sendmmsg in (True, False):
+            counters = scitags.DestinationCounters()
+            sender = scitags.udp.UDPSender(counters, use_sendmmsg=use_sendmmsg)
+            primary = scitags.udp.Collector('127.0.0.1', closed_port)
+            backup = scitags.udp.Collector('127.0.0.1', receiver.getsockname()[1], backup=True)
+            sender.set_collectors([primary, backup])
+            for i in range(10):
+                sender.send_collectors(b'firefly')
+                sender.flush()
+                time.sleep(0.01)
+            self.assertFalse(primary.is_up(time.monotonic()))
+            self.assertEqual(dict(counters.states()), {primary.name: 0, backup.name: 1})
+            stats = dict(counters.items())
+            self.assertEqual(stats[primary.name][scitags.DESTINATION_ERRORS], 3)
+            self.assertEqual(stats[primary.name][scitags.DATAGRAMS_SENT] +
+                             stats[primary.name][scitags.DATAGRAMS_DROPPED], 10)
+            received = stats[backup.name][scitags.DATAGRAMS_SENT]
+            self.assertGreater(received, 0)
+            self.assertEqual([receiver.recv(100) for _ in range(received)], [b'firefly'] * received)
+            sender.close()
+        receiver.close()
+
+    def test_resolver(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(0.01)
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        lookups = list()
+
+        def getaddrinfo(host, port, family, socktype):
+            # first record doesn't accept datagrams, the second one does
+            lookups.append(host)
+            time.sleep(0.1)
+            if host != 'collector.test':
+                raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+            return [(socket.AF_INET, socktype, 17, '', ('127.0.0.1', closed_port)),
+                    (socket.AF_INET, socktype, 17, '', ('127.0.0.1', receiver.getsockname()[1]))]
+
+        resolver = scitags.udp.Resolver(ttl=300, negative_ttl=0.1, getaddrinfo=getaddrinfo)
+        self.assertEqual(resolver.lookup('192.0.2.1', 1), [(socket.AF_INET, ('192.0.2.1', 1))])
+        counters = scitags.DestinationCounters()
+        sender = scitags.udp.UDPSender(counters, resolver=resolver)
+        collector = scitags.udp.Collector('collector.test', 9999)
+        sender.set_collectors([collector, scitags.udp.Collector('unknown.test', 9999)])
+        # lookups are done in the background, datagrams wait for them
+        start = time.time()
+        sender.send_collectors(b'firefly')
+        self.assertEqual(sender.flush(), 2)
+        self.assertLess(time.time() - start, 0.05)
+        deadline = time.time() + 5
+        received = list()
+        while time.time() < deadline and not received:
+            sender.send_collectors(b'firefly')
+            sender.flush()
+            time.sleep(0.01)
+            try:
+                received.append(receiver.recv(100))
+            except socket.timeout:
+                pass
+        self.assertEqual(received, [b'firefly'])
+        self.assertEqual(collector.addr_index, 1)
+        while time.time() < deadline and 'unknown.test' not in lookups:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        stats = dict(counters.items())
+        self.assertEqual(stats['collector.test:9999'][scitags.DNS_LOOKUPS], 1)
+        self.assertEqual(stats['collector.test:9999'][scitags.DESTINATION_ERRORS], 1)
+        self.assertGreaterEqual(stats['unknown.test:9999'][scitags.DNS_FAILURES], 1)
+        self.assertGreater(dict(counters.times())['collector.test:9999'], 0.1)
+        self.assertEqual(lookups.count('collector.test'), 1)
+        sender.close()
+        receiver.close()
+
+    def test_startup_profile(self):
+        profile = scitags.startup.StartupProfile(enabled=True)
+        with profile.phase('config'):
+            time.sleep(0.01)
+        self.assertRaises(ValueError, self.fail_phase, profile)
+        self.assertEqual([name for name, _ in profile.phases], ['config', 'flow map'])
+        self.assertGreaterEqual(profile.phases[0][1], 0.01)
+        profile.report()
+
+    @staticmethod
+    def busy(seconds):
+        start = time.process_time()
+        while time.process_time() - start < seconds:
+            sum(range(1000))
+
+    def test_profiling(self):
+        work_dir = scitags.settings.WORK_DIR
+        scitags.settings.WORK_DIR = tempfile.mkdtemp()
+        try:
+            profiler = scitags.profiling.Profiler('backend', 'test')
+            profiler.toggle_profile()
+            TestScitags.busy(0.2)
+            profiler.toggle_profile()
+            # nothing is left armed when the profiler is off
+            self.assertEqual(signal.getitimer(signal.ITIMER_PROF), (0.0, 0.0))
+            profiler.toggle_heap()
+            blocks = [bytearray(1024) for _ in range(1000)]
+            profiler.toggle_heap()
+            files = sorted(os.listdir(scitags.settings.WORK_DIR))
+            self.assertEqual(len(files), 2)
+            self.assertTrue(files[0].startswith('heap-backend-test-{}-'.format(os.getpid())))
+            self.assertTrue(files[1].startswith('profile-backend-test-{}-'.format(os.getpid())))
+            with open(os.path.join(scitags.settings.WORK_DIR, files[1])) as f:
+                stacks = [line.rsplit(' ', 1) for line in f.read().splitlines()]
+            self.assertTrue(any('tests.py:busy' in stack for stack, _ in stacks))
+            with open(os.path.join(scitags.settings.WORK_DIR, files[0])) as f:
+                self.assertIn('tests.py', f.read())
+        finally:
+            scitags.settings.WORK_DIR = work_dir
+
+    @staticmethod
+    def log_worker(name):
+        logger = logging.getLogger(name)
+        scitags.logs.attach(logger)
+        logger.info('logged by %s', 'worker')
+
+    def test_logs(self):
+        records = list()
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger('scitags.test_logs')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(ListHandler())
+        listener = scitags.logs.start(logger)
+        try:
+            p = multiprocessing.Process(target=TestScitags.log_worker, args=(logger.name,))
+            p.start()
+            p.join()
+        finally:
+            listener.stop()
+            scitags.logs._queue = None
+        self.assertEqual([(r.getMessage(), r.process) for r in records], [('logged by worker', p.pid)])
+
+        del records[:]
+        event_log = scitags.logs.EventLog('test', 2, interval=3600, logger=logger)
+        for i in range(5):
+            if event_log.allow():
+                logger.info('event %s', i)
+        self.assertEqual([r.getMessage() for r in records[:2]], ['event 0', 'event 1'])
+        self.assertEqual(len(records) + event_log.suppressed, 5)
+        logged = len(records)
+        event_log.summary()
+        self.assertIn('5 events', records[-1].getMessage())
+        self.assertEqual(len(records), logged + 1)
+        self.assertEqual(event_log.suppressed, 0)
+
+    @staticmethod
+    def fail_phase(profile):
+        # failed phase is still accounted for
+        with profile.phase('flow map'):
+            raise ValueError()
+
 
 if __name__ == '__main__':
     unittest.main()